@@ -0,0 +1,228 @@
+import math
+import os
+import threading
+import time
+
+from flask import g, request
+from flask_login import current_user
+from werkzeug.exceptions import ServiceUnavailable, TooManyRequests
+
+import metrics
+from writer import ENABLED as WRITER_ENABLED
+from writer import get_writer
+
+# 0 turns admission control off, e.g. for load tests from a single address
+ENABLED = os.environ.get('ADMISSION', '1') == '1'
+
+
+def _rate(route_class, rate, burst):
+  prefix = f'ADMISSION_{route_class.upper()}'
+  return (float(os.environ.get(f'{prefix}_RATE', rate)),
+          float(os.environ.get(f'{prefix}_BURST', burst)))
+
+
+# requests per second and burst, for each client (user and IP) and route
+# class. 0 as the rate turns a class off.
+RATES = {
+    'auth': _rate('auth', 0.2, 5),
+    'write': _rate('write', 1, 10),
+    'read': _rate('read', 10, 50),
+    # failed logins per account and IP; only failures count, so nobody
+    # else can use up an account's logins
+    'failed_login': _rate('failed_login', 0.2, 5),
+}
+# DB-bound requests a worker process serves at once; beyond that they are
+# turned away with 503 instead of waiting for a connection or the write lock
+MAX_IN_FLIGHT = int(os.environ.get('ADMISSION_MAX_IN_FLIGHT', 32))
+# write requests are turned away while this many jobs wait for the writer
+# thread (0 = no limit)
+MAX_WRITE_BACKLOG = int(os.environ.get('ADMISSION_MAX_WRITE_BACKLOG', 200))
+# Retry-After sent with 503s
+RETRY_AFTER = int(os.environ.get('ADMISSION_RETRY_AFTER', 1))
+# how to find the client's address: the number of proxies in front of the
+# app that append to X-Forwarded-For, or 0 for the socket address. Set it
+# when deploying behind a proxy, or every client shares the proxy's bucket.
+PROXY_HOPS = int(os.environ.get('ADMISSION_PROXY_HOPS', 0))
+# buckets kept before the idle ones are dropped
+MAX_BUCKETS = int(os.environ.get('ADMISSION_MAX_BUCKETS', 100000))
+
+# endpoints that never touch the database
+UNLIMITED = {'static', 'prometheus_metrics', 'cache_stats'}
+AUTH_ENDPOINTS = {'login', 'register_customer', 'register_restaurant'}
+# GET routes that write
+WRITE_ENDPOINTS = {'order_customer', 'deleteItem'}
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+requests_shed = metrics.registry.register(
+    metrics.Counter('lieferspatz_requests_shed_total',
+                    'Requests turned away by admission control.',
+                    ('class', 'reason')))
+
+
+# token buckets keyed by (route class, client). A bucket refills at the
+# class's rate up to its burst; a request takes one token from each of its
+# client's buckets.
+class RateLimiter:
+
+  def __init__(self, rates=RATES, max_buckets=MAX_BUCKETS):
+    self.rates = rates
+    self.max_buckets = max_buckets
+    self._buckets = {}
+    self._lock = threading.Lock()
+
+  def _levels(self, route_class, clients, now):
+    rate, burst = self.rates[route_class]
+    levels = {}
+    for client in clients:
+      tokens, updated = self._buckets.get((route_class, client), (burst, now))
+      levels[(route_class, client)] = min(burst,
+                                          tokens + (now - updated) * rate)
+    return levels
+
+  def _wait(self, route_class, levels):
+    rate = self.rates[route_class][0]
+    if rate <= 0 or not levels:
+      return 0
+    return max(0, max((1 - tokens) / rate for tokens in levels.values()))
+
+  # seconds until every bucket has a token again, without taking any
+  def wait(self, route_class, clients, now=None):
+    now = time.monotonic() if now is None else now
+    with self._lock:
+      return self._wait(route_class, self._levels(route_class, clients, now))
+
+  # 0 if the request is admitted, otherwise the seconds until every bucket
+  # has a token again. A refused request takes no tokens.
+  def take(self, route_class, clients, now=None):
+    return self._take(route_class, clients, now, check=True)
+
+  # takes a token from every bucket whether or not it has one left, e.g.
+  # once a login has failed
+  def charge(self, route_class, clients, now=None):
+    self._take(route_class, clients, now, check=False)
+
+  def _take(self, route_class, clients, now, check):
+    if self.rates[route_class][0] <= 0:
+      return 0
+    now = time.monotonic() if now is None else now
+    with self._lock:
+      levels = self._levels(route_class, clients, now)
+      wait = self._wait(route_class, levels)
+      if check and wait > 0:
+        return wait
+      for key, tokens in levels.items():
+        self._buckets[key] = (max(tokens - 1, 0), now)
+      if len(self._buckets) > self.max_buckets:
+        self._prune(now)
+    return 0
+
+  # drops the buckets that have refilled, which behave like absent ones
+  def _prune(self, now):
+    for key, (tokens, updated) in list(self._buckets.items()):
+      rate, burst = self.rates[key[0]]
+      if tokens + (now - updated) * rate >= burst:
+        del self._buckets[key]
+    # under a flood of distinct clients, forget them all rather than grow
+    if len(self._buckets) > self.max_buckets:
+      self._buckets.clear()
+
+
+rate_limiter = RateLimiter()
+_in_flight = 0
+_in_flight_lock = threading.Lock()
+
+
+def route_class(endpoint, method):
+  if endpoint is None or endpoint in UNLIMITED:
+    return None
+  if endpoint in AUTH_ENDPOINTS:
+    return 'read' if method in SAFE_METHODS else 'auth'
+  if method not in SAFE_METHODS or endpoint in WRITE_ENDPOINTS:
+    return 'write'
+  return 'read'
+
+
+def client_ip():
+  if PROXY_HOPS > 0:
+    forwarded = [
+        addr.strip()
+        for addr in request.headers.get('X-Forwarded-For', '').split(',')
+        if addr.strip()
+    ]
+    if len(forwarded) >= PROXY_HOPS:
+      return forwarded[-PROXY_HOPS]
+  return request.remote_addr or 'unknown'
+
+
+# the buckets a request draws from: its IP and, once logged in, its user
+def clients():
+  keys = [f'ip:{client_ip()}']
+  if current_user.is_authenticated:
+    keys.append(f'user:{current_user.id}')
+  return keys
+
+
+def _failed_login_key(email):
+  account = (email or '').strip().lower()
+  return f'account:{account}|{client_ip()}'
+
+
+# called by the login view when the password did not match
+def login_failed(email):
+  if ENABLED:
+    rate_limiter.charge('failed_login', [_failed_login_key(email)])
+
+
+def _shed(route_class, reason):
+  requests_shed.inc(route_class, reason)
+
+
+def _admit():
+  global _in_flight
+  kind = route_class(request.endpoint, request.method)
+  if kind is None:
+    return
+  wait = rate_limiter.take(kind, clients())
+  if request.endpoint == 'login' and kind == 'auth':
+    wait = max(
+        wait,
+        rate_limiter.wait('failed_login',
+                          [_failed_login_key(request.form.get('email'))]))
+  if wait > 0:
+    _shed(kind, 'rate_limit')
+    raise TooManyRequests(retry_after=math.ceil(wait))
+  if (kind == 'write' and WRITER_ENABLED and MAX_WRITE_BACKLOG > 0
+      and get_writer().backlog() >= MAX_WRITE_BACKLOG):
+    _shed(kind, 'write_backlog')
+    raise ServiceUnavailable(retry_after=RETRY_AFTER)
+  with _in_flight_lock:
+    if _in_flight >= MAX_IN_FLIGHT:
+      admitted = False
+    else:
+      _in_flight += 1
+      admitted = g.admitted = True
+  if not admitted:
+    _shed(kind, 'in_flight')
+    raise ServiceUnavailable(retry_after=RETRY_AFTER)
+
+
+def _release(*_):
+  global _in_flight
+  if g.pop('admitted', False):
+    with _in_flight_lock:
+      _in_flight -= 1
+
+
+metrics.registry.register(
+    metrics.Gauge('lieferspatz_requests_in_flight',
+                  'DB-bound requests being served by this process.',
+                  lambda: {(): _in_flight}))
+
+
+# register after metrics.init_app so shed requests are still timed and
+# counted by status
+def init_app(app):
+  if not ENABLED:
+    return
+  app.before_request(_admit)
+  app.teardown_request(_release)
@@ -0,0 +1,136 @@
+from datetime import date, timedelta
+
+import archive
+
+# per restaurant and day: orders that were not canceled, their revenue, and
+# how many were canceled. Kept up to date by place_order/update_status, so
+# reading a range costs one row per day however many orders there are.
+DAILY_SALES_TABLE = """CREATE TABLE IF NOT EXISTS DailySales (
+  RestaurantId INTEGER NOT NULL,
+  Day TEXT NOT NULL,
+  Orders INTEGER NOT NULL DEFAULT 0,
+  Revenue REAL NOT NULL DEFAULT 0,
+  Canceled INTEGER NOT NULL DEFAULT 0,
+  PRIMARY KEY (RestaurantId, Day)
+) WITHOUT ROWID"""
+
+DAILY_ITEM_SALES_TABLE = """CREATE TABLE IF NOT EXISTS DailyItemSales (
+  RestaurantId INTEGER NOT NULL,
+  Day TEXT NOT NULL,
+  ItemID INTEGER NOT NULL,
+  Quantity INTEGER NOT NULL DEFAULT 0,
+  PRIMARY KEY (RestaurantId, Day, ItemID)
+) WITHOUT ROWID"""
+
+ANALYTICS_DAYS = 30
+
+
+def order_day(order_time):
+  # Order_Time is stored as str(datetime), so the day is its date prefix
+  return str(order_time)[:10]
+
+
+# adds (sign=1) or removes (sign=-1) one order's contribution and moves the
+# day's canceled count by `canceled`. `lines` are (item id, quantity) pairs.
+# Must run inside the order's write transaction.
+def record_order(conn, restaurant_id, day, total, lines, sign=1, canceled=0):
+  conn.execute(
+      """INSERT INTO DailySales (RestaurantId, Day, Orders, Revenue, Canceled)
+      VALUES (?, ?, ?, ?, ?)
+      ON CONFLICT(RestaurantId, Day) DO UPDATE SET
+        Orders = Orders + excluded.Orders,
+        Revenue = Revenue + excluded.Revenue,
+        Canceled = Canceled + excluded.Canceled""",
+      (int(restaurant_id), day, sign, sign * total, canceled))
+  conn.executemany(
+      """INSERT INTO DailyItemSales (RestaurantId, Day, ItemID, Quantity)
+      VALUES (?, ?, ?, ?)
+      ON CONFLICT(RestaurantId, Day, ItemID) DO UPDATE SET
+        Quantity = Quantity + excluded.Quantity""",
+      [(int(restaurant_id), day, item, sign * quantity)
+       for item, quantity in lines])
+
+
+# a status change only matters when an order enters or leaves 'Canceled'
+def record_status_change(conn, order_id, order, old_status, new_status):
+  if (old_status == 'Canceled') == (new_status == 'Canceled'):
+    return
+  sign = -1 if new_status == 'Canceled' else 1
+  lines = conn.execute(
+      'SELECT ItemID, Quantity FROM OrderItem WHERE OrderItem.OrderId = ?',
+      (int(order_id), )).fetchall()
+  record_order(conn, order['RestaurantId'], order_day(order['Order_Time']),
+               order['TotalCost'], [tuple(line) for line in lines], sign,
+               canceled=-sign)
+
+
+# every order, hot or archived, for the rebuild. Before the archive
+# migration has run (the rollups come first) there is only the hot table.
+def _all_orders(conn, columns, table='Orders'):
+  if not archive.has_archive(conn):
+    return table
+  return f"""(SELECT {columns} FROM main.{table} UNION ALL
+    SELECT {columns} FROM archive.{table}
+    WHERE OrderId NOT IN (SELECT OrderId FROM main.Orders)) AS {table}"""
+
+
+# recomputes both tables from the order history; the backfill for existing
+# data and the repair tool if they ever drift
+def rebuild(conn):
+  orders = _all_orders(conn, 'OrderId, RestaurantId, Order_Time, Status, '
+                       'TotalCost')
+  order_items = _all_orders(conn, 'OrderId, ItemID, Quantity', 'OrderItem')
+  conn.execute('DELETE FROM DailySales')
+  conn.execute('DELETE FROM DailyItemSales')
+  conn.execute(f"""/* scan-ok */ INSERT INTO DailySales
+    (RestaurantId, Day, Orders, Revenue, Canceled)
+    SELECT RestaurantId, substr(Order_Time, 1, 10),
+      SUM(Status != 'Canceled'),
+      SUM(CASE WHEN Status != 'Canceled' THEN TotalCost ELSE 0 END),
+      SUM(Status = 'Canceled')
+    FROM {orders} GROUP BY RestaurantId, substr(Order_Time, 1, 10)""")
+  conn.execute(f"""/* scan-ok */ INSERT INTO DailyItemSales
+    (RestaurantId, Day, ItemID, Quantity)
+    SELECT Orders.RestaurantId, substr(Orders.Order_Time, 1, 10),
+      OrderItem.ItemID, SUM(OrderItem.Quantity)
+    FROM {orders} JOIN {order_items} ON OrderItem.OrderId = Orders.OrderId
+    WHERE Orders.Status != 'Canceled'
+    GROUP BY 1, 2, 3""")
+
+
+# the last `days` days for the restaurant dashboard
+def sales_summary(conn, restaurant_id, days=ANALYTICS_DAYS, today=None):
+  today = today or date.today()
+  since = (today - timedelta(days=days - 1)).isoformat()
+  rows = conn.execute(
+      'SELECT Day, Orders, Revenue, Canceled FROM DailySales '
+      'WHERE RestaurantId = ? AND Day >= ? ORDER BY Day',
+      (int(restaurant_id), since)).fetchall()
+  top_items = conn.execute(
+      """SELECT DailyItemSales.ItemID, Items.ItemName,
+        SUM(DailyItemSales.Quantity) as Quantity
+      FROM DailyItemSales
+      JOIN Items ON Items.ItemID = DailyItemSales.ItemID
+      WHERE DailyItemSales.RestaurantId = ? AND DailyItemSales.Day >= ?
+      GROUP BY DailyItemSales.ItemID
+      HAVING SUM(DailyItemSales.Quantity) > 0
+      ORDER BY Quantity DESC LIMIT 10""",
+      (int(restaurant_id), since)).fetchall()
+  daily = [{
+      'day': row['Day'],
+      'orders': row['Orders'],
+      'revenue': round(row['Revenue'], 2),
+      'canceled': row['Canceled']
+  } for row in rows]
+  return {
+      'since': since,
+      'orders': sum(day['orders'] for day in daily),
+      'revenue': round(sum(row['Revenue'] for row in rows), 2),
+      'canceled': sum(day['canceled'] for day in daily),
+      'daily': daily,
+      'top_items': [{
+          'item_id': row['ItemID'],
+          'name': row['ItemName'],
+          'quantity': row['Quantity']
+      } for row in top_items],
+  }
@@ -0,0 +1,206 @@
+import gzip
+import hashlib
+import json
+import os
+from functools import wraps
+
+from flask import Blueprint, abort, make_response, request, url_for
+from flask_login import current_user
+from werkzeug.exceptions import HTTPException
+
+from discovery import restaurant_index
+from menu import menu_cache
+from utils import getUserPostcode, isCustomer
+
+try:
+  import brotli
+except ImportError:  # gzip only
+  brotli = None
+
+# restaurants per /menus request
+MAX_BATCH = int(os.environ.get('API_MAX_BATCH', 20))
+# smaller bodies are sent as they are; compressing them saves next to nothing
+COMPRESS_MIN_BYTES = int(os.environ.get('API_COMPRESS_MIN_BYTES', 512))
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+
+# JSON for native clients, next to the HTML routes. Every response can be
+# trimmed with ?fields=, carries an ETag and is compressed when the client
+# accepts it.
+api = Blueprint('api', __name__, url_prefix='/api/v1')
+
+
+def customer_only(view):
+
+  @wraps(view)
+  def wrapped(*args, **kwargs):
+    if not current_user.is_authenticated:
+      abort(401)
+    if not isCustomer():
+      abort(403)
+    return view(*args, **kwargs)
+
+  return wrapped
+
+
+# ?fields=name,items.name,items.price -> {'name': None, 'items': {'name':
+# None, 'price': None}}; None keeps the whole value
+def parse_fields(spec):
+  tree = {}
+  for path in (spec or '').split(','):
+    parts = [part for part in path.strip().split('.') if part]
+    node = tree
+    for i, part in enumerate(parts):
+      if part in node and node[part] is None:
+        break
+      if i == len(parts) - 1:
+        node[part] = None
+      else:
+        node = node.setdefault(part, {})
+  return tree or None
+
+
+def select_fields(value, tree):
+  if tree is None:
+    return value
+  if isinstance(value, list):
+    return [select_fields(entry, tree) for entry in value]
+  if isinstance(value, dict):
+    return {
+        key: select_fields(value[key], subtree)
+        for key, subtree in tree.items() if key in value
+    }
+  return value
+
+
+def _not_modified(etag):
+  response = make_response('', 304)
+  response.set_etag(etag, weak=True)
+  return response
+
+
+# {key: entries} as compact JSON with an ETag; ?fields= applies to each
+# entry. Callers that can name the version without serializing pass `etag`
+# (and a callable for `entries`) and get the 304 before any work is done.
+def json_response(key, entries, etag=None):
+  fields = parse_fields(request.args.get('fields'))
+  if etag is not None:
+    etag = hashlib.sha1(
+        f'{etag}|{request.args.get("fields", "")}'.encode()).hexdigest()
+    if request.if_none_match.contains_weak(etag):
+      return _not_modified(etag)
+  if callable(entries):
+    entries = entries()
+  body = json.dumps({key: select_fields(entries, fields)},
+                    separators=(',', ':'),
+                    ensure_ascii=False).encode()
+  if etag is None:
+    etag = hashlib.sha1(body).hexdigest()
+    if request.if_none_match.contains_weak(etag):
+      return _not_modified(etag)
+  response = make_response(body)
+  response.mimetype = 'application/json'
+  # weak, since the same version is sent gzip'd, brotli'd or plain
+  response.set_etag(etag, weak=True)
+  response.headers['Cache-Control'] = 'private, no-cache'
+  return response
+
+
+def _encoding():
+  accepted = request.accept_encodings
+  if brotli is not None and accepted.quality('br') > 0 and (
+      accepted.quality('br') >= accepted.quality('gzip')):
+    return 'br'
+  if accepted.quality('gzip') > 0:
+    return 'gzip'
+  return None
+
+
+@api.after_request
+def compress(response):
+  response.vary.add('Accept-Encoding')
+  if (response.status_code != 200 or response.direct_passthrough
+      or 'Content-Encoding' in response.headers):
+    return response
+  body = response.get_data()
+  encoding = _encoding() if len(body) >= COMPRESS_MIN_BYTES else None
+  if encoding == 'br':
+    response.set_data(brotli.compress(body, quality=BROTLI_QUALITY))
+  elif encoding == 'gzip':
+    response.set_data(gzip.compress(body, GZIP_LEVEL, mtime=0))
+  if encoding:
+    response.headers['Content-Encoding'] = encoding
+  return response
+
+
+@api.errorhandler(HTTPException)
+def error(e):
+  # keeps headers such as Retry-After
+  headers = [(key, value) for key, value in e.get_headers()
+             if key != 'Content-Type']
+  return {'error': e.name, 'message': e.description}, e.code, headers
+
+
+def _image(picture):
+  return url_for('static', filename=f'uploads/{picture}') if picture else None
+
+
+def restaurant_payload(row):
+  return {
+      'id': row['RestaurantID'],
+      'name': row['RestaurantName'],
+      'description': row['Description'],
+      'opening_time': row['OpeningTime'],
+      'closing_time': row['ClosingTime'],
+      'image_path': _image(row.get('PictureThumb') or row.get('Picture')),
+  }
+
+
+def menu_payload(snapshot):
+  return {
+      'id': snapshot.restaurant_id,
+      'name': snapshot.name,
+      'items': [{
+          'id': item['ItemID'],
+          'name': item['ItemName'],
+          'description': item['ItemDescription'],
+          'price': item['Price'],
+          'category': item['Name'],
+          'image_path': item['image_path'],
+      } for item in snapshot.items],
+  }
+
+
+# the restaurants delivering to the customer that are open right now
+@api.route('/restaurants')
+@customer_only
+def restaurants():
+  rows = restaurant_index.open_now(getUserPostcode())
+  return json_response('restaurants', [restaurant_payload(row) for row in rows])
+
+
+# several menus in one round-trip: ?ids=1,2,3 (at most MAX_BATCH; unknown
+# ids are left out). Menus that are not cached are loaded together, with one
+# query for all of them.
+@api.route('/menus')
+@customer_only
+def menus():
+  try:
+    ids = list(
+        dict.fromkeys(
+            int(value) for value in request.args.get('ids', '').split(',')
+            if value.strip()))
+  except ValueError:
+    abort(400, 'ids must be a comma separated list of restaurant ids')
+  if not ids:
+    abort(400, 'ids is required')
+  if len(ids) > MAX_BATCH:
+    abort(400, f'at most {MAX_BATCH} ids per request')
+  snapshots = [
+      snapshot for snapshot in menu_cache.get_many(ids)
+      if snapshot.name is not None
+  ]
+  return json_response(
+      'menus',
+      lambda: [menu_payload(snapshot) for snapshot in snapshots],
+      etag=','.join(snapshot.etag for snapshot in snapshots))
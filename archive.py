@@ -0,0 +1,238 @@
+import json
+import logging
+import os
+import random
+import re
+import threading
+import time
+from datetime import datetime, timedelta
+
+from writer import write
+
+# Complete/Canceled orders older than this move to the archive database
+AFTER_DAYS = float(os.environ.get('ARCHIVE_AFTER_DAYS', 90))
+# orders moved per write transaction, so the write lock is only held briefly
+BATCH_SIZE = int(os.environ.get('ARCHIVE_BATCH', 500))
+# pause between batches, which lets queued request writes in
+BATCH_PAUSE = float(os.environ.get('ARCHIVE_PAUSE_MS', 100)) / 1000
+# seconds between archival runs across all processes; 0 disables the
+# background job (`flask archive-orders` still works)
+INTERVAL = float(os.environ.get('ARCHIVE_INTERVAL', 3600))
+
+log = logging.getLogger(__name__)
+
+# the archive keeps the columns of the hot tables (missing ones are added
+# before each batch) and indexes for the paths that fall back to it. Its
+# own user_version records that they exist, since the file can be replaced
+# or moved independently of the main database.
+ARCHIVE_VERSION = 1
+ARCHIVE_TABLES = [
+    """CREATE TABLE IF NOT EXISTS archive.Orders (
+      OrderId INTEGER NOT NULL PRIMARY KEY,
+      CustomerId INTEGER,
+      RestaurantId INTEGER,
+      Status TEXT NOT NULL,
+      AdditionalText TEXT NOT NULL,
+      EstimatedDeliveryTime TEXT NOT NULL,
+      TotalCost REAL NOT NULL,
+      Order_Time TEXT NOT NULL
+    )""",
+    """CREATE TABLE IF NOT EXISTS archive.OrderItem (
+      OrderId,
+      ItemID INTEGER,
+      Quantity INTEGER
+    )""",
+    """CREATE TABLE IF NOT EXISTS archive.ArchiveState (
+      Id INTEGER PRIMARY KEY CHECK (Id = 1),
+      LastRun REAL NOT NULL
+    )""",
+    'CREATE INDEX IF NOT EXISTS archive.idx_orders_restaurant '
+    'ON Orders(RestaurantId, Status, Order_Time, OrderId)',
+    'CREATE INDEX IF NOT EXISTS archive.idx_orders_customer '
+    'ON Orders(CustomerId, Status, Order_Time, OrderId)',
+    'CREATE INDEX IF NOT EXISTS archive.idx_orders_restaurant_time '
+    'ON Orders(RestaurantId, Order_Time, OrderId)',
+    'CREATE INDEX IF NOT EXISTS archive.idx_orders_customer_time '
+    'ON Orders(CustomerId, Order_Time, OrderId)',
+    'CREATE INDEX IF NOT EXISTS archive.idx_orders_time ON Orders(Order_Time)',
+    'CREATE INDEX IF NOT EXISTS archive.idx_orderitem_order '
+    'ON OrderItem(OrderId, ItemID, Quantity)',
+]
+ARCHIVE_SCHEMA = ARCHIVE_TABLES + [
+    # only the archivable orders, so finding a batch never scans history
+    'CREATE INDEX IF NOT EXISTS idx_orders_archivable ON Orders(Order_Time) '
+    "WHERE Status IN ('Complete', 'Canceled')",
+]
+
+ARCHIVABLE_SQL = """SELECT OrderId FROM Orders
+  WHERE Status IN ('Complete', 'Canceled') AND Order_Time < ? LIMIT ?"""
+NEWEST_ARCHIVED_SQL = 'SELECT MAX(Order_Time) as newest FROM archive.Orders'
+
+_TABLE = re.compile(r'\b(FROM|JOIN)\s+(Orders|OrderItem)\b')
+
+
+# the same query against the archive. The tables keep their names as
+# aliases, so column references need no change.
+def archived(sql):
+  return _TABLE.sub(r'\1 archive.\2 AS \2', sql)
+
+
+# for lookups of a single order: the hot tables first, the archive only if
+# the order is not there
+def fetch_with_archive(conn, sql, params):
+  rows = conn.execute(sql, params).fetchall()
+  if rows:
+    return rows
+  return conn.execute(archived(sql), params).fetchall()
+
+
+# called by db for every new connection once the archive is attached, so a
+# missing or new archive file gets its tables before anything reads it
+def ensure_schema(conn):
+  if conn.execute('PRAGMA archive.user_version').fetchone()[0] >= (
+      ARCHIVE_VERSION):
+    return
+  for statement in ARCHIVE_TABLES:
+    conn.execute(statement)
+  conn.execute(f'PRAGMA archive.user_version = {ARCHIVE_VERSION}')
+
+
+def has_archive(conn):
+  return conn.execute(
+      "/* scan-ok */ SELECT 1 FROM archive.sqlite_master "
+      "WHERE type = 'table' AND name = 'Orders'").fetchone() is not None
+
+
+# Order_Time of the newest archived order, or None while the archive is empty
+def newest_archived(conn):
+  return conn.execute(NEWEST_ARCHIVED_SQL).fetchone()['newest']
+
+
+def _sync_columns(conn):
+  archived_columns = {
+      row['name']
+      for row in conn.execute('PRAGMA archive.table_info(Orders)')
+  }
+  columns = []
+  for row in conn.execute('PRAGMA main.table_info(Orders)'):
+    if row['name'] not in archived_columns:
+      conn.execute(
+          f'ALTER TABLE archive.Orders ADD COLUMN {row["name"]} {row["type"]}')
+    columns.append(row['name'])
+  return ', '.join(columns)
+
+
+# The two files commit separately, so a batch is copied in one transaction
+# and deleted from the hot tables in the next. If the process dies between
+# them the orders are in both for a while; the next run copies them again
+# (a no-op) and deletes them.
+def copy_batch(conn, cutoff, limit):
+  ids = [
+      row['OrderId']
+      for row in conn.execute(ARCHIVABLE_SQL, (cutoff, limit))
+  ]
+  if not ids:
+    return ids
+  batch = json.dumps(ids)
+  columns = _sync_columns(conn)
+  # the column list follows the schema, so queryplan cannot read this
+  # statement; it looks orders up by primary key
+  conn.execute(
+      f"""/* scan-ok */ INSERT OR IGNORE INTO archive.Orders ({columns})
+      SELECT {columns} FROM main.Orders
+      WHERE OrderId IN (SELECT value FROM json_each(?))""", (batch, ))
+  conn.execute(
+      'DELETE FROM archive.OrderItem '
+      'WHERE OrderId IN (SELECT value FROM json_each(?))', (batch, ))
+  conn.execute(
+      """INSERT INTO archive.OrderItem (OrderId, ItemID, Quantity)
+      SELECT OrderId, ItemID, Quantity FROM main.OrderItem
+      WHERE OrderId IN (SELECT value FROM json_each(?))""", (batch, ))
+  return ids
+
+
+def delete_batch(conn, ids):
+  batch = json.dumps(ids)
+  conn.execute(
+      'DELETE FROM main.OrderItem '
+      'WHERE OrderId IN (SELECT value FROM json_each(?))', (batch, ))
+  conn.execute(
+      'DELETE FROM main.Orders '
+      'WHERE OrderId IN (SELECT value FROM json_each(?))', (batch, ))
+
+
+# moves every archivable order, one bounded batch at a time. Returns how
+# many orders were moved.
+def archive_orders(after_days=AFTER_DAYS, batch_size=BATCH_SIZE,
+                   pause=BATCH_PAUSE, now=None):
+  cutoff = str((now or datetime.now()) - timedelta(days=after_days))
+  moved = 0
+  while True:
+    ids = write(copy_batch, cutoff, batch_size)
+    if ids:
+      write(delete_batch, ids)
+      moved += len(ids)
+    if len(ids) < batch_size:
+      return moved
+    time.sleep(pause)
+
+
+# writer job: true if this process should run now, i.e. no process has
+# started a run within the last `interval` seconds
+def claim_run(conn, interval):
+  now = time.time()
+  row = conn.execute(
+      'SELECT LastRun FROM archive.ArchiveState WHERE Id = 1').fetchone()
+  if row is not None and now - row['LastRun'] < interval:
+    return False
+  conn.execute(
+      'INSERT OR REPLACE INTO archive.ArchiveState (Id, LastRun) '
+      'VALUES (1, ?)', (now, ))
+  return True
+
+
+# runs archive_orders every `interval` seconds in a background thread of
+# each process; the claim in the archive makes sure only one of them does
+# the work per interval
+class Archiver:
+
+  def __init__(self, interval=INTERVAL):
+    self.interval = interval
+    self.runs = 0
+    self.moved = 0
+    self._thread = None
+    self._pid = None
+    self._lock = threading.Lock()
+
+  def ensure_started(self):
+    # a forked worker inherits the object but not the thread
+    if self.interval <= 0 or (self._thread is not None
+                              and self._pid == os.getpid()):
+      return
+    with self._lock:
+      if self._thread is None or self._pid != os.getpid():
+        self._pid = os.getpid()
+        self._thread = threading.Thread(target=self._run,
+                                        name='archiver',
+                                        daemon=True)
+        self._thread.start()
+
+  def _run(self):
+    while True:
+      try:
+        if write(claim_run, self.interval):
+          moved = archive_orders()
+          self.runs += 1
+          self.moved += moved
+          log.info('archived %d orders', moved)
+      except Exception:
+        log.exception('order archival failed')
+      # jittered so the workers do not all check at the same moment
+      time.sleep(self.interval * random.uniform(0.5, 1.0))
+
+
+archiver = Archiver()
+
+
+def init_app(app):
+  app.before_request(archiver.ensure_started)
@@ -0,0 +1,89 @@
+# Password verification throughput at several scrypt costs.
+#
+#   python -m benchmarks.login_throughput --threads 32 --seconds 5
+#
+# Every virtual user logs in back to back through credentials' bounded
+# process pool; attempts beyond LOGIN_MAX_IN_FLIGHT are shed, exactly as in
+# the login route. Prints one JSON document with logins/sec and p50/p99
+# latency of the accepted attempts per cost and mode.
+import argparse
+import json
+import threading
+import time
+
+import credentials
+from benchmarks.writer_stress import percentile
+
+
+def run(n, threads, seconds, inline):
+  stored = credentials._hash('correct horse', n, credentials.SCRYPT_R,
+                             credentials.SCRYPT_P)
+  workers = credentials.WORKERS
+  credentials.WORKERS = 0 if inline else workers
+  shed_before = credentials.shed
+  latencies = []
+  lock = threading.Lock()
+  deadline = time.perf_counter() + seconds
+
+  def user():
+    local = []
+    while time.perf_counter() < deadline:
+      started = time.perf_counter()
+      try:
+        credentials._run(credentials._verify,
+                         stored,
+                         'correct horse',
+                         n,
+                         credentials.SCRYPT_R,
+                         credentials.SCRYPT_P,
+                         shed_load=True)
+      except credentials.Overloaded:
+        # a rejected client backs off briefly before retrying
+        time.sleep(0.01)
+        continue
+      local.append(time.perf_counter() - started)
+    with lock:
+      latencies.extend(local)
+
+  pool = [threading.Thread(target=user) for _ in range(threads)]
+  started = time.perf_counter()
+  for thread in pool:
+    thread.start()
+  for thread in pool:
+    thread.join()
+  elapsed = time.perf_counter() - started
+  credentials.WORKERS = workers
+  return {
+      'mode': 'inline' if inline else 'pool',
+      'scrypt_n': n,
+      'threads': threads,
+      'logins': len(latencies),
+      'shed': credentials.shed - shed_before,
+      'logins_per_sec': round(len(latencies) / elapsed, 1),
+      'p50_ms': round((percentile(latencies, 50) or 0) * 1000, 2),
+      'p99_ms': round((percentile(latencies, 99) or 0) * 1000, 2),
+  }
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--threads', type=int, default=32)
+  parser.add_argument('--seconds', type=float, default=5)
+  parser.add_argument('--costs',
+                      default='4096,16384,32768',
+                      help='comma separated scrypt N values')
+  parser.add_argument('--inline',
+                      action='store_true',
+                      help='also measure hashing on the request threads')
+  args = parser.parse_args()
+
+  results = []
+  for n in [int(cost) for cost in args.costs.split(',')]:
+    results.append(run(n, args.threads, args.seconds, inline=False))
+    if args.inline:
+      results.append(run(n, args.threads, args.seconds, inline=True))
+  print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+  main()
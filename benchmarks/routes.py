@@ -0,0 +1,262 @@
+# Per-route load test with concurrent virtual users.
+#
+#   python -m benchmarks.seed --out /tmp/bench.db
+#   python -m benchmarks.routes --db /tmp/bench.db --users 32 --seconds 30
+#   python -m benchmarks.routes --url http://127.0.0.1:8080 --db /tmp/bench.db
+#
+# Customers log in, list restaurants, open a menu, fill the cart, place an
+# order and look at their orders; restaurants log in and work through their
+# dashboard. Without --url the app is driven in-process through Flask's test
+# client. Prints (and with --out writes) JSON with p50/p95/p99 latency and
+# requests/sec per route, so runs can be compared over time.
+import argparse
+import http.cookiejar
+import importlib
+import json
+import os
+import random
+import sqlite3
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from datetime import datetime
+
+import db
+from benchmarks.seed import PASSWORD
+from benchmarks.writer_stress import percentile
+
+
+class TestClientTransport:
+
+  def __init__(self, app):
+    self.client = app.test_client()
+
+  def request(self, method, path, data=None):
+    response = self.client.open(path, method=method, data=data)
+    response.close()
+    return response.status_code, response.headers.get('Location')
+
+
+class _NoRedirect(urllib.request.HTTPRedirectHandler):
+
+  def redirect_request(self, *_):
+    return None
+
+
+class HttpTransport:
+
+  def __init__(self, base_url):
+    self.base_url = base_url.rstrip('/')
+    self.opener = urllib.request.build_opener(
+        urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()),
+        _NoRedirect)
+
+  def request(self, method, path, data=None):
+    body = urllib.parse.urlencode(data).encode() if data else None
+    req = urllib.request.Request(self.base_url + path, data=body, method=method)
+    try:
+      with self.opener.open(req, timeout=30) as response:
+        response.read()
+        return response.status, None
+    except urllib.error.HTTPError as e:
+      return e.code, e.headers.get('Location')
+
+
+# who can be logged in as, and what they can order, read straight from the
+# seeded database
+class Fixtures:
+
+  def __init__(self, path):
+    conn = sqlite3.connect(path)
+    self.customers = conn.execute(
+        'SELECT AccountHolder.Email, AccountHolder.postcode FROM Customer '
+        'JOIN AccountHolder ON AccountHolder.ID = Customer.CustomerID'
+    ).fetchall()
+    self.restaurants = conn.execute(
+        'SELECT AccountHolder.Email, AccountHolder.ID FROM Restaurant '
+        'JOIN AccountHolder ON AccountHolder.ID = Restaurant.RestaurantID'
+    ).fetchall()
+    self.delivering = {}
+    for postcode, restaurant_id in conn.execute(
+        'SELECT PostCode, RestaurantID FROM PostCodes'):
+      self.delivering.setdefault(postcode, []).append(restaurant_id)
+    self.menus = {}
+    for restaurant_id, item_id in conn.execute(
+        'SELECT hasMenu.RestaurantID, contains.ItemID FROM contains '
+        'JOIN hasMenu ON hasMenu.MenuID = contains.MenuID'):
+      self.menus.setdefault(restaurant_id, []).append(item_id)
+    self.open_orders = {}
+    for restaurant_id, order_id in conn.execute(
+        "SELECT RestaurantId, OrderId FROM Orders "
+        "WHERE Status IN ('Processing', 'Preparing')"):
+      self.open_orders.setdefault(restaurant_id, []).append(order_id)
+    conn.close()
+
+
+# a redirect to the login page means the session is not logged in (or the
+# login itself failed), so the route did not do its work
+def failed(status, location):
+  if status is None or status >= 400:
+    return True
+  return location is not None and urllib.parse.urlsplit(
+      location).path.rstrip('/') == '/login'
+
+
+class Recorder:
+
+  def __init__(self):
+    self.samples = {}
+    self.errors = {}
+    self.lock = threading.Lock()
+
+  def timed(self, route, transport, method, path, data=None):
+    started = time.perf_counter()
+    try:
+      status, location = transport.request(method, path, data)
+    except Exception:
+      status, location = None, None
+    elapsed = time.perf_counter() - started
+    with self.lock:
+      self.samples.setdefault(route, []).append(elapsed)
+      if failed(status, location):
+        self.errors[route] = self.errors.get(route, 0) + 1
+    return status, location
+
+  def report(self, seconds):
+    routes = {}
+    for route, samples in sorted(self.samples.items()):
+      routes[route] = {
+          'requests': len(samples),
+          'errors': self.errors.get(route, 0),
+          'rps': round(len(samples) / seconds, 1),
+          'p50_ms': round(percentile(samples, 50) * 1000, 2),
+          'p95_ms': round(percentile(samples, 95) * 1000, 2),
+          'p99_ms': round(percentile(samples, 99) * 1000, 2),
+      }
+    return routes
+
+
+# logs in, backing off while logins are shed or fail; every attempt counts
+# as a 'login' request. False if no attempt succeeded before the deadline,
+# and the session then ends instead of timing redirects to /login.
+def login(transport, rec, rng, email, deadline):
+  delay = 0.05
+  while time.perf_counter() < deadline:
+    status, location = rec.timed('login', transport, 'POST', '/login', {
+        'email': email,
+        'password': PASSWORD
+    })
+    if status in (301, 302, 303) and not failed(status, location):
+      return True
+    time.sleep(
+        max(0, min(delay * rng.uniform(1, 2), deadline - time.perf_counter())))
+    delay = min(delay * 2, 2)
+  return False
+
+
+def customer_session(transport, rec, fixtures, rng, deadline, user):
+  email, postcode = rng.choice(fixtures.customers)
+  if not login(transport, rec, rng, email, deadline):
+    return
+  n = 0
+  while time.perf_counter() < deadline:
+    n += 1
+    rec.timed('restaurant_list', transport, 'GET', '/restaurant_list/')
+    candidates = [
+        r for r in fixtures.delivering.get(postcode, ()) if r in fixtures.menus
+    ]
+    if not candidates:
+      continue
+    restaurant_id = rng.choice(candidates)
+    rec.timed('menu', transport, 'GET', f'/menu/{restaurant_id}')
+    items = rng.sample(fixtures.menus[restaurant_id],
+                       min(3, len(fixtures.menus[restaurant_id])))
+    cart = [{'item': item, 'quantity': rng.randint(1, 3)} for item in items]
+    rec.timed('cart', transport, 'POST', '/cart', {
+        'items': json.dumps(cart),
+        'total': '0',
+        'additionalText': ''
+    })
+    rec.timed('order_customer', transport, 'POST', '/order_customer',
+              {'idempotency_key': f'bench-{user}-{n}-{time.time_ns()}'})
+    rec.timed('view_orders_customer', transport, 'GET',
+              '/view_orders/customer')
+
+
+def restaurant_session(transport, rec, fixtures, rng, deadline, _user):
+  email, restaurant_id = rng.choice(fixtures.restaurants)
+  if not login(transport, rec, rng, email, deadline):
+    return
+  while time.perf_counter() < deadline:
+    rec.timed('view_orders_restaurant', transport, 'GET',
+              '/view_orders/restaurant')
+    open_orders = fixtures.open_orders.get(restaurant_id)
+    if open_orders:
+      rec.timed('edit_order', transport, 'GET',
+                f'/order/edit/{rng.choice(open_orders)}')
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--db', required=True, help='seeded database')
+  parser.add_argument('--url', help='drive a running server instead')
+  parser.add_argument('--users', type=int, default=16)
+  parser.add_argument('--restaurant-share',
+                      type=float,
+                      default=0.2,
+                      help='fraction of users that are restaurants')
+  parser.add_argument('--seconds', type=float, default=20)
+  parser.add_argument('--seed', type=int, default=1)
+  parser.add_argument('--out', help='also write the JSON report here')
+  args = parser.parse_args()
+
+  fixtures = Fixtures(args.db)
+  if args.url:
+    make_transport = lambda: HttpTransport(args.url)  # noqa: E731
+  else:
+    # db was imported (through benchmarks.seed) before the path was known
+    os.environ['LIEFERSPATZ_DB'] = args.db
+    db.DATABASE = args.db
+    db.reset_pool()
+    # every virtual user shares one address; measure the routes, not the
+    # rate limits
+    os.environ.setdefault('ADMISSION', '0')
+    app = importlib.import_module('main').app
+    make_transport = lambda: TestClientTransport(app)  # noqa: E731
+
+  rec = Recorder()
+  deadline = time.perf_counter() + args.seconds
+  restaurants = int(args.users * args.restaurant_share)
+  threads = []
+  for user in range(args.users):
+    session = restaurant_session if user < restaurants else customer_session
+    threads.append(
+        threading.Thread(target=session,
+                         args=(make_transport(), rec, fixtures,
+                               random.Random(args.seed + user), deadline,
+                               user)))
+  started = time.perf_counter()
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  elapsed = time.perf_counter() - started
+
+  report = {
+      'started_at': datetime.now().isoformat(timespec='seconds'),
+      'target': args.url or 'test-client',
+      'users': args.users,
+      'seconds': round(elapsed, 2),
+      'routes': rec.report(elapsed),
+  }
+  output = json.dumps(report, indent=2)
+  if args.out:
+    with open(args.out, 'w') as f:
+      f.write(output + '\n')
+  print(output)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,221 @@
+# Seeded synthetic data for benchmarks.
+#
+#   python -m benchmarks.seed --out /tmp/bench.db --restaurants 500 \
+#       --customers 20000 --orders 200000
+#
+# Builds a fresh database with the current schema (tables copied from
+# --template, then every migration applied) and fills it. The same --seed
+# always produces the same data. Every account's password is 'password'.
+import argparse
+import os
+import random
+import sqlite3
+import time
+from datetime import datetime, timedelta
+
+import analytics
+import db
+import eta
+import migrations
+import prep
+from credentials import _hash
+
+PASSWORD = 'password'
+STATUSES = (('Complete', 80), ('Canceled', 8), ('Processing', 7),
+            ('Preparing', 5))
+WORDS = ('pizza', 'pasta', 'vegan', 'curry', 'burger', 'sushi', 'salad',
+         'falafel', 'ramen', 'taco', 'kebab', 'noodle', 'spicy', 'grilled',
+         'cheese', 'chicken', 'tofu', 'lamb', 'garlic', 'lemon')
+CHUNK = 5000
+
+
+def chunks(rows, size=CHUNK):
+  for start in range(0, len(rows), size):
+    yield rows[start:start + size]
+
+
+def create_schema(conn, template):
+  source = sqlite3.connect(template)
+  tables = source.execute(
+      "SELECT name, sql FROM sqlite_master WHERE type = 'table' "
+      "AND name NOT LIKE 'sqlite_%'").fetchall()
+  categories = source.execute('SELECT CategoryId, Name FROM Category').fetchall()
+  source.close()
+  # a migrated template also has the FTS tables and their shadow tables;
+  # the migrations create those again
+  virtual = [
+      name for name, sql in tables
+      if sql.upper().startswith('CREATE VIRTUAL TABLE')
+  ]
+  for name, sql in tables:
+    if not any(name == v or name.startswith(v + '_') for v in virtual):
+      conn.execute(sql)
+  conn.executemany('INSERT INTO Category (CategoryId, Name) VALUES (?, ?)',
+                   categories)
+  conn.commit()
+  migrations.upgrade(conn)
+  return [category for category, _ in categories]
+
+
+def phrase(rng, words):
+  return ' '.join(rng.choice(WORDS) for _ in range(words))
+
+
+def hours(rng):
+  opening = rng.choice(range(6, 14))
+  length = rng.choice((8, 10, 12, 14, 16))
+  closing = (opening + length) % 24  # some run past midnight
+  return f'{opening:02d}:{rng.choice((0, 30)):02d}', f'{closing:02d}:00'
+
+
+def seed(conn, args, log=print):
+  rng = random.Random(args.seed)
+  started = time.perf_counter()
+  categories = create_schema(conn, args.template)
+  stored = _hash(PASSWORD, args.scrypt_n, 8, 1)
+  postcodes = [47000 + i for i in range(args.postcode_pool)]
+
+  accounts = []
+  for i in range(args.restaurants):
+    accounts.append((f'restaurant{i}@example.com', stored,
+                     rng.choice(postcodes), f'{i} Market Street'))
+  for i in range(args.customers):
+    accounts.append((f'customer{i}@example.com', stored,
+                     rng.choice(postcodes), f'{i} Main Street'))
+  for rows in chunks(accounts):
+    conn.executemany(
+        'INSERT INTO AccountHolder (Email, Password, postcode, Address) '
+        'VALUES (?, ?, ?, ?)', rows)
+  conn.commit()
+  first_id = conn.execute(
+      "SELECT ID FROM AccountHolder WHERE Email = 'restaurant0@example.com'"
+  ).fetchone()[0] if args.restaurants else 1
+  restaurant_ids = list(range(first_id, first_id + args.restaurants))
+  customer_ids = list(
+      range(first_id + args.restaurants,
+            first_id + args.restaurants + args.customers))
+  log(f'accounts: {len(accounts)}')
+
+  restaurants, coverage, menus = [], [], []
+  for n, restaurant_id in enumerate(restaurant_ids):
+    opening, closing = hours(rng)
+    restaurants.append((restaurant_id, opening, closing, phrase(rng, 6),
+                        'default restaurant.jpg', f'{phrase(rng, 2)} {n}'))
+    for postcode in rng.sample(postcodes, min(args.coverage, len(postcodes))):
+      coverage.append((postcode, restaurant_id))
+    menus.append((restaurant_id, n + 1))
+  conn.executemany(
+      'INSERT INTO Restaurant (RestaurantID, OpeningTime, ClosingTime, '
+      'Description, Picture, RestaurantName) VALUES (?, ?, ?, ?, ?, ?)',
+      restaurants)
+  for rows in chunks(coverage):
+    conn.executemany(
+        'INSERT INTO PostCodes (PostCode, RestaurantID) VALUES (?, ?)', rows)
+  conn.executemany('INSERT INTO hasMenu (RestaurantID, MenuID) VALUES (?, ?)',
+                   menus)
+  conn.executemany(
+      'INSERT INTO Customer (CustomerID, FirstName, LastName) VALUES (?, ?, ?)',
+      [(customer_id, 'Customer', str(customer_id))
+       for customer_id in customer_ids])
+  conn.commit()
+  log(f'restaurants: {len(restaurants)}, delivery areas: {len(coverage)}')
+
+  items, contains, prices, menu_items = [], [], {}, {}
+  item_id = 0
+  for restaurant_id, menu_id in menus:
+    for _ in range(args.items):
+      item_id += 1
+      price = rng.choice(range(3, 30)) + rng.choice((0, 0.5))
+      items.append((item_id, phrase(rng, 2).title(), 'main.jpg',
+                    rng.choice(categories), price, phrase(rng, 10), 0))
+      contains.append((menu_id, item_id))
+      prices[item_id] = price
+      menu_items.setdefault(restaurant_id, []).append(item_id)
+  for rows in chunks(items):
+    conn.executemany(
+        'INSERT INTO Items (ItemID, ItemName, Picture, CategoryId, Price, '
+        'ItemDescription, isDeleted) VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+  for rows in chunks(contains):
+    conn.executemany('INSERT INTO contains (MenuID, ItemID) VALUES (?, ?)',
+                     rows)
+  conn.commit()
+  log(f'items: {len(items)}')
+
+  statuses = [status for status, weight in STATUSES for _ in range(weight)]
+  now = datetime.now()
+  orders, order_items = [], []
+  order_id = conn.execute(
+      'SELECT COALESCE(MAX(OrderId), 0) FROM Orders').fetchone()[0]
+  for _ in range(args.orders if restaurant_ids and customer_ids else 0):
+    order_id += 1
+    restaurant_id = rng.choice(restaurant_ids)
+    lines = {}
+    for _ in range(rng.randint(1, 4)):
+      item = rng.choice(menu_items[restaurant_id])
+      lines[item] = lines.get(item, 0) + rng.randint(1, 3)
+    status = rng.choice(statuses)
+    age = timedelta(minutes=rng.randint(0, 90)) if status in (
+        'Processing', 'Preparing') else timedelta(
+            minutes=rng.randint(0, args.days * 24 * 60))
+    orders.append(
+        (order_id, rng.choice(customer_ids), restaurant_id, status, '', '',
+         sum(prices[item] * quantity for item, quantity in lines.items()),
+         str(now - age)))
+    order_items.extend(
+        (order_id, item, quantity) for item, quantity in lines.items())
+    if len(orders) >= CHUNK:
+      _flush_orders(conn, orders, order_items)
+  _flush_orders(conn, orders, order_items)
+  analytics.rebuild(conn)
+  eta.rebuild(conn)
+  prep.rebuild(conn)
+  conn.commit()
+  log(f'orders: {args.orders} in {time.perf_counter() - started:.1f}s')
+
+
+def _flush_orders(conn, orders, order_items):
+  conn.executemany(
+      'INSERT INTO Orders (OrderId, CustomerId, RestaurantId, Status, '
+      'AdditionalText, EstimatedDeliveryTime, TotalCost, Order_Time) '
+      'VALUES (?, ?, ?, ?, ?, ?, ?, ?)', orders)
+  conn.executemany(
+      'INSERT INTO OrderItem (OrderId, ItemID, Quantity) VALUES (?, ?, ?)',
+      order_items)
+  orders.clear()
+  order_items.clear()
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--out', required=True)
+  parser.add_argument('--template', default=db.DATABASE)
+  parser.add_argument('--seed', type=int, default=1)
+  parser.add_argument('--restaurants', type=int, default=200)
+  parser.add_argument('--postcode-pool', type=int, default=50)
+  parser.add_argument('--coverage',
+                      type=int,
+                      default=5,
+                      help='postcodes each restaurant delivers to')
+  parser.add_argument('--items', type=int, default=30, help='per restaurant')
+  parser.add_argument('--customers', type=int, default=5000)
+  parser.add_argument('--orders', type=int, default=50000)
+  parser.add_argument('--days', type=int, default=365, help='order history')
+  parser.add_argument('--scrypt-n', type=int, default=2**14)
+  parser.add_argument('--force', action='store_true')
+  args = parser.parse_args()
+
+  if os.path.exists(args.out):
+    if not args.force:
+      parser.error(f'{args.out} exists, pass --force to replace it')
+    for suffix in ('', '-wal', '-shm'):
+      if os.path.exists(args.out + suffix):
+        os.remove(args.out + suffix)
+  conn = db.open_connection(args.out)
+  try:
+    seed(conn, args)
+  finally:
+    conn.close()
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,128 @@
+# Concurrent order submissions with and without the single-writer queue.
+#
+#   python -m benchmarks.writer_stress --threads 16 --orders 200
+#
+# Runs against a scratch copy of the database and prints one JSON document
+# with throughput, p50/p99 latency and error counts per mode.
+import argparse
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+
+import db
+import migrations
+from cart import Cart
+from orders import place_order
+from writer import WriteQueue
+
+
+def percentile(samples, pct):
+  if not samples:
+    return None
+  samples = sorted(samples)
+  return samples[min(len(samples) - 1, int(len(samples) * pct / 100))]
+
+
+def menu_of(path, restaurant_id):
+  conn = db.open_connection(path)
+  items = [
+      row['ItemID'] for row in conn.execute(
+          """SELECT contains.ItemID FROM contains
+          JOIN hasMenu ON hasMenu.MenuID = contains.MenuID
+          JOIN Items ON Items.ItemID = contains.ItemID
+          WHERE hasMenu.RestaurantID = ? AND Items.isDeleted = 0""",
+          (restaurant_id, ))
+  ]
+  conn.close()
+  return items
+
+
+def run(mode, path, threads, orders, customer_id, restaurant_id, items):
+  latencies = []
+  errors = []
+  lock = threading.Lock()
+  writer = WriteQueue(path) if mode == 'writer' else None
+
+  def worker(n):
+    conn = db.open_connection(path) if writer is None else None
+    local, failed = [], []
+    for i in range(orders):
+      cart = Cart(restaurant_id, {items[(n + i) % len(items)]: 1 + i % 3})
+      key = f'{mode}-{n}-{i}'
+      started = time.perf_counter()
+      try:
+        if writer is None:
+          with db.transaction(conn):
+            place_order(conn, customer_id, restaurant_id, cart, key)
+        else:
+          writer.submit(place_order, customer_id, restaurant_id, cart,
+                        key).result()
+      except sqlite3.Error as e:
+        failed.append(str(e))
+        continue
+      local.append(time.perf_counter() - started)
+    if conn is not None:
+      conn.close()
+    with lock:
+      latencies.extend(local)
+      errors.extend(failed)
+
+  pool = [
+      threading.Thread(target=worker, args=(n, )) for n in range(threads)
+  ]
+  started = time.perf_counter()
+  for thread in pool:
+    thread.start()
+  for thread in pool:
+    thread.join()
+  elapsed = time.perf_counter() - started
+  result = {
+      'mode': mode,
+      'threads': threads,
+      'orders': len(latencies),
+      'errors': len(errors),
+      'seconds': round(elapsed, 3),
+      'orders_per_sec': round(len(latencies) / elapsed, 1),
+      'p50_ms': round(percentile(latencies, 50) * 1000, 2),
+      'p99_ms': round(percentile(latencies, 99) * 1000, 2),
+  }
+  if writer is not None:
+    writer.stop()
+    result['batches'] = writer.batches
+    result['avg_batch'] = round(writer.jobs / max(writer.batches, 1), 1)
+  return result
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--db', default=db.DATABASE)
+  parser.add_argument('--threads', type=int, default=16)
+  parser.add_argument('--orders', type=int, default=200)
+  parser.add_argument('--customer', type=int, default=1)
+  parser.add_argument('--restaurant', type=int, default=4)
+  args = parser.parse_args()
+
+  scratch = tempfile.mkdtemp()
+  results = []
+  try:
+    for mode in ('direct', 'writer'):
+      path = os.path.join(scratch, f'{mode}.db')
+      shutil.copy(args.db, path)
+      conn = db.open_connection(path)
+      migrations.upgrade(conn)
+      conn.close()
+      items = menu_of(path, args.restaurant)
+      results.append(
+          run(mode, path, args.threads, args.orders, args.customer,
+              args.restaurant, items))
+  finally:
+    shutil.rmtree(scratch)
+  print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,60 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+# bounded LRU map whose entries also expire after `ttl` seconds
+class TTLCache:
+
+  def __init__(self, maxsize=1024, ttl=300):
+    self.maxsize = maxsize
+    self.ttl = ttl
+    self.hits = 0
+    self.misses = 0
+    self._data = OrderedDict()
+    self._lock = threading.Lock()
+
+  def get(self, key, default=None):
+    now = time.monotonic()
+    with self._lock:
+      entry = self._data.get(key)
+      if entry is None or entry[0] < now:
+        if entry is not None:
+          del self._data[key]
+        self.misses += 1
+        return default
+      self._data.move_to_end(key)
+      self.hits += 1
+      return entry[1]
+
+  def set(self, key, value):
+    with self._lock:
+      self._data[key] = (time.monotonic() + self.ttl, value)
+      self._data.move_to_end(key)
+      while len(self._data) > self.maxsize:
+        self._data.popitem(last=False)
+
+  def invalidate(self, key):
+    with self._lock:
+      self._data.pop(key, None)
+
+  def clear(self):
+    with self._lock:
+      self._data.clear()
+
+  def __len__(self):
+    return len(self._data)
+
+  @property
+  def hit_ratio(self):
+    total = self.hits + self.misses
+    return self.hits / total if total else 0.0
+
+  def stats(self):
+    return {
+        'size': len(self._data),
+        'maxsize': self.maxsize,
+        'hits': self.hits,
+        'misses': self.misses,
+        'hit_ratio': round(self.hit_ratio, 4),
+    }
@@ -0,0 +1,134 @@
+import json
+import os
+import time
+
+# abandoned carts are dropped after this many seconds without an update
+CART_TTL = int(os.environ.get('CART_TTL', 2 * 24 * 3600))
+SWEEP_INTERVAL = int(os.environ.get('CART_SWEEP_INTERVAL', 600))
+
+_last_sweep = 0
+
+
+class Cart:
+
+  def __init__(self, restaurant_id=None, items=None, additional_text=None,
+               updated_at=None, last_key=None, last_order_id=None):
+    self.restaurant_id = restaurant_id
+    self.items = items or {}  # item id -> quantity
+    self.additional_text = additional_text
+    self.updated_at = updated_at
+    # the order the cart was last checked out as, and the idempotency key it
+    # was placed with, so a refresh of the checkout finds it again
+    self.last_key = last_key
+    self.last_order_id = last_order_id
+
+  def __bool__(self):
+    return bool(self.items)
+
+
+# the client posts [{"item": <id>, "quantity": <n>, ...}, ...]; only ids and
+# quantities are kept, everything else is recomputed on the server. Raises
+# ValueError if the payload is not a JSON list.
+def parse_items(raw):
+  entries = json.loads(raw or '[]')
+  if not isinstance(entries, list):
+    raise ValueError('cart items must be a list')
+  items = {}
+  for entry in entries:
+    try:
+      item_id = int(entry['item'])
+      quantity = int(entry['quantity'])
+    except (KeyError, TypeError, ValueError, OverflowError):
+      continue
+    if quantity > 0:
+      items[item_id] = items.get(item_id, 0) + quantity
+  return items
+
+
+def load_cart(conn, customer_id):
+  row = conn.execute(
+      'SELECT RestaurantId, Items, AdditionalText, UpdatedAt, LastKey, '
+      'LastOrderId FROM Cart WHERE CustomerId = ?',
+      (int(customer_id), )).fetchone()
+  if row is None or row['UpdatedAt'] < time.time() - CART_TTL:
+    return Cart()
+  items = {int(k): v for k, v in json.loads(row['Items']).items()}
+  return Cart(row['RestaurantId'], items, row['AdditionalText'],
+              row['UpdatedAt'], row['LastKey'], row['LastOrderId'])
+
+
+def save_cart(conn, customer_id, cart):
+  conn.execute(
+      """INSERT INTO Cart (CustomerId, RestaurantId, Items, AdditionalText, UpdatedAt)
+      VALUES (?, ?, ?, ?, ?)
+      ON CONFLICT(CustomerId) DO UPDATE SET RestaurantId = excluded.RestaurantId,
+        Items = excluded.Items, AdditionalText = excluded.AdditionalText,
+        UpdatedAt = excluded.UpdatedAt""",
+      (int(customer_id), cart.restaurant_id,
+       json.dumps(cart.items, separators=(',', ':')), cart.additional_text,
+       time.time()))
+
+
+def clear_cart(conn, customer_id):
+  conn.execute('DELETE FROM Cart WHERE CustomerId = ?', (int(customer_id), ))
+
+
+# empties the cart once it has been ordered, remembering the order
+def check_out_cart(conn, customer_id, idempotency_key, order_id):
+  conn.execute(
+      """INSERT INTO Cart (CustomerId, RestaurantId, Items, AdditionalText,
+        UpdatedAt, LastKey, LastOrderId)
+      VALUES (?, NULL, '{}', NULL, ?, ?, ?)
+      ON CONFLICT(CustomerId) DO UPDATE SET RestaurantId = NULL, Items = '{}',
+        AdditionalText = NULL, UpdatedAt = excluded.UpdatedAt,
+        LastKey = excluded.LastKey, LastOrderId = excluded.LastOrderId""",
+      (int(customer_id), time.time(), idempotency_key, int(order_id)))
+
+
+# reprices the whole cart with one lookup; items that no longer exist or were
+# deleted are dropped, and with restaurant_id so is anything that is not on
+# that restaurant's menu. Returns (lines, total)
+def price_cart(conn, cart, restaurant_id=None):
+  if not cart.items:
+    return [], 0
+  ids = json.dumps(list(cart.items))
+  if restaurant_id is None:
+    rows = conn.execute(
+        'SELECT ItemID, ItemName, Price FROM Items '
+        'WHERE ItemID IN (SELECT value FROM json_each(?)) AND isDeleted = 0',
+        (ids, )).fetchall()
+  else:
+    rows = conn.execute(
+        """SELECT Items.ItemID, Items.ItemName, Items.Price FROM Items
+        JOIN contains ON contains.ItemID = Items.ItemID
+        JOIN hasMenu ON hasMenu.MenuID = contains.MenuID
+        WHERE hasMenu.RestaurantID = ?
+          AND Items.ItemID IN (SELECT value FROM json_each(?))
+          AND Items.isDeleted = 0""", (int(restaurant_id), ids)).fetchall()
+  lines = []
+  total = 0
+  for row in rows:
+    quantity = cart.items[row['ItemID']]
+    lines.append({
+        'item': row['ItemID'],
+        'name': row['ItemName'],
+        'price': row['Price'],
+        'quantity': quantity,
+    })
+    total += row['Price'] * quantity
+  return lines, total
+
+
+# true at most once per SWEEP_INTERVAL per process
+def sweep_due():
+  global _last_sweep
+  now = time.time()
+  if now - _last_sweep < SWEEP_INTERVAL:
+    return False
+  _last_sweep = now
+  return True
+
+
+def expire_carts(conn):
+  return conn.execute('DELETE FROM Cart WHERE UpdatedAt < ?',
+                      (time.time() - CART_TTL, )).rowcount
@@ -0,0 +1,154 @@
+import base64
+import hashlib
+import hmac
+import multiprocessing
+import os
+import secrets
+import signal
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+# scrypt cost; raise N as hardware allows, old hashes are upgraded on login
+SCRYPT_N = int(os.environ.get('PASSWORD_SCRYPT_N', 2**14))
+SCRYPT_R = int(os.environ.get('PASSWORD_SCRYPT_R', 8))
+SCRYPT_P = int(os.environ.get('PASSWORD_SCRYPT_P', 1))
+# 0 hashes in the calling thread instead of the process pool
+WORKERS = int(os.environ.get('PASSWORD_WORKERS', os.cpu_count() or 1))
+# password checks allowed in flight at once; further logins are shed
+MAX_IN_FLIGHT = int(os.environ.get('LOGIN_MAX_IN_FLIGHT', max(WORKERS, 1) * 4))
+
+PREFIX = 'scrypt'
+
+
+class Overloaded(Exception):
+  pass
+
+
+def _b64(raw):
+  return base64.b64encode(raw).decode('ascii')
+
+
+def _kdf(password, salt, n, r, p):
+  return hashlib.scrypt(password.encode('utf-8'),
+                        salt=salt,
+                        n=n,
+                        r=r,
+                        p=p,
+                        maxmem=256 * n * r + 1024 * 1024,
+                        dklen=32)
+
+
+def _hash(password, n, r, p):
+  salt = secrets.token_bytes(16)
+  digest = _kdf(password, salt, n, r, p)
+  return f'{PREFIX}${n}${r}${p}${_b64(salt)}${_b64(digest)}'
+
+
+# returns (matches, needs_rehash). Rows written before passwords were hashed
+# hold the plain password; they match by constant-time comparison and are
+# flagged for rehashing, as are hashes made with an outdated cost.
+def _verify(stored, password, n, r, p):
+  if not stored.startswith(PREFIX + '$'):
+    return hmac.compare_digest(stored.encode('utf-8'),
+                               password.encode('utf-8')), True
+  _, sn, sr, sp, salt, digest = stored.split('$')
+  sn, sr, sp = int(sn), int(sr), int(sp)
+  candidate = _kdf(password, base64.b64decode(salt), sn, sr, sp)
+  matches = hmac.compare_digest(candidate, base64.b64decode(digest))
+  return matches, (sn, sr, sp) != (n, r, p)
+
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+_in_flight = threading.BoundedSemaphore(MAX_IN_FLIGHT)
+_dummy_hash = None
+shed = 0
+
+
+# pool processes are stopped by their parent, not by the signals sent to
+# the whole process group
+def _init_pool_process():
+  signal.signal(signal.SIGTERM, signal.SIG_DFL)
+  signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def _get_pool():
+  global _pool, _pool_pid
+  if _pool is None or _pool_pid != os.getpid():
+    with _pool_lock:
+      if _pool is None or _pool_pid != os.getpid():
+        # the pool is created on the first login, in a worker that already
+        # runs threads (writer, request pool), which must not be forked
+        _pool = ProcessPoolExecutor(
+            max_workers=WORKERS,
+            mp_context=multiprocessing.get_context('forkserver'),
+            initializer=_init_pool_process)
+        _pool_pid = os.getpid()
+  return _pool
+
+
+# stops this process's pool, for exits that skip the interpreter's own
+# cleanup (os._exit)
+def shutdown():
+  global _pool
+  with _pool_lock:
+    pool, _pool = _pool, None
+  if pool is not None and _pool_pid == os.getpid():
+    pool.shutdown(cancel_futures=True)
+
+
+# runs the KDF off the request thread so the GIL stays free for other
+# requests; with shed=True a full pipeline raises Overloaded at once
+def _run(fn, *args, shed_load=False):
+  global shed
+  if not _in_flight.acquire(blocking=not shed_load):
+    shed += 1
+    raise Overloaded()
+  try:
+    if WORKERS <= 0:
+      return fn(*args)
+    return _get_pool().submit(fn, *args).result()
+  finally:
+    _in_flight.release()
+
+
+def hash_password(password):
+  return _run(_hash, password, SCRYPT_N, SCRYPT_R, SCRYPT_P)
+
+
+# many at once for bulk imports, spread over the whole pool
+def hash_passwords(passwords):
+  passwords = list(passwords)
+  if WORKERS <= 0:
+    return [_hash(p, SCRYPT_N, SCRYPT_R, SCRYPT_P) for p in passwords]
+  count = len(passwords)
+  return list(_get_pool().map(_hash,
+                              passwords, [SCRYPT_N] * count,
+                              [SCRYPT_R] * count, [SCRYPT_P] * count,
+                              chunksize=max(1, count // (WORKERS * 4))))
+
+
+# a hash of a random password with the current cost, for checking passwords
+# of unknown accounts as slowly as those of real ones
+def _dummy():
+  global _dummy_hash
+  if _dummy_hash is None:
+    _dummy_hash = hash_password(secrets.token_urlsafe(16))
+  return _dummy_hash
+
+
+# stored=None (no such account) takes as long as a wrong password and never
+# matches
+def verify_password(stored, password):
+  if stored is None:
+    _run(_verify, _dummy(), password, SCRYPT_N, SCRYPT_R, SCRYPT_P,
+         shed_load=True)
+    return False, False
+  return _run(_verify,
+              stored,
+              password,
+              SCRYPT_N,
+              SCRYPT_R,
+              SCRYPT_P,
+              shed_load=True)
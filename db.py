@@ -0,0 +1,217 @@
+import os
+import queue
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import g, has_app_context
+
+import metrics
+
+DATABASE = os.environ.get('LIEFERSPATZ_DB', './lieferspatz.db')
+POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 8))
+POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', 10))
+BUSY_TIMEOUT_MS = int(os.environ.get('DB_BUSY_TIMEOUT_MS', 5000))
+# old completed orders live in a second file, attached to every connection
+# as `archive` (see archive.py); by default next to the main database
+ARCHIVE_DATABASE = os.environ.get('LIEFERSPATZ_ARCHIVE_DB')
+
+# applied once when a connection is opened, not on every checkout
+PRAGMAS = (
+    'PRAGMA journal_mode = WAL',
+    'PRAGMA synchronous = NORMAL',
+    f'PRAGMA busy_timeout = {BUSY_TIMEOUT_MS}',
+    'PRAGMA mmap_size = 268435456',
+    'PRAGMA cache_size = -16000',
+)
+ARCHIVE_PRAGMAS = (
+    'PRAGMA archive.journal_mode = WAL',
+    'PRAGMA archive.synchronous = NORMAL',
+)
+
+
+class PoolExhausted(Exception):
+  pass
+
+
+# times and counts every statement for the per-request metrics and the slow
+# query log. Only the execute step is timed; rows fetched afterwards are not.
+class InstrumentedConnection(sqlite3.Connection):
+
+  def execute(self, sql, parameters=()):
+    started = time.perf_counter()
+    try:
+      return super().execute(sql, parameters)
+    finally:
+      metrics.record_query(sql, parameters, time.perf_counter() - started)
+
+  def executemany(self, sql, seq_of_parameters):
+    if not hasattr(seq_of_parameters, '__len__'):
+      seq_of_parameters = list(seq_of_parameters)
+    started = time.perf_counter()
+    try:
+      return super().executemany(sql, seq_of_parameters)
+    finally:
+      metrics.record_query(sql,
+                           seq_of_parameters,
+                           time.perf_counter() - started,
+                           many=True)
+
+
+# connection handed out for the duration of a request. Routes still call
+# conn.close() when they are done, which must not close the shared handle;
+# the teardown hook hands it back to the pool instead.
+class PooledConnection(InstrumentedConnection):
+
+  def close(self):
+    pass
+
+  def _close(self):
+    sqlite3.Connection.close(self)
+
+
+def archive_path(path):
+  if ARCHIVE_DATABASE:
+    return ARCHIVE_DATABASE
+  if path == ':memory:':
+    return path
+  return os.path.splitext(path)[0] + '-archive.db'
+
+
+def _configure(conn, path):
+  conn.row_factory = sqlite3.Row
+  for pragma in PRAGMAS:
+    conn.execute(pragma)
+  conn.execute('ATTACH DATABASE ? AS archive', (archive_path(path), ))
+  for pragma in ARCHIVE_PRAGMAS:
+    conn.execute(pragma)
+  # imported here: archive imports writer, which imports this module
+  import archive
+  archive.ensure_schema(conn)
+  return conn
+
+
+def open_connection(path=None, factory=InstrumentedConnection):
+  path = path or DATABASE
+  conn = sqlite3.connect(path,
+                         timeout=BUSY_TIMEOUT_MS / 1000,
+                         check_same_thread=False,
+                         factory=factory)
+  metrics.connections_opened_total.inc()
+  return _configure(conn, path)
+
+
+class ConnectionPool:
+
+  def __init__(self, path, size):
+    self.path = path
+    self.size = size
+    self._idle = queue.LifoQueue()
+    self._slots = threading.BoundedSemaphore(size)
+    self.opened = 0
+
+  def acquire(self, timeout=POOL_TIMEOUT):
+    if not self._slots.acquire(timeout=timeout):
+      raise PoolExhausted(f'no connection available after {timeout}s')
+    try:
+      return self._idle.get_nowait()
+    except queue.Empty:
+      pass
+    try:
+      conn = open_connection(self.path, factory=PooledConnection)
+    except Exception:
+      self._slots.release()
+      raise
+    self.opened += 1
+    return conn
+
+  def release(self, conn):
+    try:
+      if conn.in_transaction:
+        conn.rollback()
+    except sqlite3.Error:
+      # a broken handle is dropped; its slot is freed below
+      conn._close()
+    else:
+      self._idle.put(conn)
+    self._slots.release()
+
+  def close_all(self):
+    while True:
+      try:
+        self._idle.get_nowait()._close()
+      except queue.Empty:
+        return
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+  global _pool
+  if _pool is None:
+    with _pool_lock:
+      if _pool is None:
+        _pool = ConnectionPool(DATABASE, POOL_SIZE)
+  return _pool
+
+
+def reset_pool():
+  # drops every idle handle, e.g. in a freshly forked worker
+  global _pool
+  with _pool_lock:
+    if _pool is not None:
+      _pool.close_all()
+    _pool = None
+
+
+def get_db():
+  if 'db' not in g:
+    g.db = get_pool().acquire()
+  return g.db
+
+
+def close_db(*_):
+  conn = g.pop('db', None)
+  if conn is not None:
+    get_pool().release(conn)
+
+
+def connect_db():
+  # inside a request every caller shares one pooled connection; scripts and
+  # background jobs outside an app context get a private one they must close
+  if has_app_context():
+    return get_db()
+  return open_connection()
+
+
+# BEGIN IMMEDIATE takes the write lock up front, so a read-then-write body
+# cannot be invalidated by a concurrent writer halfway through
+@contextmanager
+def transaction(conn):
+  conn.execute('BEGIN IMMEDIATE')
+  try:
+    yield conn
+  except BaseException:
+    conn.rollback()
+    raise
+  conn.commit()
+
+
+# the next `count` ids of an AUTOINCREMENT table, so a batch can be inserted
+# with executemany and explicit ids instead of reading lastrowid row by row.
+# Only valid inside a write transaction, which keeps other writers out.
+# `column` must be the table's primary key, so MAX() is one index lookup.
+def reserve_ids(conn, table, column, count):
+  last_id = conn.execute(
+      f"""/* scan-ok */ SELECT MAX(
+        (SELECT COALESCE(MAX({column}), 0) FROM {table}),
+        COALESCE((SELECT seq FROM sqlite_sequence WHERE name = ?), 0))""",
+      (table, )).fetchone()[0]
+  return range(last_id + 1, last_id + 1 + count)
+
+
+def init_app(app):
+  app.teardown_appcontext(close_db)
@@ -0,0 +1,115 @@
+import os
+import threading
+import time
+from datetime import datetime
+
+from utils import connect_db
+
+# safety net for changes made by other processes; local writes update the
+# index directly
+MAX_AGE = float(os.environ.get('DISCOVERY_MAX_AGE', 60))
+
+
+def parse_minutes(value):
+  try:
+    hours, minutes = str(value).split(':')[:2]
+    return int(hours) * 60 + int(minutes)
+  except ValueError:
+    return None
+
+
+# opening hours are inclusive like the old BETWEEN; an interval whose close
+# is before its open runs past midnight (e.g. 09:00 - 01:00)
+def is_open(opening, closing, minute):
+  if opening is None or closing is None:
+    return False
+  if opening <= closing:
+    return opening <= minute <= closing
+  return minute >= opening or minute <= closing
+
+
+# postcode -> restaurants delivering there, with their opening intervals,
+# so "open now in postcode X" never touches SQLite
+class RestaurantIndex:
+
+  def __init__(self, max_age=MAX_AGE):
+    self.max_age = max_age
+    self._lock = threading.Lock()
+    self._restaurants = None
+    self._by_postcode = {}
+    self._loaded_at = 0
+
+  def load(self, conn=None):
+    own = conn is None
+    conn = conn or connect_db()
+    restaurants = {}
+    for row in conn.execute('SELECT * FROM Restaurant /* scan-ok */'):
+      restaurants[row['RestaurantID']] = self._entry(dict(row))
+    by_postcode = {}
+    for row in conn.execute(
+        'SELECT PostCode, RestaurantID FROM PostCodes /* scan-ok */'):
+      if row['RestaurantID'] in restaurants:
+        by_postcode.setdefault(int(row['PostCode']),
+                               []).append(row['RestaurantID'])
+    if own:
+      conn.close()
+    with self._lock:
+      self._restaurants = restaurants
+      self._by_postcode = {
+          postcode: tuple(ids)
+          for postcode, ids in by_postcode.items()
+      }
+      self._loaded_at = time.monotonic()
+
+  def _entry(self, restaurant):
+    return (parse_minutes(restaurant['OpeningTime']),
+            parse_minutes(restaurant['ClosingTime']), restaurant)
+
+  def _ensure_loaded(self):
+    if (self._restaurants is None
+        or time.monotonic() - self._loaded_at > self.max_age):
+      self.load()
+
+  def open_now(self, postcode, now=None):
+    self._ensure_loaded()
+    now = now or datetime.now()
+    minute = now.hour * 60 + now.minute
+    restaurants = self._restaurants
+    result = []
+    for restaurant_id in self._by_postcode.get(int(postcode), ()):
+      entry = restaurants.get(restaurant_id)
+      if entry and is_open(entry[0], entry[1], minute):
+        result.append(entry[2])
+    return result
+
+  # incremental update after a restaurant row and/or its postcodes changed;
+  # postcodes=None keeps the delivery area as it is
+  def update_restaurant(self, restaurant, postcodes=None):
+    if self._restaurants is None:
+      return
+    restaurant_id = restaurant['RestaurantID']
+    with self._lock:
+      restaurants = dict(self._restaurants)
+      restaurants[restaurant_id] = self._entry(dict(restaurant))
+      by_postcode = self._by_postcode
+      if postcodes is not None:
+        by_postcode = self._without(by_postcode, restaurant_id)
+        for postcode in postcodes:
+          postcode = int(postcode)
+          by_postcode[postcode] = by_postcode.get(postcode,
+                                                  ()) + (restaurant_id, )
+      self._restaurants = restaurants
+      self._by_postcode = by_postcode
+
+  @staticmethod
+  def _without(by_postcode, restaurant_id):
+    result = {}
+    for postcode, ids in by_postcode.items():
+      if restaurant_id in ids:
+        ids = tuple(i for i in ids if i != restaurant_id)
+      if ids:
+        result[postcode] = ids
+    return result
+
+
+restaurant_index = RestaurantIndex()
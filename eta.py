@@ -0,0 +1,142 @@
+import os
+from datetime import datetime, timedelta
+
+# used until a restaurant has completed an order we timed
+DEFAULT_PREP_MINUTES = float(os.environ.get('ETA_DEFAULT_PREP_MINUTES', 20))
+DELIVERY_MINUTES = float(os.environ.get('ETA_DELIVERY_MINUTES', 15))
+# orders a kitchen prepares at once; every waiting order ahead adds
+# prep / KITCHEN_SLOTS to the wait
+KITCHEN_SLOTS = max(int(os.environ.get('ETA_KITCHEN_SLOTS', 2)), 1)
+# weight of the newest preparation time in the moving average
+ALPHA = float(os.environ.get('ETA_ALPHA', 0.2))
+# outside this range a "preparation" is a restaurant clicking through the
+# statuses or an order someone forgot to complete, not a sample
+MIN_SAMPLE_MINUTES = 1
+MAX_SAMPLE_MINUTES = 240
+HISTORY_DAYS = 7
+
+ACTIVE = ('Processing', 'Preparing')
+
+# per restaurant: how many orders are open and a moving average of how long
+# the kitchen takes from starting an order to completing it (NULL until an
+# order was timed). Updated inside the order write transactions, so every
+# worker process sees the same numbers.
+KITCHEN_STATS_TABLE = """CREATE TABLE IF NOT EXISTS KitchenStats (
+  RestaurantId INTEGER NOT NULL PRIMARY KEY,
+  QueueDepth INTEGER NOT NULL DEFAULT 0,
+  PrepMinutes REAL
+)"""
+
+KITCHEN_STATS_SQL = """SELECT QueueDepth, PrepMinutes FROM KitchenStats
+  WHERE RestaurantId = ?"""
+# walks the partial index idx_orders_active, which holds the open orders
+# and nothing else
+QUEUE_DEPTH_SQL = """/* scan-ok */ SELECT RestaurantId, COUNT(*) as depth
+  FROM Orders WHERE Status IN ('Processing', 'Preparing') GROUP BY RestaurantId"""
+PREP_HISTORY_SQL = """SELECT RestaurantId,
+    COALESCE(PreparingAt, Order_Time) as started, CompletedAt
+  FROM Orders WHERE CompletedAt >= ? ORDER BY CompletedAt"""
+
+
+def parse_time(value):
+  try:
+    return datetime.fromisoformat(str(value))
+  except ValueError:
+    return None
+
+
+def format_eta(eta):
+  return str(eta.replace(microsecond=0)) if eta else ''
+
+
+def _sample_minutes(started, completed):
+  if started is None or completed is None:
+    return None
+  minutes = (completed - started).total_seconds() / 60
+  if not MIN_SAMPLE_MINUTES <= minutes <= MAX_SAMPLE_MINUTES:
+    return None
+  return minutes
+
+
+def _average(average, minutes):
+  if average is None:
+    return minutes
+  return average + ALPHA * (minutes - average)
+
+
+# recomputes KitchenStats from the open orders and the last HISTORY_DAYS of
+# timed completions; the backfill for existing data and the repair tool if
+# it ever drifts
+def rebuild(conn, now=None):
+  since = (now or datetime.now()) - timedelta(days=HISTORY_DAYS)
+  stats = {
+      row['RestaurantId']: [row['depth'], None]
+      for row in conn.execute(QUEUE_DEPTH_SQL)
+  }
+  for row in conn.execute(PREP_HISTORY_SQL, (str(since), )):
+    minutes = _sample_minutes(parse_time(row['started']),
+                              parse_time(row['CompletedAt']))
+    if minutes is not None:
+      entry = stats.setdefault(row['RestaurantId'], [0, None])
+      entry[1] = _average(entry[1], minutes)
+  conn.execute('/* scan-ok */ DELETE FROM KitchenStats')
+  conn.executemany(
+      'INSERT INTO KitchenStats (RestaurantId, QueueDepth, PrepMinutes) '
+      'VALUES (?, ?, ?)',
+      [(restaurant_id, depth, prep)
+       for restaurant_id, (depth, prep) in stats.items()])
+
+
+def _estimate(prep, status, now, ahead=0):
+  if prep is None:
+    prep = DEFAULT_PREP_MINUTES
+  if status == 'Processing':
+    minutes = ahead * prep / KITCHEN_SLOTS + prep + DELIVERY_MINUTES
+  elif status == 'Preparing':
+    minutes = prep + DELIVERY_MINUTES
+  elif status == 'Complete':
+    minutes = DELIVERY_MINUTES
+  else:
+    return None
+  return now + timedelta(minutes=minutes)
+
+
+# the queue depth and moving average behind the estimates, kept in
+# KitchenStats. Both hooks run inside the order's write transaction and
+# return the estimate to store with it.
+class DeliveryEstimator:
+
+  def stats(self, conn, restaurant_id):
+    row = conn.execute(KITCHEN_STATS_SQL, (int(restaurant_id), )).fetchone()
+    return (row['QueueDepth'], row['PrepMinutes']) if row else (0, None)
+
+  def _store(self, conn, restaurant_id, depth, prep):
+    conn.execute(
+        """INSERT INTO KitchenStats (RestaurantId, QueueDepth, PrepMinutes)
+        VALUES (?, ?, ?)
+        ON CONFLICT(RestaurantId) DO UPDATE SET
+          QueueDepth = excluded.QueueDepth,
+          PrepMinutes = excluded.PrepMinutes""",
+        (int(restaurant_id), depth, prep))
+
+  def order_placed(self, conn, restaurant_id, now):
+    ahead, prep = self.stats(conn, restaurant_id)
+    self._store(conn, restaurant_id, ahead + 1, prep)
+    return _estimate(prep, 'Processing', now, ahead)
+
+  # `started` is when the kitchen began the order, for timing a completion
+  def status_changed(self, conn, restaurant_id, old_status, new_status,
+                     started, now):
+    restaurant_id = int(restaurant_id)
+    depth, prep = self.stats(conn, restaurant_id)
+    depth = max(depth + (new_status in ACTIVE) - (old_status in ACTIVE), 0)
+    if new_status == 'Complete' and old_status in ACTIVE:
+      minutes = _sample_minutes(started, now)
+      if minutes is not None:
+        prep = _average(prep, minutes)
+    self._store(conn, restaurant_id, depth, prep)
+    ahead = max(depth - 1, 0) if new_status == 'Processing' else 0
+    return _estimate(prep, new_status, now, ahead)
+
+
+delivery_estimator = DeliveryEstimator()
@@ -0,0 +1,239 @@
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+
+import db
+from writer import write
+
+HISTORY = int(os.environ.get('EVENT_HISTORY', 256))
+HEARTBEAT = float(os.environ.get('EVENT_HEARTBEAT', 15))
+# how often each process reads the events published by the others
+POLL = float(os.environ.get('EVENT_POLL_MS', 500)) / 1000
+# events are kept this long for clients that reconnect with Last-Event-ID
+RETENTION = float(os.environ.get('EVENT_RETENTION', 3600))
+# live streams per process (0 = no limit). Each one holds a request thread
+# for as long as the dashboard is open; clients beyond the limit are sent
+# what is new and reconnect after POLL_RETRY_MS, i.e. they poll.
+MAX_STREAMS = int(os.environ.get('EVENT_MAX_STREAMS', 0))
+# a live stream ends after this long so its thread is given back; the
+# client reconnects with Last-Event-ID and misses nothing
+STREAM_SECONDS = float(os.environ.get('EVENT_STREAM_SECONDS', 300))
+RETRY_MS = 3000
+POLL_RETRY_MS = int(os.environ.get('EVENT_POLL_RETRY_MS', 5000))
+
+log = logging.getLogger(__name__)
+
+# every published event, shared by all worker processes. Ids are time
+# based, so they keep increasing across restarts and a stale id never hides
+# new events.
+EVENTS_TABLE = """CREATE TABLE IF NOT EXISTS Events (
+  Id INTEGER PRIMARY KEY,
+  Topic TEXT NOT NULL,
+  Event TEXT NOT NULL,
+  Data TEXT NOT NULL
+)"""
+EVENTS_INDEX = ('CREATE INDEX IF NOT EXISTS idx_events_topic '
+                'ON Events(Topic, Id)')
+
+NEW_EVENTS_SQL = """SELECT Id, Topic, Event, Data FROM Events
+  WHERE Id > ? ORDER BY Id LIMIT ?"""
+TOPIC_EVENTS_SQL = """SELECT Id, Event, Data FROM Events
+  WHERE Topic = ? AND Id > ? ORDER BY Id LIMIT ?"""
+OLDEST_EVENT_SQL = 'SELECT MIN(Id) AS oldest FROM Events'
+NEWEST_EVENT_SQL = 'SELECT MAX(Id) AS newest FROM Events'
+
+
+# writer job: appends (topic, event, data) rows and drops the expired ones.
+# The write lock orders the ids across processes.
+def record_events(conn, events):
+  now = time.time_ns() // 1000
+  newest = conn.execute(NEWEST_EVENT_SQL).fetchone()['newest'] or 0
+  first = max(newest + 1, now)
+  conn.executemany(
+      'INSERT INTO Events (Id, Topic, Event, Data) VALUES (?, ?, ?, ?)',
+      [(first + i, topic, event, data)
+       for i, (topic, event, data) in enumerate(events)])
+  conn.execute('DELETE FROM Events WHERE Id < ?',
+               (now - int(RETENTION * 1000000), ))
+
+
+class _Topic:
+
+  def __init__(self, history):
+    self.events = deque(maxlen=history)
+    self.changed = threading.Condition()
+
+
+# pub/sub for dashboard updates across worker processes. Events are written
+# to the Events table; a thread in every process reads the new ones and
+# wakes that process's streams. Every topic keeps its last `history` events
+# in memory for the live streams, and a reconnecting client is replayed
+# what it missed since its Last-Event-ID from the table.
+class Broker:
+
+  def __init__(self, history=HISTORY, max_streams=MAX_STREAMS):
+    self.history = history
+    self.max_streams = max_streams
+    self.streams = 0
+    self._topics = {}
+    self._lock = threading.Lock()
+    self._wake = threading.Event()
+    self._thread = None
+    self._pid = None
+
+  def _topic(self, name):
+    topic = self._topics.get(name)
+    if topic is None:
+      with self._lock:
+        topic = self._topics.setdefault(name, _Topic(self.history))
+    return topic
+
+  def _ensure_started(self):
+    # a forked worker inherits the object but not the thread
+    if self._thread is not None and self._pid == os.getpid():
+      return
+    with self._lock:
+      if self._thread is None or self._pid != os.getpid():
+        # read the position here, so events published right after this
+        # call are not skipped
+        conn = db.open_connection()
+        cursor = conn.execute(NEWEST_EVENT_SQL).fetchone()['newest'] or 0
+        self._pid = os.getpid()
+        self._thread = threading.Thread(target=self._run,
+                                        args=(conn, cursor),
+                                        name='event-poller',
+                                        daemon=True)
+        self._thread.start()
+
+  def _run(self, conn, cursor):
+    while True:
+      self._wake.wait(POLL)
+      self._wake.clear()
+      try:
+        rows = conn.execute(NEW_EVENTS_SQL, (cursor, self.history)).fetchall()
+      except Exception:
+        log.exception('reading events failed')
+        continue
+      for row in rows:
+        self._deliver(row['Topic'], row['Id'], row['Event'],
+                      json.loads(row['Data']))
+        cursor = row['Id']
+      if len(rows) == self.history:
+        self._wake.set()
+
+  def _deliver(self, name, event_id, event, data):
+    topic = self._topic(name)
+    with topic.changed:
+      topic.events.append((event_id, event, data))
+      topic.changed.notify_all()
+
+  def publish(self, name, event, data):
+    self.publish_many([(name, event, data)])
+
+  # several events in one write, e.g. for both parties of an order. Events
+  # are best effort: a failure is logged, not raised into the request.
+  def publish_many(self, events):
+    self._ensure_started()
+    try:
+      write(record_events,
+            [(name, event, json.dumps(data)) for name, event, data in events])
+    except Exception:
+      log.exception('publishing events failed')
+      return
+    self._wake.set()
+
+  # events after last_id; a 'reset' event tells the client that some were
+  # already dropped from the history and it should reload instead
+  def since(self, name, last_id):
+    topic = self._topic(name)
+    with topic.changed:
+      return self._since(topic, last_id)
+
+  def _since(self, topic, last_id):
+    events = [e for e in topic.events if e[0] > last_id]
+    if (last_id and events and len(topic.events) == topic.events.maxlen
+        and topic.events[0][0] > last_id):
+      # the events right after last_id may already have been evicted
+      events.insert(0, (last_id, 'reset', {}))
+    return events
+
+  # what a client missed since last_id, whichever process it was connected
+  # to before
+  def replay(self, name, last_id):
+    conn = db.open_connection()
+    try:
+      rows = conn.execute(TOPIC_EVENTS_SQL,
+                          (name, last_id, self.history)).fetchall()
+      oldest = conn.execute(OLDEST_EVENT_SQL).fetchone()['oldest']
+    finally:
+      conn.close()
+    events = [(row['Id'], row['Event'], json.loads(row['Data']))
+              for row in rows]
+    if oldest is not None and (oldest > last_id
+                               or len(events) == self.history):
+      events.insert(0, (last_id, 'reset', {}))
+    return events
+
+  def wait(self, name, last_id, timeout=HEARTBEAT):
+    topic = self._topic(name)
+    with topic.changed:
+      events = self._since(topic, last_id)
+      if not events:
+        topic.changed.wait(timeout)
+        events = self._since(topic, last_id)
+      return events
+
+  def _open_stream(self):
+    with self._lock:
+      if self.max_streams and self.streams >= self.max_streams:
+        return False
+      self.streams += 1
+      return True
+
+  def _close_stream(self):
+    with self._lock:
+      self.streams -= 1
+
+  def stream(self, name, last_id=0):
+    self._ensure_started()
+    live = self._open_stream()
+    try:
+      yield f'retry: {RETRY_MS if live else POLL_RETRY_MS}\n\n'
+      events = self.replay(name, last_id) if last_id else self.since(
+          name, last_id)
+      deadline = time.monotonic() + STREAM_SECONDS
+      while True:
+        for event_id, event, data in events:
+          last_id = max(last_id, event_id)
+          yield (f'id: {event_id}\nevent: {event}\n'
+                 f'data: {json.dumps(data)}\n\n')
+        remaining = deadline - time.monotonic()
+        if not live or remaining <= 0:
+          return
+        events = self.wait(name, last_id, min(HEARTBEAT, remaining))
+        if not events:
+          yield ': keepalive\n\n'
+    finally:
+      if live:
+        self._close_stream()
+
+
+broker = Broker()
+
+
+def restaurant_topic(restaurant_id):
+  return f'restaurant:{int(restaurant_id)}'
+
+
+def customer_topic(customer_id):
+  return f'customer:{int(customer_id)}'
+
+
+# publishes an order change to both parties of the order
+def publish_order(event, order):
+  broker.publish_many([(restaurant_topic(order['restaurant_id']), event,
+                        order),
+                       (customer_topic(order['customer_id']), event, order)])
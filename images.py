@@ -0,0 +1,123 @@
+import hashlib
+import io
+import logging
+import os
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+
+import db
+from discovery import restaurant_index
+from menu import menu_cache
+from writer import write
+
+log = logging.getLogger(__name__)
+
+WORKERS = int(os.environ.get('IMAGE_WORKERS', 2))
+VARIANTS = (('thumb', (320, 320)), ('medium', (960, 960)))
+# files named by content hash never change, so they can be cached forever
+HASHED_NAME = re.compile(r'^uploads/[0-9a-f]{24}(-[a-z]+)?\.[a-z]+$')
+IMMUTABLE = 'public, max-age=31536000, immutable'
+
+_executor = None
+_executor_pid = None
+_lock = threading.Lock()
+
+
+def _get_executor():
+  global _executor, _executor_pid
+  if _executor is None or _executor_pid != os.getpid():
+    with _lock:
+      if _executor is None or _executor_pid != os.getpid():
+        _executor = ThreadPoolExecutor(max_workers=WORKERS,
+                                       thread_name_prefix='images')
+        _executor_pid = os.getpid()
+  return _executor
+
+
+def _save(folder, filename, data):
+  path = os.path.join(folder, filename)
+  if os.path.exists(path):
+    return
+  tmp = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+  with open(tmp, 'wb') as f:
+    f.write(data)
+  os.replace(tmp, path)
+
+
+# writes the original and its resized variants under content-hash names and
+# returns {'original': ..., 'thumb': ..., 'medium': ...}
+def store_variants(data, folder):
+  os.makedirs(folder, exist_ok=True)
+  digest = hashlib.sha256(data).hexdigest()[:24]
+  image = Image.open(io.BytesIO(data))
+  image.load()
+  if image.mode not in ('RGB', 'L'):
+    image = image.convert('RGB')
+  names = {'original': f'{digest}.jpeg'}
+  _save(folder, names['original'], _encode(image, quality=90))
+  for variant, size in VARIANTS:
+    resized = image.copy()
+    resized.thumbnail(size)
+    names[variant] = f'{digest}-{variant}.jpeg'
+    _save(folder, names[variant], _encode(resized, quality=82))
+  return names
+
+
+def _encode(image, quality):
+  out = io.BytesIO()
+  image.save(out, 'JPEG', quality=quality, optimize=True, progressive=True)
+  return out.getvalue()
+
+
+def _process_restaurant(data, folder, restaurant_id):
+  names = store_variants(data, folder)
+  write(lambda conn: conn.execute(
+      'UPDATE Restaurant SET Picture = ?, PictureThumb = ?, PictureMedium = ? '
+      'WHERE RestaurantID = ?', (names['original'], names['thumb'],
+                                 names['medium'], restaurant_id)))
+  conn = db.open_connection()
+  row = conn.execute('SELECT * FROM Restaurant WHERE RestaurantID = ?',
+                     (restaurant_id, )).fetchone()
+  conn.close()
+  if row:
+    restaurant_index.update_restaurant(dict(row))
+
+
+def _process_item(data, folder, item_id, restaurant_id):
+  names = store_variants(data, folder)
+  write(lambda conn: conn.execute(
+      'UPDATE Items SET Picture = ?, PictureThumb = ?, PictureMedium = ? '
+      'WHERE ItemID = ?', (names['original'], names['thumb'], names[
+          'medium'], item_id)))
+  menu_cache.bump(restaurant_id)
+
+
+def _report(future):
+  if future.exception() is not None:
+    log.error('image upload failed', exc_info=future.exception())
+
+
+# the request only reads the upload into memory; decoding, resizing and the
+# row update happen on the worker pool. Until then the row keeps its
+# placeholder picture.
+def submit_restaurant_picture(picture, folder, restaurant_id):
+  future = _get_executor().submit(_process_restaurant, picture.read(), folder,
+                                  restaurant_id)
+  future.add_done_callback(_report)
+  return future
+
+
+def submit_item_picture(picture, folder, item_id, restaurant_id):
+  future = _get_executor().submit(_process_item, picture.read(), folder,
+                                  item_id, restaurant_id)
+  future.add_done_callback(_report)
+  return future
+
+
+def cache_static(response, filename):
+  if filename and HASHED_NAME.match(filename):
+    response.headers['Cache-Control'] = IMMUTABLE
+  return response
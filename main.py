@@ -1,11 +1,92 @@
-from flask import Flask, render_template, request, session, redirect, url_for, flash
-from flask_login import LoginManager, login_user, login_required, logout_user, current_user
 import os
 import sqlite3
-import json
-from datetime import datetime
-from utils import User, connect_db, authenticate_user, isCustomer, isRestaurant, getUserPostcode, restaurantName, insertAccountHolder, allowed_file, user_already_exists
-from werkzeug.utils import secure_filename
+from datetime import date, timedelta
+
+import click
+from flask import (
+  Flask,
+  Response,
+  abort,
+  flash,
+  jsonify,
+  make_response,
+  redirect,
+  render_template,
+  request,
+  session,
+  url_for,
+)
+from flask_login import (
+  LoginManager,
+  current_user,
+  login_required,
+  login_user,
+  logout_user,
+)
+
+import admission
+import analytics
+import archive
+import credentials
+import db
+import metrics
+import migrations
+import prep
+import queryplan
+from api import api
+from cart import (
+  Cart,
+  clear_cart,
+  expire_carts,
+  load_cart,
+  parse_items,
+  price_cart,
+  save_cart,
+  sweep_due,
+)
+from credentials import Overloaded, hash_password
+from discovery import restaurant_index
+from events import broker, customer_topic, publish_order, restaurant_topic
+from images import cache_static, submit_item_picture, submit_restaurant_picture
+from menu import menu_cache
+from menu_bulk import (
+  export_menu,
+  import_items,
+  parse_upload,
+  placeholder_picture,
+)
+from onboarding import Onboarding, validate_restaurant
+from orders import (
+  CUSTOMER_ARCHIVE_HISTORY_SQL,
+  CUSTOMER_ARCHIVE_PAGE_SQL,
+  CUSTOMER_DASHBOARD_SQL,
+  CUSTOMER_HISTORY_SQL,
+  RESTAURANT_ARCHIVE_HISTORY_SQL,
+  RESTAURANT_ARCHIVE_PAGE_SQL,
+  RESTAURANT_DASHBOARD_SQL,
+  RESTAURANT_HISTORY_SQL,
+  TERMINAL_STATUSES,
+  EmptyCart,
+  ItemNotOnMenu,
+  export_history,
+  load_dashboard,
+  place_order,
+  update_status,
+)
+from search import MAX_RESULTS, search
+from utils import (
+  allowed_file,
+  authenticate_user,
+  connect_db,
+  getUserPostcode,
+  insertAccountHolder,
+  invalidate_principal,
+  isCustomer,
+  isRestaurant,
+  load_principal,
+  principal_cache,
+)
+from writer import get_writer, write
 
 app = Flask(__name__)
 app.config["SESSION_PERMANENT"] = False
@@ -17,17 +98,86 @@ login_manager = LoginManager(app)
 login_manager.login_view = 'login'
 login_manager.init_app(app)
 
+db.init_app(app)
+metrics.init_app(app)
+admission.init_app(app)
+archive.init_app(app)
+app.register_blueprint(api)
+
+if os.environ.get('AUTO_MIGRATE', '1') == '1':
+  migrations.upgrade()
+
+
+@app.cli.command('db-upgrade')
+def db_upgrade():
+  click.echo(f'database at version {migrations.upgrade()}')
+
+
+# moves old completed orders to the archive now instead of waiting for the
+# background job
+@app.cli.command('archive-orders')
+@click.option('--days',
+              type=float,
+              default=archive.AFTER_DAYS,
+              show_default=True,
+              help='archive Complete/Canceled orders older than this')
+def archive_orders(days):
+  click.echo(f'archived {archive.archive_orders(days)} orders')
+
+
+# recomputes the sales rollups from the order history
+@app.cli.command('rebuild-sales')
+def rebuild_sales():
+  write(analytics.rebuild)
+
+
+# recomputes the kitchen prep lists from the open orders
+@app.cli.command('rebuild-prep-list')
+def rebuild_prep_list():
+  write(prep.rebuild)
+
+
+# fails if any SQL literal in the app still needs a full table scan
+@app.cli.command('check-query-plans')
+def check_query_plans():
+  if queryplan.check():
+    raise SystemExit(1)
+
 UPLOAD_FOLDER = os.path.join(os.getcwd(), 'static/uploads')
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 
+
+# bulk onboarding from CSV or JSON Lines with the registration form's fields
+# (postcodes separated by commas, semicolons or spaces) plus an optional
+# picture path, validated like the form and inserted in chunks
+@app.cli.command('onboard-restaurants')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'jsonl']))
+@click.option('--chunk-size', default=500, show_default=True)
+@click.option('--images',
+              type=click.Path(exists=True, file_okay=False),
+              help='directory that picture paths are relative to')
+def onboard_restaurants(path, fmt, chunk_size, images):
+  fmt = fmt or ('csv' if path.lower().endswith('.csv') else 'jsonl')
+  job = Onboarding(app.config['UPLOAD_FOLDER'], images, chunk_size,
+                   log=click.echo)
+  job.run(path, fmt)
+  if job.failed:
+    raise SystemExit(1)
+
 # show user address and restaurant address in the order pagez
 
 
+@app.after_request
+def cache_uploads(response):
+  if request.endpoint == 'static':
+    cache_static(response, (request.view_args or {}).get('filename'))
+  return response
+
+
 @login_manager.user_loader
 def load_user(user_id):
-  user = User()
-  user.id = user_id
-  return user
+  return load_principal(user_id)
 
 
 # route for logging in for both customer and restaurant
@@ -36,7 +186,6 @@ def login():
 
   if (current_user.is_authenticated):
     if (isCustomer()):
-      postcode = getUserPostcode()
       return redirect(url_for('get_list_restaurants'))
     else:
       return redirect(url_for('restaurant_dashboard'))
@@ -44,19 +193,23 @@ def login():
   if request.method == 'POST':
     email = request.form['email']
     password = request.form['password']
-    user = authenticate_user(email, password)
+    try:
+      user = authenticate_user(email, password)
+    except Overloaded:
+      flash('Too many login attempts right now. Please try again.', 'error')
+      response = make_response(render_template('login.html'), 503)
+      response.headers['Retry-After'] = '1'
+      return response
 
     if user:
       login_user(user)
 
       if isCustomer():
-        print(int(current_user.id))
-        postcode = getUserPostcode()
         return redirect(url_for('get_list_restaurants'))
       else:
-        return render_template('restaurant_dashboard.html')
+        return redirect(url_for('restaurant_dashboard'))
     else:
-      print('flash here')
+      admission.login_failed(email)
       flash('Login failed. Check your email and password.', 'error')
       return redirect(url_for('login'))
   return render_template('login.html')
@@ -67,11 +220,47 @@ def login():
 @login_required
 def restaurant_dashboard():
   if (isRestaurant()):
-    return render_template('restaurant_dashboard.html')
+    conn = connect_db()
+    return render_template('restaurant_dashboard.html',
+                           sales=analytics.sales_summary(
+                               conn, current_user.id),
+                           prep_list=prep.prep_list(conn, current_user.id))
   else:
     return redirect(url_for('index'))
 
 
+# daily orders, revenue and cancellations plus the best-selling items over
+# the last ?days= days (default 30), read from the rollup tables
+@app.route('/restaurant/analytics')
+@login_required
+def restaurant_analytics():
+  if not isRestaurant():
+    abort(403)
+  days = min(max(request.args.get('days', analytics.ANALYTICS_DAYS, type=int),
+                 1), 366)
+  return jsonify(
+      analytics.sales_summary(connect_db(), current_user.id, days=days))
+
+
+# what the kitchen has to cook now: per item, the portions needed by the
+# Processing and Preparing orders. The dashboard keeps it current from the
+# 'prep_list' events on the restaurant's event stream.
+@app.route('/restaurant/prep-list')
+@login_required
+def restaurant_prep_list():
+  if not isRestaurant():
+    abort(403)
+  return jsonify({'items': prep.prep_list(connect_db(), current_user.id)})
+
+
+# sends the prep list entries of one order's items to the kitchen, after
+# the order was placed or changed stage
+def publish_prep_list(restaurant_id, order_id):
+  broker.publish(
+      restaurant_topic(restaurant_id), 'prep_list',
+      {'items': prep.order_entries(connect_db(), restaurant_id, order_id)})
+
+
 @app.route('/logout')
 @login_required
 def logout():
@@ -92,24 +281,26 @@ def register_customer():
     firstName = request.form['fname']
     lastName = request.form['lname']
     email = request.form['email']
-    password = request.form['password']
+    password = hash_password(request.form['password'])
     postcode = request.form['postcode']
     address = request.form['address']
     #session['name'] = request.form['name']
 
-    conn = connect_db()
-    if (user_already_exists(conn, email)):
+    def insert_customer(conn):
+      last_row_id = insertAccountHolder(email, password, postcode, address,
+                                        conn)
+      conn.execute(
+          'INSERT INTO Customer (CustomerID, FirstName, LastName) VALUES (?, ?, ?  )',
+          (last_row_id, firstName, lastName))
+      return last_row_id
+
+    try:
+      last_row_id = write(insert_customer)
+    except sqlite3.IntegrityError:
+      # AccountHolder.Email is UNIQUE (migration 2)
       flash('Email already exists. Please use a different email.', 'error')
-      conn.close()
       return redirect(url_for('register_customer'))
-
-    last_row_id = insertAccountHolder(email, password, postcode, address, conn)
-
-    conn.execute(
-        'INSERT INTO Customer (CustomerID, FirstName, LastName) VALUES (?, ?, ?  )',
-        (last_row_id, firstName, lastName))
-    conn.commit()
-    conn.close()
+    invalidate_principal(last_row_id)
     return render_template('register_success.html')
   return render_template('register_customer.html')
 
@@ -117,51 +308,58 @@ def register_customer():
 @app.route('/register_restaurant', methods=['GET', 'POST'])
 def register_restaurant():
   if request.method == 'POST':
-    name = request.form['name']
-    description = request.form['description']
-    opening_time = request.form['opening_time']
-    closing_time = request.form['closing_time']
-
-    email = request.form['email']
-    password = request.form['password']
-    address = request.form['address']
-    postcode = request.form['postcode']
-    postcodes = request.form['postcodes']
+    try:
+      fields = validate_restaurant(request.form)
+    except ValueError as e:
+      flash(f'Registration failed: {e}.', 'error')
+      return redirect(url_for('register_restaurant'))
+    name = fields['name']
+    description = fields['description']
+    opening_time = fields['opening_time']
+    closing_time = fields['closing_time']
+
+    email = fields['email']
+    password = hash_password(fields['password'])
+    address = fields['address']
+    postcode = fields['postcode']
+    postcodes_array = fields['postcodes']
     #session['name'] = request.form['name']
-    postcodes_array = postcodes.split(',')
 
-    conn = connect_db()
-    if (user_already_exists(conn, email)):
-      flash('Email already exists. Please use a different email.', 'error')
-      conn.close()
-      return redirect(url_for('register_restaurant'))
+    # an uploaded picture replaces the placeholder once it is processed
+    filename = "default restaurant.jpg"
+    picture = request.files.get('picture')
 
-    if 'picture' in request.files:
-      picture = request.files['picture']
-      if picture and allowed_file(picture.filename):
-        filename = secure_filename(picture.filename)
-        upload_folder = app.config['UPLOAD_FOLDER']
-        if not os.path.exists(upload_folder):
-          os.makedirs(upload_folder)
-        filename = f"{name}.jpeg"
-        picture.save(os.path.join(upload_folder, filename))
-      else:
-        filename = "default restaurant.jpg"
-    else:
-      filename = "default restaurant.jpg"
-
-    last_row_id = insertAccountHolder(email, password, postcode, address, conn)
-    postcodes_array = [int(num) for num in postcodes_array]
-    conn.execute(
-        'INSERT INTO Restaurant (RestaurantID, OpeningTime, ClosingTime, Description, Picture, RestaurantName) VALUES (?, ?, ?,?,? ,? )',
-        (last_row_id, opening_time, closing_time, description, filename, name))
-    for item in postcodes_array:
+    def insert_restaurant(conn):
+      last_row_id = insertAccountHolder(email, password, postcode, address,
+                                        conn)
       conn.execute(
+          'INSERT INTO Restaurant (RestaurantID, OpeningTime, ClosingTime, '
+          'Description, Picture, RestaurantName) VALUES (?, ?, ?,?,? ,? )',
+          (last_row_id, opening_time, closing_time, description, filename,
+           name))
+      conn.executemany(
           'INSERT INTO PostCodes (PostCode, RestaurantID) VALUES (?, ?)',
-          (item, last_row_id))
-    conn.commit()
-    conn.close()
-    print(name, description, email, password, address, postcode)
+          [(item, last_row_id) for item in postcodes_array])
+      return last_row_id
+
+    try:
+      last_row_id = write(insert_restaurant)
+    except sqlite3.IntegrityError:
+      flash('Email already exists. Please use a different email.', 'error')
+      return redirect(url_for('register_restaurant'))
+    invalidate_principal(last_row_id)
+    restaurant_index.update_restaurant(
+        {
+            'RestaurantID': last_row_id,
+            'OpeningTime': opening_time,
+            'ClosingTime': closing_time,
+            'Description': description,
+            'Picture': filename,
+            'RestaurantName': name
+        }, postcodes_array)
+    if picture and allowed_file(picture.filename):
+      submit_restaurant_picture(picture, app.config['UPLOAD_FOLDER'],
+                                last_row_id)
     return render_template('register_success.html')
   return render_template('register_restaurant.html')
 
@@ -171,23 +369,13 @@ def register_restaurant():
 @login_required
 def get_list_restaurants():
   if isCustomer():
-    conn = connect_db()
-    current_time = datetime.now().strftime('%H:%M')
-
-    rows = conn.execute(
-        """SELECT Restaurant.*
-							 FROM Restaurant 
-							 JOIN PostCodes ON Restaurant.RestaurantID = PostCodes.RestaurantID 
-							 JOIN AccountHolder ON AccountHolder.Postcode = PostCodes.Postcode 
-							 WHERE AccountHolder.ID = ? 
-								 AND ? BETWEEN Restaurant.OpeningTime AND Restaurant.ClosingTime""",
-        (int(current_user.id), current_time)).fetchall()
-    conn.close()
+    rows = restaurant_index.open_now(getUserPostcode())
 
     restaurants = []
     for row in rows:
       restaurant_dict = dict(row)
-      image_filename = restaurant_dict['Picture']
+      image_filename = restaurant_dict.get(
+          'PictureThumb') or restaurant_dict['Picture']
       image_path = url_for('static', filename=f'uploads/{image_filename}')
       restaurant_dict['image_path'] = image_path
       restaurants.append(restaurant_dict)
@@ -199,6 +387,23 @@ def get_list_restaurants():
     return redirect(url_for('index'))
 
 
+# dishes and restaurants matching ?q=, best first, among the restaurants
+# that deliver to the customer and are open right now
+@app.route('/search')
+@login_required
+def search_menu():
+  if not isCustomer():
+    abort(403)
+  limit = min(max(request.args.get('limit', 20, type=int), 1), MAX_RESULTS)
+  results = search(connect_db(), request.args.get('q', ''), getUserPostcode(),
+                   limit)
+  for result in results:
+    if result['picture']:
+      result['image_path'] = url_for('static',
+                                     filename=f'uploads/{result["picture"]}')
+  return jsonify(query=request.args.get('q', ''), results=results)
+
+
 # endpoint for the restaurant to add an item to the menu
 @app.route('/restaurant/add_to_menu', methods=['GET', 'POST'])
 @login_required
@@ -208,18 +413,18 @@ def add_to_menu():
 
   restaurant_id = current_user.id
 
+  def ensure_menu(conn):
+    hasMenu = conn.execute('SELECT  MenuID from hasMenu WHERE RestaurantID=?',
+                           (restaurant_id, )).fetchone()
+    if hasMenu:
+      return hasMenu['MenuID']
+    return conn.execute('INSERT INTO hasMenu(RestaurantID) VALUES(?)',
+                        (restaurant_id, )).lastrowid
+
   conn = connect_db()
-  hasMenu = conn.execute('SELECT * FROM hasMenu WHERE RestaurantID = ?',
-                         (int(restaurant_id), )).fetchall()
-  menuId = 0
-  if (len(hasMenu) == 0):
-    print('no menu')
-    menuId = conn.execute('INSERT INTO hasMenu(RestaurantID) VALUES(?)',
-                          (restaurant_id, )).lastrowid
-    conn.commit()
-  else:
-    menuId = conn.execute('SELECT  MenuID from hasMenu WHERE RestaurantID=?',
-                          (restaurant_id, )).fetchone()['MenuID']
+  hasMenu = conn.execute('SELECT  MenuID from hasMenu WHERE RestaurantID=?',
+                         (restaurant_id, )).fetchone()
+  menuId = hasMenu['MenuID'] if hasMenu else write(ensure_menu)
 
   menu_items = conn.execute(
       """SELECT Category.Name as category, Items.*   FROM Items 
@@ -233,51 +438,93 @@ def add_to_menu():
     price = request.form['price']
     description = request.form['description']
 
-    if 'picture' in request.files:
-      picture = request.files['picture']
-      if picture and allowed_file(picture.filename):
-        filename = secure_filename(picture.filename)
-        upload_folder = app.config['UPLOAD_FOLDER']
-        if not os.path.exists(upload_folder):
-          os.makedirs(upload_folder)
-        filename = f"{item}.jpeg"
-        picture.save(os.path.join(upload_folder, filename))
-      else:
-        if category == '1':
-          filename = "appetizer.jpg"
-        elif category == '2':
-          filename = "main.jpg"
-        elif category == '3':
-          filename = "dessert.jpg"
-        elif category == '4':
-          filename = "drink.jpg"
-    else:
-      if category == '1':
-        filename = "appetizer.jpg"
-      elif category == '2':
-        filename = "main.jpg"
-      elif category == '3':
-        filename = "dessert.jpg"
-      elif category == '4':
-        filename = "drink.jpg"
-
-    itemId = conn.execute(
-        'INSERT INTO Items (ItemName, Picture, CategoryId, Price, ItemDescription, isDeleted) '
-        'VALUES (?, ?, ?, ?, ?,?)',
-        (item, filename, int(category), int(price), description, 0)).lastrowid
-
-    conn.execute(
-        'INSERT INTO contains (MenuID, ItemID) VALUES (?, ?)',
-        (menuId, itemId),
-    )
-
-    conn.commit()
+    # category placeholder until an uploaded picture is processed
+    filename = placeholder_picture(category)
+    picture = request.files.get('picture')
+
+    def insert_item(conn):
+      itemId = conn.execute(
+          'INSERT INTO Items (ItemName, Picture, CategoryId, Price, '
+          'ItemDescription, isDeleted) '
+          'VALUES (?, ?, ?, ?, ?,?)',
+          (item, filename, int(category), int(price), description,
+           0)).lastrowid
+      conn.execute(
+          'INSERT INTO contains (MenuID, ItemID) VALUES (?, ?)',
+          (menuId, itemId),
+      )
+      return itemId
+
+    itemId = write(insert_item)
+    if picture and allowed_file(picture.filename):
+      submit_item_picture(picture, app.config['UPLOAD_FOLDER'], itemId,
+                          restaurant_id)
     conn.close()
+    menu_cache.bump(restaurant_id)
     return redirect(url_for('add_to_menu'))
   conn.close()
   return render_template('restaurant_menu_add.html', items=menu_items)
 
 
+def bulk_format(filename=None):
+  fmt = request.args.get('format')
+  if not fmt:
+    name = (filename or '').lower()
+    is_csv = name.endswith('.csv') or request.mimetype == 'text/csv'
+    fmt = 'csv' if is_csv else 'jsonl'
+  if fmt not in ('csv', 'jsonl'):
+    abort(400)
+  return fmt
+
+
+# bulk menu upload: a CSV (header name,category,price,description[,picture])
+# or JSON Lines body, raw or as the 'file' form field. Valid rows are added
+# in one transaction; the response lists the rejected rows by line number.
+# ?dry_run=1 only validates.
+@app.route('/restaurant/menu/import', methods=['POST'])
+@login_required
+def import_menu():
+  if not isRestaurant():
+    abort(403)
+  upload = request.files.get('file')
+  fmt = bulk_format(upload.filename if upload else None)
+  stream = upload.stream if upload else request.stream
+  try:
+    rows, errors = parse_upload(stream, fmt, connect_db())
+  except UnicodeDecodeError:
+    return jsonify(inserted=0,
+                   valid=0,
+                   item_ids=[],
+                   errors=[{
+                       'line': None,
+                       'error': 'the file is not UTF-8 encoded'
+                   }]), 400
+  item_ids = []
+  if rows and request.args.get('dry_run') != '1':
+    item_ids = write(import_items, int(current_user.id), rows)
+    menu_cache.bump(current_user.id)
+  status = 400 if errors and not rows else 200
+  return jsonify(inserted=len(item_ids),
+                 valid=len(rows),
+                 item_ids=item_ids,
+                 errors=errors), status
+
+
+@app.route('/restaurant/menu/export')
+@login_required
+def export_menu_items():
+  if not isRestaurant():
+    abort(403)
+  fmt = bulk_format()
+  mimetype = 'text/csv' if fmt == 'csv' else 'application/x-ndjson'
+  return Response(export_menu(current_user.id, fmt),
+                  mimetype=mimetype,
+                  headers={
+                      'Content-Disposition':
+                      f'attachment; filename=menu-{current_user.id}.{fmt}'
+                  })
+
+
 #endpoint to see a restaurant's menu
 @app.route('/menu/<restaurant_id>', methods=['GET', 'POST'])
 @login_required
@@ -287,32 +534,20 @@ def menu_items(restaurant_id):
 
   session.modified = True
   session['restaurant_id'] = restaurant_id
-  conn = connect_db()
 
-  rows = conn.execute(
-      """SELECT *  FROM contains 
-  JOIN Items on Items.ItemID = contains.ItemID 
-  JOIN hasMenu on hasMenu.MenuID = contains.MenuID
-  JOIN Category on Category.CategoryId = Items.CategoryId
-  where RestaurantID = ? and Items.isDeleted=0;""",
-      (int(restaurant_id), )).fetchall()
-
-  name = conn.execute(
-      """SELECT RestaurantName from Restaurant where RestaurantID = ?""",
-      (int(restaurant_id), )).fetchone()
-  name = name['RestaurantName']
-  menuItems = []
-  for row in rows:
-    menu_dict = dict(row)
-    image_filename = menu_dict['Picture']
-    image_path = url_for('static', filename=f'uploads/{image_filename}')
-    menu_dict['image_path'] = image_path
-    menuItems.append(menu_dict)
-
-  conn.close()
-  return render_template('menu_items_restaurant.html',
-                         items=menuItems,
-                         name=name)
+  snapshot = menu_cache.get(restaurant_id)
+  if snapshot.name is None:
+    abort(404)
+  if request.if_none_match.contains(snapshot.etag):
+    response = make_response('', 304)
+  else:
+    response = make_response(
+        render_template('menu_items_restaurant.html',
+                        items=snapshot.items,
+                        name=snapshot.name))
+  response.set_etag(snapshot.etag)
+  response.headers['Cache-Control'] = 'private, no-cache'
+  return response
 
 
 #get the current user's cart
@@ -322,41 +557,49 @@ def cart():
   if (isRestaurant()):
     return redirect(url_for('restaurant_dashboard'))
 
-  if (('cart' not in session) or
-      ('total' not in session)) or ('additionalText' not in session):
-
-    session['cart'] = []
-    session['total'] = 0
-    session['additionalText'] = None
+  # the cart lives server-side, keyed by the customer; drop what older
+  # sessions still carry in the cookie
+  for key in ('cart', 'total', 'additionalText'):
+    session.pop(key, None)
 
+  if sweep_due():
+    write(expire_carts)
   if request.method == "POST":
-    items = request.form['items']
-    total = request.form['total']
+    try:
+      items = parse_items(request.form['items'])
+    except ValueError:
+      abort(400)
     additionalText = request.form['additionalText']
 
     if (items):
-      session['cart'] = json.loads(items)
-      session['total'] = total
-      session['additionalText'] = additionalText
-
+      write(save_cart, current_user.id,
+            Cart(session.get('restaurant_id'), items, additionalText))
     else:
-      session['cart'] = []
-
+      write(clear_cart, current_user.id)
     return redirect(url_for("cart"))
+
+  conn = connect_db()
+
+  current_cart = load_cart(conn, current_user.id)
+  lines, total = price_cart(conn, current_cart)
+  conn.close()
   return render_template("cart.html",
-                         cart=session['cart'],
-                         total=session['total'],
-                         additionalText=session['additionalText'])
+                         cart=lines,
+                         total=total,
+                         additionalText=current_cart.additional_text)
 
 
 @app.route('/item/edit/<item_id>', methods=['GET', 'POST'])
+@login_required
 def editOrDeleteOrder(item_id):
   if (isCustomer()):
     return redirect(url_for('index'))
 
   conn = connect_db()
   item_data = conn.execute(
-      """SELECT Items.ItemName as ItemName, Items.ItemID as item_id, Items.ItemDescription, Items.Price, Category.CategoryId as category, Category.Name as category_name FROM Items 
+      """SELECT Items.ItemName as ItemName, Items.ItemID as item_id,
+    Items.ItemDescription, Items.Price, Category.CategoryId as category,
+    Category.Name as category_name FROM Items
     JOIN Category on Category.CategoryID = Items.CategoryId
     WHERE ItemID = ?""", (item_id, )).fetchone()
   if request.method == 'POST':
@@ -364,13 +607,13 @@ def editOrDeleteOrder(item_id):
     category = request.form['category']
     price = request.form['price']
     description = request.form['description']
-    print(name, category, price, description)
-    conn.execute(
+    write(lambda conn: conn.execute(
         """UPDATE Items
-     SET ItemName = ?, CategoryId = ?, Price = ?, ItemDescription = ? where ItemID=(?)""",
-        (name, category, float(price), description, item_id))
-    conn.commit()
+     SET ItemName = ?, CategoryId = ?, Price = ?, ItemDescription = ?
+     where ItemID=(?)""",
+        (name, category, float(price), description, item_id)))
     conn.close()
+    menu_cache.bump(current_user.id)
     return redirect(url_for('editOrDeleteOrder', item_id=item_id))
 
   conn.close()
@@ -380,14 +623,14 @@ def editOrDeleteOrder(item_id):
 
 
 @app.route("/item/delete/<item_id>")
+@login_required
 def deleteItem(item_id):
   if (isCustomer()):
     return redirect(url_for('index'))
 
-  conn = connect_db()
-  conn.execute("UPDATE Items SET isDeleted = 1 WHERE ItemID = ?", (item_id, ))
-  conn.commit()
-  conn.close()
+  write(lambda conn: conn.execute(
+      "UPDATE Items SET isDeleted = 1 WHERE ItemID = ?", (item_id, )))
+  menu_cache.bump(current_user.id)
   return redirect(url_for('add_to_menu'))
 
 
@@ -398,32 +641,49 @@ def order_customer():
   if (isRestaurant()):
     return redirect(url_for('restaurant_dashboard'))
 
-  print(session['cart'], session['total'])
   conn = connect_db()
-
-  items = session['cart']
-  total = session['total']
-  additionalText = session['additionalText']
-  restaurant_id = session['restaurant_id']
-  user_id = int(
-      current_user.id)  #used as example. Please change user id when you login
-  current_time = datetime.now()
-  order_id = conn.execute(
-      """INSERT INTO Orders(CustomerId, RestaurantId, 
-      Status, AdditionalText, EstimatedDeliveryTime,             
-      TotalCost, Order_Time) 
-        VALUES(? , ? , ? , ? ,?, ? , ?)""",
-      (user_id, restaurant_id, 'Processing', additionalText, '', total,
-       current_time)).lastrowid
-
-  for item in items:
-    conn.execute(
-        """INSERT INTO OrderItem(OrderId, ItemID, Quantity) VALUES(?, ?, ?)""",
-        (order_id, item['item'], item['quantity']))
-
-  conn.commit()
+  current_cart = load_cart(conn, current_user.id)
   conn.close()
-  return render_template('menu_item_success.html')
+  restaurant_id = session.get('restaurant_id', current_cart.restaurant_id)
+  # the order form sends a key per checkout; without one the cart revision
+  # makes a double submit or a refresh of the same cart resolve to one order
+  idempotency_key = request.values.get('idempotency_key')
+  if not current_cart and current_cart.last_order_id and (
+      idempotency_key in (None, '', current_cart.last_key)):
+    # a refresh after the order went through: the cart is empty by now
+    return render_template('menu_item_success.html',
+                           order_id=current_cart.last_order_id)
+  if not idempotency_key and current_cart:
+    idempotency_key = f'cart-{current_cart.updated_at!r}'
+
+  try:
+    order_id, created = write(place_order, current_user.id, restaurant_id,
+                              current_cart, idempotency_key)
+  except EmptyCart:
+    flash('Your cart is empty.', 'error')
+    return redirect(url_for('cart'))
+  except ItemNotOnMenu:
+    flash('Some items in your cart are no longer available.', 'error')
+    return redirect(url_for('cart'))
+  if created:
+    publish_order(
+        'order_created', {
+            'order_id': order_id,
+            'restaurant_id': int(restaurant_id),
+            'customer_id': int(current_user.id),
+            'status': 'Processing',
+        })
+    publish_prep_list(restaurant_id, order_id)
+  return render_template('menu_item_success.html', order_id=order_id)
+
+
+# "load more" links pass the cursor of the last row they showed, e.g.
+# ?complete_before=<cursor>&canceled_before=<cursor>
+def dashboard_cursors():
+  return {
+      status: request.args.get(f'{status.lower()}_before')
+      for status in TERMINAL_STATUSES
+  }
 
 
 # view all the orders for the customer
@@ -434,32 +694,16 @@ def view_orders_customer():
     return redirect(url_for("index"))
 
   conn = connect_db()
-  customer_id = current_user.id
-  processing_orders = conn.execute(
-      """SELECT strftime('%d/%m/%Y %H:%M',Order_Time) as Order_Time, TotalCost, Status,OrderId from (
-  SELECT * from Orders where CustomerId=(?) and Status='Processing' ORDER BY Order_Time DESC );""",
-      (customer_id, )).fetchall()
-
-  preparing_orders = conn.execute(
-      """SELECT strftime('%d/%m/%Y %H:%M',Order_Time) as Order_Time, TotalCost, Status,OrderId from (
-	SELECT * from Orders where CustomerId=(?) and Status='Preparing' ORDER BY Order_Time DESC );""",
-      (customer_id, )).fetchall()
-
-  completed_orders = conn.execute(
-      """SELECT strftime('%d/%m/%Y %H:%M',Order_Time) as Order_Time, TotalCost, Status,OrderId from (
-  SELECT * from Orders where CustomerId=(?) and Status='Complete' ORDER BY Order_Time DESC );""",
-      (customer_id, )).fetchall()
-
-  cancelled_orders = conn.execute(
-      """SELECT strftime('%d/%m/%Y %H:%M',Order_Time) as Order_Time, TotalCost, Status,OrderId from (
-  SELECT * from Orders where CustomerId=(?) and Status='Canceled' ORDER BY Order_Time DESC );""",
-      (customer_id, )).fetchall()
+  orders, next_cursors = load_dashboard(conn, CUSTOMER_DASHBOARD_SQL,
+                                        CUSTOMER_ARCHIVE_PAGE_SQL,
+                                        current_user.id, dashboard_cursors())
   conn.close()
   return render_template('view_orders_customer.html',
-                         processing_orders=processing_orders,
-                         preparing_orders=preparing_orders,
-                         completed_orders=completed_orders,
-                         cancelled_orders=cancelled_orders)
+                         processing_orders=orders['Processing'],
+                         preparing_orders=orders['Preparing'],
+                         completed_orders=orders['Complete'],
+                         cancelled_orders=orders['Canceled'],
+                         next_cursors=next_cursors)
 
 
 # view a specific order for a customer
@@ -471,8 +715,10 @@ def view_order_customer(order_id):
 
   conn = connect_db()
   customer_id = current_user.id
-  order_data = conn.execute(
-      """SELECT Items.ItemName, OrderItem.Quantity, Items.Price, Orders.TotalCost, Restaurant.RestaurantName, AdditionalText
+  order_data = archive.fetch_with_archive(
+      conn, """SELECT Items.ItemName, OrderItem.Quantity, Items.Price,
+        Orders.TotalCost, Restaurant.RestaurantName, AdditionalText,
+        Orders.Status, Orders.EstimatedDeliveryTime
 
         FROM Orders
         JOIN OrderItem
@@ -482,14 +728,16 @@ def view_order_customer(order_id):
         JOIN Restaurant 
         ON Restaurant.RestaurantID = Orders.RestaurantId
         Where OrderItem.OrderId = ?
-         AND Orders.CustomerId=?""", (int(order_id), customer_id)).fetchall()
-  print()
+         AND Orders.CustomerId=?""", (int(order_id), customer_id))
   conn.close()
   return render_template('view_order_customer.html',
                          order_data=order_data,
                          total_cost=order_data[0]['TotalCost'],
                          restaurant_name=order_data[0]['RestaurantName'],
-                         additionalText=order_data[0]['additionalText'])
+                         additionalText=order_data[0]['additionalText'],
+                         status=order_data[0]['Status'],
+                         estimated_delivery=order_data[0]
+                         ['EstimatedDeliveryTime'])
 
 
 # view all the orders of a restaurant
@@ -500,30 +748,41 @@ def view_orders():
     return redirect(url_for("index"))
 
   conn = connect_db()
-  restaurant_id = current_user.id
   # Processing -> Preparing -> Completed| Cancelled
-  processing = conn.execute(
-      """SELECT  TotalCost , OrderId, datetime(Order_Time) as Order_Time, Status FROM (
-	SELECT * FROM Orders WHERE Orders.RestaurantId=(?) AND Status='Processing'
-	ORDER by Order_Time desc);""", (restaurant_id, )).fetchall()
-  preparing = conn.execute(
-      """SELECT  TotalCost , OrderId, datetime(Order_Time) as Order_Time, Status FROM (
-  SELECT * FROM Orders WHERE Orders.RestaurantId=(?) AND Status='Preparing'
-  ORDER by Order_Time desc);""", (restaurant_id, )).fetchall()
-  completed = conn.execute(
-      """SELECT  TotalCost , OrderId, datetime(Order_Time) as Order_Time, Status FROM (
-	SELECT * FROM Orders WHERE Orders.RestaurantId=(?) AND Status='Complete'
-	ORDER by Order_Time desc);""", (restaurant_id, )).fetchall()
-  canceled = conn.execute(
-      """SELECT  TotalCost , OrderId, datetime(Order_Time) as Order_Time, Status FROM (
-	SELECT * FROM Orders WHERE Orders.RestaurantId=(?) AND Status='Canceled'
-	ORDER by Order_Time desc);""", (restaurant_id, )).fetchall()
+  orders, next_cursors = load_dashboard(conn, RESTAURANT_DASHBOARD_SQL,
+                                        RESTAURANT_ARCHIVE_PAGE_SQL,
+                                        current_user.id, dashboard_cursors())
   conn.close()
   return render_template('view_orders_restaurant.html',
-                         processing=processing,
-                         preparing=preparing,
-                         completed=completed,
-                         canceled=canceled)
+                         processing=orders['Processing'],
+                         preparing=orders['Preparing'],
+                         completed=orders['Complete'],
+                         canceled=orders['Canceled'],
+                         next_cursors=next_cursors)
+
+
+# complete order history with line items as CSV, for accounting. Optional
+# ?from=YYYY-MM-DD and ?to=YYYY-MM-DD bound it by order date, both inclusive.
+@app.route('/orders/export.csv')
+@login_required
+def export_orders():
+  try:
+    start = date.fromisoformat(request.args.get('from', '0001-01-01'))
+    end = date.fromisoformat(request.args.get('to', '9999-12-30'))
+    end += timedelta(days=1)
+  except (ValueError, OverflowError):
+    abort(400)
+  if isRestaurant():
+    sql, archive_sql = RESTAURANT_HISTORY_SQL, RESTAURANT_ARCHIVE_HISTORY_SQL
+  else:
+    sql, archive_sql = CUSTOMER_HISTORY_SQL, CUSTOMER_ARCHIVE_HISTORY_SQL
+  return Response(export_history(sql, archive_sql, current_user.id,
+                                 start.isoformat(), end.isoformat()),
+                  mimetype='text/csv',
+                  headers={
+                      'Content-Disposition':
+                      f'attachment; filename=orders-{current_user.id}.csv'
+                  })
 
 
 # view and edit a  specific order from a restaurant's dashboard
@@ -535,8 +794,9 @@ def edit_order(order_id):
 
   conn = connect_db()
   restaurant_id = current_user.id
-  current_order = conn.execute(
-      """SELECT Items.ItemName, OrderItem.Quantity, Orders.TotalCost, time(Orders.Order_Time) as Order_Time,
+  current_order = archive.fetch_with_archive(
+      conn, """SELECT Items.ItemName, OrderItem.Quantity, Orders.TotalCost,
+          time(Orders.Order_Time) as Order_Time,
           AccountHolder.Address as user_address,
       Orders.Status, AdditionalText
       FROM Orders
@@ -546,9 +806,8 @@ def edit_order(order_id):
         ON Items.ItemId = OrderItem.ItemID
         JOIN AccountHolder
         ON AccountHolder.ID = Orders.CustomerId 
-        Where Orders.OrderId = ?
-        AND Orders.RestaurantId=?""",
-      (int(order_id), restaurant_id)).fetchall()
+        Where OrderItem.OrderId = ?
+        AND Orders.RestaurantId=?""", (int(order_id), restaurant_id))
   total_cost = current_order[0]['TotalCost']
   order_time = (current_order[0]['Order_Time'])
   user_address = (current_order[0]['user_address'])
@@ -556,12 +815,20 @@ def edit_order(order_id):
   if request.method == "POST":
     new_status = request.form.get('status')
 
-    conn = connect_db()
-    conn.execute(
-        "UPDATE Orders SET Status = ? WHERE OrderId = ? AND RestaurantId = ?",
-        (new_status, order_id, restaurant_id))
-    conn.commit()
+    changed = write(update_status, order_id, restaurant_id, new_status)
     conn.close()
+    if changed:
+      customer_id, old_status = changed
+      publish_order(
+          'order_status', {
+              'order_id': int(order_id),
+              'restaurant_id': int(restaurant_id),
+              'customer_id': customer_id,
+              'status': new_status,
+              'previous_status': old_status,
+          })
+      if old_status != new_status:
+        publish_prep_list(restaurant_id, order_id)
     return redirect(url_for("view_orders"))
 
   conn.close()
@@ -573,5 +840,76 @@ def edit_order(order_id):
                          addtional_text=addtional_text)
 
 
+# Server-Sent Events for the order dashboards: 'order_created' and
+# 'order_status' events carry the order id, both parties and the status.
+# Reconnecting clients send Last-Event-ID and get the missed events first.
+def event_stream(topic):
+  last_id = request.headers.get('Last-Event-ID',
+                                request.args.get('last_event_id', 0))
+  try:
+    last_id = int(last_id)
+  except ValueError:
+    last_id = 0
+  return Response(broker.stream(topic, last_id),
+                  mimetype='text/event-stream',
+                  headers={
+                      'Cache-Control': 'no-cache',
+                      'X-Accel-Buffering': 'no'
+                  })
+
+
+@app.route('/events/restaurant')
+@login_required
+def restaurant_events():
+  if not isRestaurant():
+    abort(403)
+  return event_stream(restaurant_topic(current_user.id))
+
+
+@app.route('/events/customer')
+@login_required
+def customer_events():
+  if not isCustomer():
+    abort(403)
+  return event_stream(customer_topic(current_user.id))
+
+
+# principal cache effectiveness, e.g. to tune PRINCIPAL_CACHE_SIZE/TTL
+@app.route('/cache_stats')
+def cache_stats():
+  return jsonify(principal=principal_cache.stats())
+
+
+metrics.registry.register(
+    metrics.Gauge(
+        'lieferspatz_principal_cache', 'Principal cache hits, misses and size.',
+        lambda: {(key, ): value
+                 for key, value in principal_cache.stats().items()
+                 if key in ('hits', 'misses', 'size')}, ('stat', )))
+metrics.registry.register(
+    metrics.Gauge('lieferspatz_writer_batches',
+                  'Write batches and jobs committed by the writer thread.',
+                  lambda: {('batches', ): get_writer().batches,
+                           ('jobs', ): get_writer().jobs}, ('stat', )))
+metrics.registry.register(
+    metrics.Gauge('lieferspatz_event_streams',
+                  'Live event streams held open by this process.',
+                  lambda: {(): broker.streams}))
+metrics.registry.register(
+    metrics.Gauge('lieferspatz_login_shed',
+                  'Logins refused because password checks were saturated.',
+                  lambda: {(): credentials.shed}))
+
+
+# Prometheus text format; each worker process reports its own numbers
+@app.route('/metrics')
+def prometheus_metrics():
+  return Response(metrics.registry.render(),
+                  mimetype='text/plain; version=0.0.4')
+
+
+# development server; production runs serve.py
 if __name__ == '__main__':
-  app.run(debug=True, host='0.0.0.0', port=8080)
+  app.run(debug=os.environ.get('FLASK_DEBUG', '1') == '1',
+          host=os.environ.get('HOST', '0.0.0.0'),
+          port=int(os.environ.get('PORT', 8080)))
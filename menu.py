@@ -0,0 +1,147 @@
+import hashlib
+import json
+import os
+import threading
+import time
+
+from flask import url_for
+
+from utils import connect_db
+
+# bounds staleness when another process changed the menu
+SNAPSHOT_TTL = float(os.environ.get('MENU_CACHE_TTL', 60))
+
+MENU_ITEMS_SQL = """SELECT *  FROM contains
+  JOIN Items on Items.ItemID = contains.ItemID
+  JOIN hasMenu on hasMenu.MenuID = contains.MenuID
+  JOIN Category on Category.CategoryId = Items.CategoryId
+  where RestaurantID = ? and Items.isDeleted=0;"""
+# the same for a JSON array of restaurant ids
+MENU_ITEMS_MANY_SQL = """SELECT *  FROM contains
+  JOIN Items on Items.ItemID = contains.ItemID
+  JOIN hasMenu on hasMenu.MenuID = contains.MenuID
+  JOIN Category on Category.CategoryId = Items.CategoryId
+  where RestaurantID IN (SELECT value FROM json_each(?))
+    and Items.isDeleted=0"""
+
+
+class MenuSnapshot:
+
+  def __init__(self, restaurant_id, name, items):
+    self.restaurant_id = restaurant_id
+    self.name = name
+    self.items = items
+    # from the content, so a rebuild of an unchanged menu (after the TTL or
+    # in another worker process) keeps its ETag
+    self.version = hashlib.sha1(
+        json.dumps([name, items], sort_keys=True,
+                   default=str).encode('utf-8')).hexdigest()[:16]
+    self.built_at = time.monotonic()
+
+  @property
+  def etag(self):
+    return f'menu-{self.restaurant_id}-{self.version}'
+
+
+# prebuilt, read-only menus per restaurant. Writers call bump() after they
+# commit, which drops the snapshot so the next view rebuilds it, with a new
+# version (and therefore a new ETag) if the menu changed. Every bump also advances the
+# restaurant's generation; a snapshot whose build started before a bump may
+# have read the old menu and is not cached.
+class MenuCache:
+
+  def __init__(self, ttl=SNAPSHOT_TTL):
+    self.ttl = ttl
+    self._snapshots = {}
+    self._generations = {}
+    self._lock = threading.Lock()
+
+  def get(self, restaurant_id):
+    restaurant_id = int(restaurant_id)
+    snapshot = self._snapshots.get(restaurant_id)
+    if snapshot is None or time.monotonic() - snapshot.built_at > self.ttl:
+      generation = self._generations.get(restaurant_id, 0)
+      snapshot = self._build(restaurant_id)
+      self._store({restaurant_id: snapshot}, {restaurant_id: generation})
+    return snapshot
+
+  def bump(self, restaurant_id):
+    restaurant_id = int(restaurant_id)
+    with self._lock:
+      self._generations[restaurant_id] = self._generations.get(
+          restaurant_id, 0) + 1
+      self._snapshots.pop(restaurant_id, None)
+
+  # caches the snapshots of restaurants not bumped since `generations`
+  def _store(self, snapshots, generations):
+    with self._lock:
+      for restaurant_id, snapshot in snapshots.items():
+        current = self._generations.get(restaurant_id, 0)
+        if current == generations[restaurant_id]:
+          self._snapshots[restaurant_id] = snapshot
+
+  # snapshots for several restaurants in the order asked for. The ones not
+  # cached are built together, with one query per table for all of them.
+  def get_many(self, restaurant_ids):
+    restaurant_ids = [int(restaurant_id) for restaurant_id in restaurant_ids]
+    now = time.monotonic()
+    snapshots = {}
+    for restaurant_id in restaurant_ids:
+      snapshot = self._snapshots.get(restaurant_id)
+      if snapshot is not None and now - snapshot.built_at <= self.ttl:
+        snapshots[restaurant_id] = snapshot
+    missing = sorted(set(restaurant_ids) - set(snapshots))
+    if missing:
+      generations = {
+          restaurant_id: self._generations.get(restaurant_id, 0)
+          for restaurant_id in missing
+      }
+      built = self._build_many(missing)
+      self._store(built, generations)
+      snapshots.update(built)
+    return [snapshots[restaurant_id] for restaurant_id in restaurant_ids]
+
+  def _build(self, restaurant_id):
+    conn = connect_db()
+    rows = conn.execute(MENU_ITEMS_SQL, (restaurant_id, )).fetchall()
+    name = conn.execute(
+        """SELECT RestaurantName from Restaurant where RestaurantID = ?""",
+        (restaurant_id, )).fetchone()
+    conn.close()
+
+    items = [self._item(row) for row in rows]
+    return MenuSnapshot(restaurant_id, name['RestaurantName'] if name else None,
+                        tuple(items))
+
+  def _build_many(self, restaurant_ids):
+    conn = connect_db()
+    ids = json.dumps(restaurant_ids)
+    rows = conn.execute(MENU_ITEMS_MANY_SQL, (ids, )).fetchall()
+    names = {
+        row['RestaurantID']: row['RestaurantName']
+        for row in conn.execute(
+            """SELECT RestaurantID, RestaurantName from Restaurant
+            where RestaurantID IN (SELECT value FROM json_each(?))""",
+            (ids, ))
+    }
+    conn.close()
+
+    items = {restaurant_id: [] for restaurant_id in restaurant_ids}
+    for row in rows:
+      items[row['RestaurantID']].append(self._item(row))
+    return {
+        restaurant_id: MenuSnapshot(restaurant_id, names.get(restaurant_id),
+                                    tuple(items[restaurant_id]))
+        for restaurant_id in restaurant_ids
+    }
+
+  @staticmethod
+  def _item(row):
+    menu_dict = dict(row)
+    image_filename = menu_dict.get('PictureMedium') or menu_dict['Picture']
+    menu_dict['image_path'] = url_for('static',
+                                      filename=f'uploads/{image_filename}')
+    return menu_dict
+
+
+menu_cache = MenuCache()
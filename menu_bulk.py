@@ -0,0 +1,174 @@
+import codecs
+import csv
+import io
+import json
+import math
+import os
+
+from werkzeug.utils import secure_filename
+
+import db
+
+# rows accepted per upload; the whole upload is inserted in one transaction
+MAX_ROWS = int(os.environ.get('MENU_IMPORT_MAX_ROWS', 5000))
+EXPORT_CHUNK = 500
+
+COLUMNS = ('item_id', 'name', 'category', 'price', 'description', 'picture')
+# category placeholder until a real picture is uploaded
+PLACEHOLDER_PICTURES = {
+    1: 'appetizer.jpg',
+    2: 'main.jpg',
+    3: 'dessert.jpg',
+    4: 'drink.jpg'
+}
+
+MENU_EXPORT_SQL = """SELECT Items.ItemID as item_id, Items.ItemName as name,
+  Category.Name as category, Items.Price as price,
+  Items.ItemDescription as description, Items.Picture as picture
+  FROM contains
+  JOIN hasMenu on hasMenu.MenuID = contains.MenuID
+  JOIN Items on Items.ItemID = contains.ItemID
+  JOIN Category on Category.CategoryId = Items.CategoryId
+  WHERE hasMenu.RestaurantID = ? and Items.isDeleted = 0
+  ORDER BY Items.ItemID"""
+
+
+def placeholder_picture(category_id):
+  return PLACEHOLDER_PICTURES.get(int(category_id), 'main.jpg')
+
+
+# category id and lower-cased name -> CategoryId, read once per upload
+def load_categories(conn):
+  categories = {}
+  for row in conn.execute(
+      '/* scan-ok */ SELECT CategoryId, Name FROM Category'):
+    categories[str(row['CategoryId'])] = row['CategoryId']
+    categories[row['Name'].strip().lower()] = row['CategoryId']
+  return categories
+
+
+# the body's lines as text, decoded as they are read. Werkzeug's spooled
+# upload files cannot be wrapped in a TextIOWrapper on Python 3.10 (they lack
+# readable()), so the binary lines are decoded here. Raises
+# UnicodeDecodeError if the body is not UTF-8.
+def _text_lines(stream):
+  decoder = codecs.getincrementaldecoder('utf-8-sig')()
+  for line in stream:
+    yield decoder.decode(line)
+  rest = decoder.decode(b'', final=True)
+  if rest:
+    yield rest
+
+
+# yields (line number, dict or None, error) without reading the whole body
+def read_rows(stream, fmt):
+  text = _text_lines(stream)
+  if fmt == 'csv':
+    reader = csv.DictReader(text)
+    for row in reader:
+      yield reader.line_num, row, None
+    return
+  for line_no, line in enumerate(text, 1):
+    if not line.strip():
+      continue
+    try:
+      row = json.loads(line)
+    except ValueError as e:
+      yield line_no, None, f'invalid JSON: {e}'
+      continue
+    if not isinstance(row, dict):
+      yield line_no, None, 'expected a JSON object'
+      continue
+    yield line_no, row, None
+
+
+# returns the Items values for one row, or raises ValueError with the reason
+def validate_row(row, categories):
+  name = str(row.get('name') or '').strip()
+  if not name:
+    raise ValueError('name is required')
+  category = categories.get(str(row.get('category') or '').strip().lower())
+  if category is None:
+    raise ValueError(f'unknown category {row.get("category")!r}')
+  try:
+    price = round(float(row.get('price')), 2)
+  except (TypeError, ValueError):
+    raise ValueError(f'invalid price {row.get("price")!r}') from None
+  if not math.isfinite(price):
+    raise ValueError(f'invalid price {row.get("price")!r}')
+  if price < 0:
+    raise ValueError('price must not be negative')
+  description = str(row.get('description') or '').strip()
+  picture = secure_filename(str(row.get('picture') or ''))
+  return (name, picture or placeholder_picture(category), category, price,
+          description)
+
+
+# parses and validates an upload; returns (valid rows, [{'line', 'error'}])
+def parse_upload(stream, fmt, conn):
+  categories = load_categories(conn)
+  valid, errors = [], []
+  for line_no, row, error in read_rows(stream, fmt):
+    if error is None:
+      if len(valid) >= MAX_ROWS:
+        errors.append({
+            'line': line_no,
+            'error': f'more than {MAX_ROWS} rows, remainder ignored'
+        })
+        break
+      try:
+        valid.append(validate_row(row, categories))
+        continue
+      except ValueError as e:
+        error = str(e)
+    errors.append({'line': line_no, 'error': error})
+  return valid, errors
+
+
+# writer job: one transaction for the whole upload, with Items and contains
+# both inserted by executemany
+def import_items(conn, restaurant_id, rows):
+  menu = conn.execute('SELECT MenuID from hasMenu WHERE RestaurantID = ?',
+                      (restaurant_id, )).fetchone()
+  if menu:
+    menu_id = menu['MenuID']
+  else:
+    menu_id = conn.execute('INSERT INTO hasMenu(RestaurantID) VALUES(?)',
+                           (restaurant_id, )).lastrowid
+  item_ids = db.reserve_ids(conn, 'Items', 'ItemID', len(rows))
+  conn.executemany(
+      'INSERT INTO Items (ItemID, ItemName, Picture, CategoryId, Price, '
+      'ItemDescription, isDeleted) VALUES (?, ?, ?, ?, ?, ?, 0)',
+      [(item_id, ) + row for item_id, row in zip(item_ids, rows, strict=True)])
+  conn.executemany('INSERT INTO contains (MenuID, ItemID) VALUES (?, ?)',
+                   [(menu_id, item_id) for item_id in item_ids])
+  return list(item_ids)
+
+
+# yields the menu as CSV or JSON Lines text, a chunk of rows at a time. It
+# reads on a private connection so a slow download holds no pooled handle.
+def export_menu(restaurant_id, fmt):
+  conn = db.open_connection()
+  try:
+    cursor = conn.execute(MENU_EXPORT_SQL, (int(restaurant_id), ))
+    if fmt == 'csv':
+      out = io.StringIO()
+      writer = csv.writer(out)
+      writer.writerow(COLUMNS)
+    while True:
+      rows = cursor.fetchmany(EXPORT_CHUNK)
+      if not rows:
+        break
+      if fmt == 'csv':
+        writer.writerows(tuple(row) for row in rows)
+        yield out.getvalue()
+        out.seek(0)
+        out.truncate()
+      else:
+        yield ''.join(
+            json.dumps(dict(row), separators=(',', ':')) + '\n'
+            for row in rows)
+    if fmt == 'csv' and out.tell():
+      yield out.getvalue()
+  finally:
+    conn.close()
@@ -0,0 +1,254 @@
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import g, has_app_context, has_request_context, request
+
+log = logging.getLogger(__name__)
+
+# statements slower than this are logged with their route
+SLOW_QUERY_MS = float(os.environ.get('SLOW_QUERY_MS', 100))
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200)
+
+
+def _label_text(names, values):
+  if not names:
+    return ''
+  pairs = ','.join(f'{name}="{_escape(value)}"'
+                   for name, value in zip(names, values, strict=True))
+  return '{' + pairs + '}'
+
+
+def _escape(value):
+  return str(value).replace('\\', r'\\').replace('"', r'\"').replace(
+      '\n', r'\n')
+
+
+class Counter:
+
+  kind = 'counter'
+
+  def __init__(self, name, help, labels=()):
+    self.name = name
+    self.help = help
+    self.labels = labels
+    self._values = {}
+    self._lock = threading.Lock()
+
+  def inc(self, *label_values, amount=1):
+    with self._lock:
+      self._values[label_values] = self._values.get(label_values, 0) + amount
+
+  def samples(self):
+    with self._lock:
+      values = sorted(self._values.items())
+    for label_values, value in values:
+      yield self.name + _label_text(self.labels, label_values), value
+
+
+class Histogram:
+
+  kind = 'histogram'
+
+  def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+    self.name = name
+    self.help = help
+    self.labels = labels
+    self.buckets = tuple(buckets)
+    # label values -> [count per bucket..., +Inf count, sum]
+    self._values = {}
+    self._lock = threading.Lock()
+
+  def observe(self, value, *label_values):
+    with self._lock:
+      series = self._values.get(label_values)
+      if series is None:
+        series = self._values[label_values] = [0] * (len(self.buckets) + 2)
+      for i, bound in enumerate(self.buckets):
+        if value <= bound:
+          series[i] += 1
+      series[-2] += 1
+      series[-1] += value
+
+  def samples(self):
+    with self._lock:
+      values = sorted((k, list(v)) for k, v in self._values.items())
+    names = self.labels + ('le', )
+    for label_values, series in values:
+      for bound, count in zip(self.buckets, series[:-2], strict=True):
+        yield (self.name + '_bucket' +
+               _label_text(names, label_values + (bound, ))), count
+      yield (self.name + '_bucket' +
+             _label_text(names, label_values + ('+Inf', ))), series[-2]
+      yield self.name + '_count' + _label_text(self.labels,
+                                               label_values), series[-2]
+      yield self.name + '_sum' + _label_text(self.labels,
+                                             label_values), series[-1]
+
+
+# values read at scrape time from something that already counts, e.g. a
+# cache's hit counter. `read` returns {label values tuple: value}.
+class Gauge:
+
+  kind = 'gauge'
+
+  def __init__(self, name, help, read, labels=()):
+    self.name = name
+    self.help = help
+    self.labels = labels
+    self.read = read
+
+  def samples(self):
+    for label_values, value in sorted(self.read().items()):
+      yield self.name + _label_text(self.labels, label_values), value
+
+
+class Registry:
+
+  def __init__(self):
+    self.metrics = []
+
+  def register(self, metric):
+    self.metrics.append(metric)
+    return metric
+
+  def render(self):
+    lines = []
+    for metric in self.metrics:
+      lines.append(f'# HELP {metric.name} {metric.help}')
+      lines.append(f'# TYPE {metric.name} {metric.kind}')
+      for name, value in metric.samples():
+        lines.append(f'{name} {value:g}' if isinstance(value, float) else
+                     f'{name} {value}')
+    return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+request_seconds = registry.register(
+    Histogram('lieferspatz_request_seconds', 'Request latency by endpoint.',
+              ('endpoint', )))
+requests_total = registry.register(
+    Counter('lieferspatz_requests_total', 'Responses by endpoint and status.',
+            ('endpoint', 'status')))
+request_queries = registry.register(
+    Histogram('lieferspatz_request_queries',
+              'SQL statements issued per request.', ('endpoint', ),
+              buckets=QUERY_BUCKETS))
+request_db_seconds = registry.register(
+    Histogram('lieferspatz_request_db_seconds',
+              'Time spent in SQL statements per request.', ('endpoint', )))
+queries_total = registry.register(
+    Counter('lieferspatz_db_queries_total',
+            'SQL statements executed, including background threads.'))
+query_seconds_total = registry.register(
+    Counter('lieferspatz_db_query_seconds_total',
+            'Time spent in SQL statements, including background threads.'))
+slow_queries_total = registry.register(
+    Counter('lieferspatz_db_slow_queries_total',
+            f'Statements slower than {SLOW_QUERY_MS:g}ms by endpoint.',
+            ('endpoint', )))
+connections_opened_total = registry.register(
+    Counter('lieferspatz_db_connections_opened_total',
+            'SQLite connections opened.'))
+
+
+# statements a writer job runs on behalf of a request (or a background
+# thread): counted on the writer thread and added to the submitter's numbers
+# once it has the job's result
+class JobStats:
+
+  def __init__(self, endpoint):
+    self.endpoint = endpoint
+    self.queries = 0
+    self.seconds = 0.0
+
+
+_job = threading.local()
+
+
+# statements run on this thread inside the block are counted in `stats`
+@contextmanager
+def job(stats):
+  _job.stats = stats
+  try:
+    yield
+  finally:
+    _job.stats = None
+
+
+# counted by the submitting request like its own statements
+def add_job(stats):
+  if stats is not None and has_app_context():
+    g.sql_queries = g.get('sql_queries', 0) + stats.queries
+    g.sql_seconds = g.get('sql_seconds', 0.0) + stats.seconds
+
+
+def _endpoint():
+  if has_request_context():
+    return request.endpoint or 'unmatched'
+  stats = getattr(_job, 'stats', None)
+  if stats is not None:
+    return stats.endpoint
+  return threading.current_thread().name
+
+
+# who is asking, for attributing work done elsewhere on its behalf
+def current_endpoint():
+  return _endpoint()
+
+
+# describes parameters without their values, which may be passwords
+def params_shape(params, many=False):
+  if many:
+    return f'executemany x{len(params)}' if hasattr(params,
+                                                    '__len__') else 'executemany'
+  if isinstance(params, dict):
+    return '{' + ', '.join(
+        f'{key}: {type(value).__name__}' for key, value in params.items()) + '}'
+  return '(' + ', '.join(type(value).__name__ for value in params) + ')'
+
+
+# called by db.InstrumentedConnection for every statement
+def record_query(sql, params, seconds, many=False):
+  queries_total.inc()
+  query_seconds_total.inc(amount=seconds)
+  if has_app_context():
+    g.sql_queries = g.get('sql_queries', 0) + 1
+    g.sql_seconds = g.get('sql_seconds', 0.0) + seconds
+  else:
+    stats = getattr(_job, 'stats', None)
+    if stats is not None:
+      stats.queries += 1
+      stats.seconds += seconds
+  if seconds * 1000 >= SLOW_QUERY_MS:
+    endpoint = _endpoint()
+    slow_queries_total.inc(endpoint)
+    log.warning('slow query %.1fms route=%s params=%s sql=%s', seconds * 1000,
+                endpoint, params_shape(params, many), ' '.join(sql.split()))
+
+
+def _before_request():
+  g.request_started = time.perf_counter()
+  g.sql_queries = 0
+  g.sql_seconds = 0.0
+
+
+def _after_request(response):
+  started = g.get('request_started')
+  if started is not None:
+    endpoint = request.endpoint or 'unmatched'
+    request_seconds.observe(time.perf_counter() - started, endpoint)
+    request_queries.observe(g.get('sql_queries', 0), endpoint)
+    request_db_seconds.observe(g.get('sql_seconds', 0.0), endpoint)
+    requests_total.inc(endpoint, response.status_code)
+  return response
+
+
+def init_app(app):
+  app.before_request(_before_request)
+  app.after_request(_after_request)
@@ -0,0 +1,139 @@
+import logging
+import sys
+
+import analytics
+import archive
+import db
+import eta
+import events
+import prep
+import search
+
+log = logging.getLogger(__name__)
+
+
+def add_column(table, column, declaration):
+
+  def step(conn):
+    columns = [row[1] for row in conn.execute(f'PRAGMA table_info({table})')]
+    if column not in columns:
+      conn.execute(f'ALTER TABLE {table} ADD COLUMN {column} {declaration}')
+
+  return step
+
+
+# ordered schema migrations. The database records the last applied version in
+# PRAGMA user_version; every entry above it runs once, in its own transaction.
+# A step is either a SQL statement or a callable taking the connection.
+MIGRATIONS = [
+    (1, 'hot path indexes', [
+        'CREATE INDEX IF NOT EXISTS idx_postcodes_postcode '
+        'ON PostCodes(PostCode, RestaurantID)',
+        'CREATE INDEX IF NOT EXISTS idx_orders_restaurant '
+        'ON Orders(RestaurantId, Status, Order_Time)',
+        'CREATE INDEX IF NOT EXISTS idx_orders_customer '
+        'ON Orders(CustomerId, Status, Order_Time)',
+        'CREATE INDEX IF NOT EXISTS idx_contains_menu '
+        'ON contains(MenuID, ItemID)',
+        'CREATE INDEX IF NOT EXISTS idx_orderitem_order '
+        'ON OrderItem(OrderId, ItemID, Quantity)',
+        'CREATE INDEX IF NOT EXISTS idx_hasmenu_restaurant '
+        'ON hasMenu(RestaurantID, MenuID)',
+        'CREATE UNIQUE INDEX IF NOT EXISTS idx_customer_id '
+        'ON Customer(CustomerID)',
+        'CREATE UNIQUE INDEX IF NOT EXISTS idx_restaurant_id '
+        'ON Restaurant(RestaurantID)',
+    ]),
+    (2, 'unique account emails', [
+        'CREATE UNIQUE INDEX IF NOT EXISTS idx_accountholder_email '
+        'ON AccountHolder(Email)',
+    ]),
+    (3, 'server-side carts', [
+        """CREATE TABLE IF NOT EXISTS Cart (
+          CustomerId INTEGER NOT NULL PRIMARY KEY,
+          RestaurantId INTEGER,
+          Items TEXT NOT NULL,
+          AdditionalText TEXT,
+          UpdatedAt REAL NOT NULL
+        )""",
+        'CREATE INDEX IF NOT EXISTS idx_cart_updated ON Cart(UpdatedAt)',
+    ]),
+    (4, 'idempotent order placement', [
+        add_column('Orders', 'IdempotencyKey', 'TEXT'),
+        'CREATE UNIQUE INDEX IF NOT EXISTS idx_orders_idempotency '
+        'ON Orders(CustomerId, IdempotencyKey) '
+        'WHERE IdempotencyKey IS NOT NULL',
+    ]),
+    (5, 'resized picture variants', [
+        add_column('Restaurant', 'PictureThumb', 'TEXT'),
+        add_column('Restaurant', 'PictureMedium', 'TEXT'),
+        add_column('Items', 'PictureThumb', 'TEXT'),
+        add_column('Items', 'PictureMedium', 'TEXT'),
+    ]),
+    (6, 'daily sales rollups', [
+        analytics.DAILY_SALES_TABLE,
+        analytics.DAILY_ITEM_SALES_TABLE,
+        analytics.rebuild,
+    ]),
+    (7, 'order history by time', [
+        'CREATE INDEX IF NOT EXISTS idx_orders_restaurant_time '
+        'ON Orders(RestaurantId, Order_Time, OrderId)',
+        'CREATE INDEX IF NOT EXISTS idx_orders_customer_time '
+        'ON Orders(CustomerId, Order_Time, OrderId)',
+    ]),
+    (8, 'full-text search', search.SEARCH_SCHEMA + [search.rebuild]),
+    (9, 'delivery estimates', [
+        add_column('Orders', 'PreparingAt', 'TEXT'),
+        add_column('Orders', 'CompletedAt', 'TEXT'),
+        'CREATE INDEX IF NOT EXISTS idx_orders_active ON Orders(RestaurantId) '
+        "WHERE Status IN ('Processing', 'Preparing')",
+        'CREATE INDEX IF NOT EXISTS idx_orders_completed '
+        'ON Orders(CompletedAt, RestaurantId) WHERE CompletedAt IS NOT NULL',
+    ]),
+    (10, 'order archive', archive.ARCHIVE_SCHEMA),
+    (11, 'kitchen prep list', [prep.PREP_LIST_TABLE, prep.rebuild]),
+    (12, 'shared event log', [events.EVENTS_TABLE, events.EVENTS_INDEX]),
+    (13, 'shared kitchen stats', [eta.KITCHEN_STATS_TABLE, eta.rebuild]),
+    (14, 'last order on the cart', [
+        add_column('Cart', 'LastKey', 'TEXT'),
+        add_column('Cart', 'LastOrderId', 'INTEGER'),
+    ]),
+]
+
+
+def current_version(conn):
+  return conn.execute('PRAGMA user_version').fetchone()[0]
+
+
+def upgrade(conn=None, target=None):
+  own = conn is None
+  if own:
+    conn = db.open_connection()
+  try:
+    version = current_version(conn)
+    for number, description, steps in MIGRATIONS:
+      if number <= version or (target is not None and number > target):
+        continue
+      log.info('applying migration %d: %s', number, description)
+      conn.execute('BEGIN IMMEDIATE')
+      try:
+        for step in steps:
+          if callable(step):
+            step(conn)
+          else:
+            conn.execute(step)
+        conn.execute(f'PRAGMA user_version = {int(number)}')
+        conn.commit()
+      except Exception:
+        conn.rollback()
+        raise
+      version = number
+    return version
+  finally:
+    if own:
+      conn.close()
+
+
+if __name__ == '__main__':
+  logging.basicConfig(level=logging.INFO, format='%(message)s')
+  upgrade(target=int(sys.argv[1]) if len(sys.argv) > 1 else None)
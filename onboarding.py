@@ -0,0 +1,178 @@
+import json
+import os
+import re
+import sqlite3
+import time
+
+import db
+from credentials import hash_passwords
+from discovery import parse_minutes
+from images import submit_restaurant_picture
+from menu_bulk import read_rows
+from writer import write
+
+DEFAULT_PICTURE = 'default restaurant.jpg'
+EMAIL = re.compile(r'^[^@\s]+@[^@\s]+\.[^@\s]+$')
+
+
+def _postcode(value):
+  try:
+    return int(str(value).strip())
+  except ValueError:
+    raise ValueError(f'invalid postcode {value!r}') from None
+
+
+# shared by the registration form and the bulk import; takes any mapping
+# with the form's field names and returns the cleaned values, or raises
+# ValueError with a message fit for the user
+def validate_restaurant(fields):
+  values = {}
+  for key in ('name', 'email', 'password', 'address', 'postcode',
+              'opening_time', 'closing_time', 'postcodes'):
+    value = fields.get(key)
+    if value is None or (isinstance(value, str) and not value.strip()):
+      raise ValueError(f'{key} is required')
+    values[key] = value.strip() if isinstance(value, str) else value
+  values['description'] = str(fields.get('description') or '').strip()
+  if not EMAIL.match(values['email']):
+    raise ValueError(f'invalid email {values["email"]!r}')
+  for key in ('opening_time', 'closing_time'):
+    if parse_minutes(values[key]) is None:
+      raise ValueError(f'{key} must be HH:MM')
+  values['postcode'] = _postcode(values['postcode'])
+  postcodes = values['postcodes']
+  if isinstance(postcodes, str):
+    postcodes = re.split(r'[,;\s]+', postcodes.strip())
+  values['postcodes'] = sorted({_postcode(p) for p in postcodes if str(p)})
+  if not values['postcodes']:
+    raise ValueError('postcodes is required')
+  return values
+
+
+def existing_emails(conn, emails):
+  emails = list(emails)
+  if not emails:
+    return set()
+  rows = conn.execute(
+      'SELECT Email FROM AccountHolder '
+      'WHERE Email IN (SELECT value FROM json_each(?))',
+      (json.dumps(emails), )).fetchall()
+  return {row['Email'] for row in rows}
+
+
+# writer job for one chunk: AccountHolder, Restaurant and PostCodes each
+# filled by a single executemany
+def insert_restaurants(conn, restaurants):
+  ids = db.reserve_ids(conn, 'AccountHolder', 'ID', len(restaurants))
+  conn.executemany(
+      'INSERT INTO AccountHolder (ID, Email, Password, postcode, Address) '
+      'VALUES (?, ?, ?, ?, ?)',
+      [(rid, r['email'], r['password'], r['postcode'], r['address'])
+       for rid, r in zip(ids, restaurants, strict=True)])
+  conn.executemany(
+      'INSERT INTO Restaurant (RestaurantID, OpeningTime, ClosingTime, '
+      'Description, Picture, RestaurantName) VALUES (?, ?, ?, ?, ?, ?)',
+      [(rid, r['opening_time'], r['closing_time'], r['description'],
+        DEFAULT_PICTURE, r['name'])
+       for rid, r in zip(ids, restaurants, strict=True)])
+  conn.executemany(
+      'INSERT INTO PostCodes (PostCode, RestaurantID) VALUES (?, ?)',
+      [(postcode, rid) for rid, r in zip(ids, restaurants, strict=True)
+       for postcode in r['postcodes']])
+  return list(ids)
+
+
+class Onboarding:
+
+  def __init__(self, upload_folder, images_dir=None, chunk_size=500,
+               log=print):
+    self.upload_folder = upload_folder
+    self.images_dir = images_dir
+    self.chunk_size = chunk_size
+    self.log = log
+    self.read = 0
+    self.added = 0
+    self.skipped = 0
+    self.failed = 0
+    self._seen = set()
+    self._pictures = []
+    self._started = time.perf_counter()
+
+  def run(self, path, fmt):
+    chunk = []
+    with open(path, 'rb') as f:
+      for line_no, row, error in read_rows(f, fmt):
+        self.read += 1
+        if error is None:
+          try:
+            chunk.append((line_no, validate_restaurant(row),
+                          (row.get('picture') or '').strip()))
+          except ValueError as e:
+            error = str(e)
+        if error is not None:
+          self._reject(line_no, error)
+        if len(chunk) >= self.chunk_size:
+          self._flush(chunk)
+          chunk = []
+    self._flush(chunk)
+    for restaurant_id, future in self._pictures:
+      if future.exception() is not None:
+        self.log(f'restaurant {restaurant_id}: picture failed: '
+                 f'{future.exception()}')
+    self._progress(final=True)
+
+  def _reject(self, line_no, error, failed=True):
+    if failed:
+      self.failed += 1
+    else:
+      self.skipped += 1
+    self.log(f'line {line_no}: {error}')
+
+  def _flush(self, chunk):
+    if not chunk:
+      return
+    taken = existing_emails(db.connect_db(),
+                            {values['email'] for _, values, _ in chunk})
+    fresh = []
+    for line_no, values, picture in chunk:
+      if values['email'] in taken or values['email'] in self._seen:
+        self._reject(line_no, f'{values["email"]} already exists', False)
+        continue
+      self._seen.add(values['email'])
+      fresh.append((line_no, values, picture))
+    if fresh:
+      hashed = hash_passwords(values['password'] for _, values, _ in fresh)
+      for (_, values, _), password in zip(fresh, hashed, strict=True):
+        values['password'] = password
+      try:
+        ids = write(insert_restaurants, [values for _, values, _ in fresh])
+      except sqlite3.IntegrityError as e:
+        # an email registered between the check and the write
+        for line_no, _, _ in fresh:
+          self._reject(line_no, f'chunk not imported: {e}')
+      else:
+        self.added += len(ids)
+        for restaurant_id, (line_no, _, picture) in zip(ids, fresh,
+                                                        strict=True):
+          self._submit_picture(line_no, restaurant_id, picture)
+    self._progress()
+
+  def _submit_picture(self, line_no, restaurant_id, picture):
+    if not picture:
+      return
+    path = os.path.join(self.images_dir or '', picture)
+    try:
+      with open(path, 'rb') as f:
+        self._pictures.append(
+            (restaurant_id,
+             submit_restaurant_picture(f, self.upload_folder,
+                                       restaurant_id)))
+    except OSError as e:
+      self.log(f'line {line_no}: picture not imported: {e}')
+
+  def _progress(self, final=False):
+    elapsed = time.perf_counter() - self._started
+    rate = self.read / elapsed if elapsed else 0
+    self.log(f'{"done: " if final else ""}{self.read} rows, '
+             f'{self.added} added, {self.skipped} skipped, '
+             f'{self.failed} failed, {rate:.0f} rows/s')
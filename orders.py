@@ -0,0 +1,289 @@
+import csv
+import heapq
+import io
+import os
+from datetime import datetime
+
+import db
+import prep
+from analytics import order_day, record_order, record_status_change
+from archive import archived, newest_archived
+from cart import check_out_cart, price_cart
+from eta import delivery_estimator, format_eta, parse_time
+
+ACTIVE_STATUSES = ('Processing', 'Preparing')
+TERMINAL_STATUSES = ('Complete', 'Canceled')
+PAGE_SIZE = int(os.environ.get('ORDER_PAGE_SIZE', 20))
+
+# upper bound used when no cursor is given; sorts after every Order_Time
+_FIRST_PAGE = ('9999-12-31', 2**62)
+
+
+# one round-trip per dashboard: open orders are listed in full, the terminal
+# ones are keyset-paginated on (Order_Time, OrderId) so the cost of a page
+# does not depend on how much history the party has
+def _dashboard_sql(party_column, time_expr):
+  terminal = """
+  SELECT * FROM (
+    SELECT TotalCost, OrderId, {time} as Order_Time, Status,
+      Order_Time as sort_time
+    FROM Orders WHERE {party} = :party AND Status = '{status}'
+      AND (Orders.Order_Time, OrderId) < (:{key}_time, :{key}_id)
+    ORDER BY Orders.Order_Time DESC, OrderId DESC LIMIT :page_size)"""
+  active = """
+  SELECT * FROM (
+    SELECT TotalCost, OrderId, {time} as Order_Time, Status,
+      Order_Time as sort_time
+    FROM Orders WHERE {party} = :party
+      AND Status IN ('Processing', 'Preparing'))"""
+  parts = [active] + [
+      terminal.replace('{status}', status).replace('{key}', status.lower())
+      for status in TERMINAL_STATUSES
+  ]
+  sql = """
+  UNION ALL""".join(parts) + """
+  ORDER BY sort_time DESC, OrderId DESC"""
+  return sql.format(party=party_column, time=time_expr)
+
+
+RESTAURANT_DASHBOARD_SQL = _dashboard_sql('RestaurantId',
+                                          'datetime(Order_Time)')
+CUSTOMER_DASHBOARD_SQL = _dashboard_sql(
+    'CustomerId', "strftime('%d/%m/%Y %H:%M',Order_Time)")
+
+
+# one terminal-status page from the archive, for when the hot rows of that
+# status run out before the page is full
+def _archive_page_sql(party_column, time_expr):
+  return f"""SELECT TotalCost, OrderId, {time_expr} as Order_Time, Status,
+    Order_Time as sort_time
+  FROM archive.Orders AS Orders WHERE {party_column} = :party
+    AND Status = :status
+    AND (Orders.Order_Time, OrderId) < (:before_time, :before_id)
+  ORDER BY Orders.Order_Time DESC, OrderId DESC LIMIT :page_size"""
+
+
+RESTAURANT_ARCHIVE_PAGE_SQL = _archive_page_sql('RestaurantId',
+                                                'datetime(Order_Time)')
+CUSTOMER_ARCHIVE_PAGE_SQL = _archive_page_sql(
+    'CustomerId', "strftime('%d/%m/%Y %H:%M',Order_Time)")
+
+
+def encode_cursor(row):
+  return f"{row['sort_time']}|{row['OrderId']}"
+
+
+def decode_cursor(token):
+  try:
+    order_time, order_id = token.rsplit('|', 1)
+    return order_time, int(order_id)
+  except (AttributeError, ValueError):
+    return _FIRST_PAGE
+
+
+# returns ({status: [rows]}, {terminal status: cursor of the next page}).
+# The archive is only read for a status whose hot rows did not fill the page.
+def load_dashboard(conn, sql, archive_sql, party_id, cursors,
+                   page_size=PAGE_SIZE):
+  params = {'party': int(party_id), 'page_size': page_size + 1}
+  for status in TERMINAL_STATUSES:
+    key = status.lower()
+    params[f'{key}_time'], params[f'{key}_id'] = decode_cursor(
+        cursors.get(status))
+
+  groups = {status: [] for status in ACTIVE_STATUSES + TERMINAL_STATUSES}
+  for row in conn.execute(sql, params):
+    groups.setdefault(row['Status'], []).append(row)
+
+  next_cursors = {}
+  for status in TERMINAL_STATUSES:
+    rows = groups[status]
+    if len(rows) <= page_size:
+      key = status.lower()
+      older = conn.execute(
+          archive_sql, {
+              'party': int(party_id),
+              'status': status,
+              'before_time': params[f'{key}_time'],
+              'before_id': params[f'{key}_id'],
+              'page_size': page_size + 1
+          }).fetchall()
+      # an order being archived can briefly be in both
+      hot = {row['OrderId'] for row in rows}
+      rows += [row for row in older if row['OrderId'] not in hot]
+      rows.sort(key=lambda row: (row['sort_time'], row['OrderId']),
+                reverse=True)
+    if len(rows) > page_size:
+      del rows[page_size:]
+      next_cursors[status] = encode_cursor(rows[-1])
+    else:
+      next_cursors[status] = None
+  return groups, next_cursors
+
+
+HISTORY_CHUNK = int(os.environ.get('ORDER_EXPORT_CHUNK', 1000))
+HISTORY_COLUMNS = ('order_id', 'order_time', 'status', 'customer_id',
+                   'restaurant_id', 'restaurant_name', 'total_cost',
+                   'additional_text', 'item_id', 'item_name', 'quantity',
+                   'unit_price')
+
+
+# one row per order line in time order, walked along the party's
+# (party, Order_Time, OrderId) index so nothing has to be sorted first.
+# `+Orders.OrderId` drops the integer affinity so the untyped
+# OrderItem.OrderId index can be used for the join.
+def _history_sql(party_column):
+  return f"""SELECT Orders.OrderId, Orders.Order_Time, Orders.Status,
+    Orders.CustomerId, Orders.RestaurantId, Restaurant.RestaurantName,
+    Orders.TotalCost, Orders.AdditionalText, OrderItem.ItemID,
+    Items.ItemName, OrderItem.Quantity, Items.Price
+  FROM Orders
+  JOIN OrderItem ON OrderItem.OrderId = +Orders.OrderId
+  LEFT JOIN Items ON Items.ItemID = OrderItem.ItemID
+  LEFT JOIN Restaurant ON Restaurant.RestaurantID = Orders.RestaurantId
+  WHERE Orders.{party_column} = :party
+    AND Orders.Order_Time >= :start AND Orders.Order_Time < :end
+  ORDER BY Orders.Order_Time, Orders.OrderId"""
+
+
+RESTAURANT_HISTORY_SQL = _history_sql('RestaurantId')
+CUSTOMER_HISTORY_SQL = _history_sql('CustomerId')
+RESTAURANT_ARCHIVE_HISTORY_SQL = archived(RESTAURANT_HISTORY_SQL)
+CUSTOMER_ARCHIVE_HISTORY_SQL = archived(CUSTOMER_HISTORY_SQL)
+
+
+def _history_rows(conn, sql, params):
+  cursor = conn.execute(sql, params)
+  while True:
+    rows = cursor.fetchmany(HISTORY_CHUNK)
+    if not rows:
+      return
+    yield from rows
+
+
+# both sides are in (Order_Time, OrderId) order; an order being archived can
+# briefly be in both, and then its hot rows win
+def _merge_archive(hot, cold):
+  last_hot = None
+  for source, row in heapq.merge(
+      ((0, row) for row in hot), ((1, row) for row in cold),
+      key=lambda item: (item[1]['Order_Time'], item[1]['OrderId'], item[0])):
+    if source == 0:
+      last_hot = row['OrderId']
+    elif row['OrderId'] == last_hot:
+      continue
+    yield row
+
+
+# yields the history as CSV text, HISTORY_CHUNK rows at a time, so memory
+# stays flat however long it is. `start`/`end` are ISO dates, end exclusive.
+# The archive is only read when the range reaches back to archived orders.
+# Reads on a private connection that lives as long as the download.
+def export_history(sql, archive_sql, party_id, start='0000-01-01',
+                   end='9999-12-31'):
+  conn = db.open_connection()
+  try:
+    params = {'party': int(party_id), 'start': start, 'end': end}
+    rows = _history_rows(conn, sql, params)
+    newest = newest_archived(conn)
+    if newest is not None and start <= newest:
+      rows = _merge_archive(rows, _history_rows(conn, archive_sql, params))
+    out = io.StringIO()
+    writer = csv.writer(out)
+    writer.writerow(HISTORY_COLUMNS)
+    for count, row in enumerate(rows, 1):
+      writer.writerow(tuple(row))
+      if count % HISTORY_CHUNK == 0:
+        yield out.getvalue()
+        out.seek(0)
+        out.truncate()
+    if out.tell():
+      yield out.getvalue()
+  finally:
+    conn.close()
+
+
+class OrderError(Exception):
+  pass
+
+
+class EmptyCart(OrderError):
+  pass
+
+
+class ItemNotOnMenu(OrderError):
+  pass
+
+
+# places the customer's cart as one order. Must run inside
+# db.transaction(conn). A key that was already used returns the order it
+# created instead of placing a second one. Returns (order_id, created)
+def place_order(conn, customer_id, restaurant_id, cart, idempotency_key=None):
+  customer_id = int(customer_id)
+  if idempotency_key is not None:
+    existing = conn.execute(
+        'SELECT OrderId FROM Orders WHERE CustomerId = ? AND IdempotencyKey = ?',
+        (customer_id, idempotency_key)).fetchone()
+    if existing:
+      return existing['OrderId'], False
+
+  if not cart:
+    raise EmptyCart()
+  if restaurant_id is None:
+    # without a restaurant nothing can be checked against a menu
+    raise ItemNotOnMenu(sorted(cart.items))
+  lines, total = price_cart(conn, cart, restaurant_id)
+  if len(lines) != len(cart.items):
+    missing = set(cart.items) - {line['item'] for line in lines}
+    raise ItemNotOnMenu(sorted(missing))
+
+  now = datetime.now()
+  eta = delivery_estimator.order_placed(conn, restaurant_id, now)
+  order_id = conn.execute(
+      """INSERT INTO Orders(CustomerId, RestaurantId,
+      Status, AdditionalText, EstimatedDeliveryTime,
+      TotalCost, Order_Time, IdempotencyKey)
+        VALUES(? , ? , ? , ? ,?, ? , ?, ?)""",
+      (customer_id, int(restaurant_id), 'Processing', cart.additional_text
+       or '', format_eta(eta), total, now, idempotency_key)).lastrowid
+  conn.executemany(
+      'INSERT INTO OrderItem(OrderId, ItemID, Quantity) VALUES(?, ?, ?)',
+      [(order_id, line['item'], line['quantity']) for line in lines])
+  order_lines = [(line['item'], line['quantity']) for line in lines]
+  record_order(conn, restaurant_id, order_day(now), total, order_lines)
+  prep.record_lines(conn, restaurant_id, 'Processing', order_lines)
+  check_out_cart(conn, customer_id, idempotency_key, order_id)
+  return order_id, True
+
+
+# moves an order to new_status, stamping when the kitchen started and
+# completed it and refreshing the delivery estimate. Returns the order's
+# customer and previous status, or None if the order does not belong to the
+# restaurant
+def update_status(conn, order_id, restaurant_id, new_status):
+  order = conn.execute(
+      'SELECT CustomerId, RestaurantId, Status, TotalCost, Order_Time, '
+      'PreparingAt FROM Orders WHERE OrderId = ? AND RestaurantId = ?',
+      (int(order_id), int(restaurant_id))).fetchone()
+  if order is None:
+    return None
+  if order['Status'] == new_status:
+    return order['CustomerId'], order['Status']
+  now = datetime.now()
+  started = parse_time(order['PreparingAt'] or order['Order_Time'])
+  eta = format_eta(
+      delivery_estimator.status_changed(conn, restaurant_id, order['Status'],
+                                        new_status, started, now))
+  # a NULL stamp keeps the stored one
+  conn.execute(
+      """UPDATE Orders SET Status = ?,
+        PreparingAt = COALESCE(?, PreparingAt),
+        CompletedAt = COALESCE(?, CompletedAt), EstimatedDeliveryTime = ?
+      WHERE OrderId = ? AND RestaurantId = ?""",
+      (new_status, now if new_status == 'Preparing' else None,
+       now if new_status == 'Complete' else None, eta, int(order_id),
+       int(restaurant_id)))
+  record_status_change(conn, order_id, order, order['Status'], new_status)
+  prep.record_status_change(conn, order_id, restaurant_id, order['Status'],
+                            new_status)
+  return order['CustomerId'], order['Status']
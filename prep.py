@@ -0,0 +1,117 @@
+STAGES = ('Processing', 'Preparing')
+
+# per restaurant, stage and item: how many portions the open orders in that
+# stage still need. Kept up to date by place_order/update_status, so the
+# kitchen's list costs one row per distinct item however many orders are
+# open. Rows that drop to zero are deleted.
+PREP_LIST_TABLE = """CREATE TABLE IF NOT EXISTS PrepList (
+  RestaurantId INTEGER NOT NULL,
+  Stage TEXT NOT NULL,
+  ItemID INTEGER NOT NULL,
+  Quantity INTEGER NOT NULL,
+  PRIMARY KEY (RestaurantId, ItemID, Stage)
+) WITHOUT ROWID"""
+
+PREP_LIST_SQL = """SELECT PrepList.ItemID, Items.ItemName, PrepList.Stage,
+    PrepList.Quantity
+  FROM PrepList JOIN Items ON Items.ItemID = PrepList.ItemID
+  WHERE PrepList.RestaurantId = ?"""
+# the current counts of the items in one order, for the update pushed to
+# the dashboard after the order changed
+ORDER_PREP_SQL = """SELECT OrderItem.ItemID, Items.ItemName, PrepList.Stage,
+    PrepList.Quantity
+  FROM OrderItem
+  LEFT JOIN Items ON Items.ItemID = OrderItem.ItemID
+  LEFT JOIN PrepList ON PrepList.RestaurantId = :restaurant
+    AND PrepList.ItemID = OrderItem.ItemID
+  WHERE OrderItem.OrderId = :order"""
+
+
+# adds (sign=1) or removes (sign=-1) order lines, (item id, quantity)
+# pairs, to or from a stage. Must run inside the order's write transaction.
+def record_lines(conn, restaurant_id, stage, lines, sign=1):
+  keys = [(int(restaurant_id), stage, item) for item, _ in lines]
+  conn.executemany(
+      """INSERT INTO PrepList (RestaurantId, Stage, ItemID, Quantity)
+      VALUES (?, ?, ?, ?)
+      ON CONFLICT(RestaurantId, ItemID, Stage) DO UPDATE SET
+        Quantity = Quantity + excluded.Quantity""",
+      [key + (sign * quantity, )
+       for key, (_, quantity) in zip(keys, lines, strict=True)])
+  if sign < 0:
+    conn.executemany(
+        'DELETE FROM PrepList WHERE RestaurantId = ? AND Stage = ? '
+        'AND ItemID = ? AND Quantity <= 0', keys)
+
+
+# moves an order's lines out of its old stage and into the new one; orders
+# leaving Processing/Preparing leave the list
+def record_status_change(conn, order_id, restaurant_id, old_status,
+                         new_status):
+  if old_status == new_status or (old_status not in STAGES
+                                  and new_status not in STAGES):
+    return
+  lines = [
+      tuple(line) for line in conn.execute(
+          'SELECT ItemID, Quantity FROM OrderItem WHERE OrderItem.OrderId = ?',
+          (int(order_id), ))
+  ]
+  if old_status in STAGES:
+    record_lines(conn, restaurant_id, old_status, lines, -1)
+  if new_status in STAGES:
+    record_lines(conn, restaurant_id, new_status, lines)
+
+
+# recomputes the list from the open orders; the backfill for existing data
+# and the repair tool if it ever drifts
+def rebuild(conn):
+  conn.execute('/* scan-ok */ DELETE FROM PrepList')
+  conn.execute("""/* scan-ok */ INSERT INTO PrepList
+    (RestaurantId, Stage, ItemID, Quantity)
+    SELECT Orders.RestaurantId, Orders.Status, OrderItem.ItemID,
+      SUM(OrderItem.Quantity)
+    FROM Orders JOIN OrderItem ON OrderItem.OrderId = +Orders.OrderId
+    WHERE Orders.Status IN ('Processing', 'Preparing')
+    GROUP BY 1, 2, 3
+    HAVING SUM(OrderItem.Quantity) > 0""")
+
+
+def _entry(item_id, name=None):
+  return {
+      'item_id': item_id,
+      'name': name,
+      'processing': 0,
+      'preparing': 0,
+      'total': 0
+  }
+
+
+def _add(entry, stage, quantity):
+  if stage in STAGES:
+    entry[stage.lower()] = quantity
+    entry['total'] += quantity
+
+
+# what to cook now: every item the open orders need, most needed first
+def prep_list(conn, restaurant_id):
+  items = {}
+  for row in conn.execute(PREP_LIST_SQL, (int(restaurant_id), )):
+    entry = items.setdefault(row['ItemID'],
+                             _entry(row['ItemID'], row['ItemName']))
+    _add(entry, row['Stage'], row['Quantity'])
+  return sorted(items.values(),
+                key=lambda entry: (-entry['total'], entry['name'] or ''))
+
+
+# the list entries of the items in one order, with zero counts for items
+# that left the list, so a dashboard can replace just those entries
+def order_entries(conn, restaurant_id, order_id):
+  items = {}
+  for row in conn.execute(ORDER_PREP_SQL, {
+      'restaurant': int(restaurant_id),
+      'order': int(order_id)
+  }):
+    entry = items.setdefault(row['ItemID'],
+                             _entry(row['ItemID'], row['ItemName']))
+    _add(entry, row['Stage'], row['Quantity'])
+  return list(items.values())
@@ -0,0 +1,143 @@
+import ast
+import glob
+import os
+import re
+import sys
+
+import archive
+import db
+
+# SQL that is allowed to read a whole table (tiny lookup tables, offline
+# rebuild jobs) carries this marker in its text
+SCAN_OK = '/* scan-ok */'
+
+# a virtual table (FTS5) "scan" with a constraint, e.g. INDEX 32:M2 for a
+# MATCH, is an index lookup; a bare "INDEX 0:" reads every row
+VIRTUAL_LOOKUP = re.compile(r'VIRTUAL TABLE INDEX \d+:\S')
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+CHECKED = ('SELECT', 'WITH', 'UPDATE', 'DELETE', 'INSERT')
+
+
+# the constant text of SQL given as a literal or built with an f-string,
+# % or + (None for anything else, e.g. a variable)
+def _literal_text(node):
+  if isinstance(node, ast.Constant):
+    return node.value if isinstance(node.value, str) else None
+  if isinstance(node, ast.JoinedStr):
+    return ''.join(value.value for value in node.values
+                   if isinstance(value, ast.Constant))
+  if isinstance(node, ast.BinOp) and isinstance(node.op, (ast.Mod, ast.Add)):
+    left, right = _literal_text(node.left), _literal_text(node.right)
+    if left is None and right is None:
+      return None
+    return (left or '') + (right or '')
+  if (isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute)
+      and node.func.attr == 'format'):
+    return _literal_text(node.func.value)
+  return None
+
+
+# every string literal passed as the SQL argument of .execute() in the
+# application modules, together with where it was found. A query given to
+# archive.fetch_with_archive() is also checked in its archive form. SQL
+# built at run time cannot be checked; such a call site is yielded with
+# None as its SQL unless the statement is marked scan-ok.
+def collect_queries(paths=None):
+  paths = paths or sorted(glob.glob(os.path.join(HERE, '*.py')))
+  for path in paths:
+    with open(path) as source:
+      tree = ast.parse(source.read(), path)
+    for node in ast.walk(tree):
+      if not (isinstance(node, ast.Call)
+              and isinstance(node.func, ast.Attribute)):
+        continue
+      if node.func.attr in ('execute', 'executemany') and node.args:
+        arg = node.args[0]
+      elif node.func.attr == 'fetch_with_archive' and len(node.args) > 1:
+        arg = node.args[1]
+      else:
+        continue
+      text = _literal_text(arg)
+      if text is None or not text.strip():
+        continue
+      sql = text.strip()
+      if sql.split(None, 1)[0].upper() not in CHECKED:
+        continue
+      if sql.upper().startswith('INSERT') and 'SELECT' not in sql.upper():
+        continue
+      if not isinstance(arg, ast.Constant):
+        if SCAN_OK not in sql:
+          yield os.path.relpath(path, HERE), node.lineno, None
+        continue
+      yield os.path.relpath(path, HERE), node.lineno, sql
+      if node.func.attr == 'fetch_with_archive':
+        yield os.path.relpath(path, HERE), node.lineno, archive.archived(sql)
+
+
+# statements assembled at import time cannot be read from the source, so
+# loaded app modules also expose them as module-level *_SQL strings
+def collect_module_queries():
+  for _, module in sorted(sys.modules.items()):
+    path = getattr(module, '__file__', None) or ''
+    if os.path.dirname(os.path.abspath(path)) != HERE:
+      continue
+    for attr, value in sorted(vars(module).items()):
+      if attr.endswith('_SQL') and isinstance(value, str):
+        yield os.path.relpath(path, HERE), attr, value.strip()
+
+
+def _placeholders(sql):
+  named = re.findall(r':(\w+)', sql)
+  if named:
+    return dict.fromkeys(named)
+  return (None, ) * sql.count('?')
+
+
+def full_scans(conn, sql):
+  plan = conn.execute('EXPLAIN QUERY PLAN ' + sql,
+                      _placeholders(sql)).fetchall()
+  # reading back a subquery the plan already built is not a table scan
+  built = {
+      row['detail'].split(None, 1)[1]
+      for row in plan
+      if row['detail'].startswith(('MATERIALIZE ', 'CO-ROUTINE '))
+  }
+  return [
+      row['detail'] for row in plan if row['detail'].startswith('SCAN ')
+      # json_each walks a parameter array, not a table
+      and not row['detail'].startswith(
+          ('SCAN CONSTANT ROW', 'SCAN (', 'SCAN json_each'))
+      and not VIRTUAL_LOOKUP.search(row['detail'])
+      and row['detail'][len('SCAN '):] not in built
+  ]
+
+
+def check(conn=None, out=sys.stdout):
+  own = conn is None
+  if own:
+    conn = db.open_connection()
+  failures = 0
+  import main  # noqa: F401 -- loads every app module
+  queries = list(collect_queries()) + list(collect_module_queries())
+  try:
+    for path, line, sql in queries:
+      if sql is None:
+        failures += 1
+        out.write(f'{path}:{line}: SQL built at run time is not checked; '
+                  'use a literal or a *_SQL constant\n')
+        continue
+      if SCAN_OK in sql:
+        continue
+      scans = full_scans(conn, sql)
+      if scans:
+        failures += 1
+        out.write(f'{path}:{line}: {"; ".join(scans)}\n')
+  finally:
+    if own:
+      conn.close()
+  return failures
+
+
+if __name__ == '__main__':
+  sys.exit(1 if check() else 0)
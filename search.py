@@ -0,0 +1,171 @@
+import json
+import os
+import re
+
+from discovery import restaurant_index
+
+MAX_RESULTS = int(os.environ.get('SEARCH_MAX_RESULTS', 50))
+MAX_TERMS = 8
+
+# one FTS5 row per live menu item (rowid = 2 * ItemID) and per restaurant
+# (rowid = 2 * RestaurantID + 1), so triggers can replace a row by rowid
+# without searching for it. `area` lists the postcodes the restaurant
+# delivers to as tokens ('p47057'), so the delivery filter is a single
+# posting list intersected inside the index.
+AREA = """(SELECT COALESCE(group_concat('p' || PostCode, ' '), '')
+  FROM PostCodes WHERE PostCodes.RestaurantID = {})"""
+ITEM_ROWS = """SELECT Items.ItemID * 2, Items.ItemName, Items.ItemDescription,
+    hasMenu.RestaurantID, """ + AREA.format('hasMenu.RestaurantID')
+RESTAURANT_ROWS = """SELECT RestaurantID * 2 + 1, COALESCE(RestaurantName, ''),
+    COALESCE(Description, ''), RestaurantID, """ + AREA.format(
+    'Restaurant.RestaurantID')
+INSERT_ROWS = 'INSERT INTO SearchIndex(rowid, name, description, rid, area) '
+
+SEARCH_SCHEMA = [
+    """CREATE VIRTUAL TABLE IF NOT EXISTS SearchIndex USING fts5(
+      name, description, rid UNINDEXED, area,
+      tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3')""",
+    # names weigh most; the postcode tokens never contribute to the score
+    "INSERT INTO SearchIndex(SearchIndex, rank) "
+    "VALUES('rank', 'bm25(10.0, 2.0, 0.0, 0.0)')",
+    'CREATE INDEX IF NOT EXISTS idx_contains_item ON contains(ItemID, MenuID)',
+    'CREATE INDEX IF NOT EXISTS idx_postcodes_restaurant '
+    'ON PostCodes(RestaurantID, PostCode)',
+    f"""CREATE TRIGGER IF NOT EXISTS search_restaurant_insert
+    AFTER INSERT ON Restaurant BEGIN
+      {INSERT_ROWS} {RESTAURANT_ROWS}
+      FROM Restaurant WHERE Restaurant.RestaurantID = new.RestaurantID;
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS search_restaurant_update
+    AFTER UPDATE OF RestaurantName, Description ON Restaurant BEGIN
+      DELETE FROM SearchIndex WHERE rowid = old.RestaurantID * 2 + 1;
+      {INSERT_ROWS} {RESTAURANT_ROWS}
+      FROM Restaurant WHERE Restaurant.RestaurantID = new.RestaurantID;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS search_restaurant_delete
+    AFTER DELETE ON Restaurant BEGIN
+      DELETE FROM SearchIndex WHERE rowid = old.RestaurantID * 2 + 1;
+    END""",
+] + [
+    # a changed delivery area rewrites the restaurant's rows; this happens
+    # at registration, before the restaurant has a menu
+    f"""CREATE TRIGGER IF NOT EXISTS search_area_{event.lower()}
+    AFTER {event} ON PostCodes BEGIN
+      DELETE FROM SearchIndex WHERE rowid = {row}.RestaurantID * 2 + 1;
+      {INSERT_ROWS} {RESTAURANT_ROWS}
+      FROM Restaurant WHERE Restaurant.RestaurantID = {row}.RestaurantID;
+      DELETE FROM SearchIndex WHERE rowid IN (
+        SELECT contains.ItemID * 2 FROM hasMenu
+        JOIN contains ON contains.MenuID = hasMenu.MenuID
+        WHERE hasMenu.RestaurantID = {row}.RestaurantID);
+      {INSERT_ROWS} {ITEM_ROWS}
+      FROM hasMenu
+      JOIN contains ON contains.MenuID = hasMenu.MenuID
+      JOIN Items ON Items.ItemID = contains.ItemID
+      WHERE hasMenu.RestaurantID = {row}.RestaurantID
+        AND Items.isDeleted = 0;
+    END""" for event, row in (('INSERT', 'new'), ('DELETE', 'old'))
+] + [
+    # an item becomes searchable once it is linked to a menu
+    f"""CREATE TRIGGER IF NOT EXISTS search_item_menu
+    AFTER INSERT ON contains BEGIN
+      DELETE FROM SearchIndex WHERE rowid = new.ItemID * 2;
+      {INSERT_ROWS} {ITEM_ROWS}
+      FROM Items JOIN hasMenu ON hasMenu.MenuID = new.MenuID
+      WHERE Items.ItemID = new.ItemID AND Items.isDeleted = 0;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS search_item_unlink
+    AFTER DELETE ON contains BEGIN
+      DELETE FROM SearchIndex WHERE rowid = old.ItemID * 2;
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS search_item_update
+    AFTER UPDATE OF ItemName, ItemDescription, isDeleted ON Items BEGIN
+      DELETE FROM SearchIndex WHERE rowid = old.ItemID * 2;
+      {INSERT_ROWS} {ITEM_ROWS}
+      FROM contains
+      JOIN hasMenu ON hasMenu.MenuID = contains.MenuID
+      JOIN Items ON Items.ItemID = contains.ItemID
+      WHERE contains.ItemID = new.ItemID AND Items.isDeleted = 0;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS search_item_delete
+    AFTER DELETE ON Items BEGIN
+      DELETE FROM SearchIndex WHERE rowid = old.ItemID * 2;
+    END""",
+]
+
+
+# fills the index from scratch, for the migration and after a bulk repair
+def rebuild(conn):
+  conn.execute('/* scan-ok */ DELETE FROM SearchIndex')
+  conn.execute(f'/* scan-ok */ {INSERT_ROWS} {RESTAURANT_ROWS} FROM Restaurant')
+  conn.execute(f"""/* scan-ok */ {INSERT_ROWS} {ITEM_ROWS}
+    FROM Items
+    JOIN contains ON contains.ItemID = Items.ItemID
+    JOIN hasMenu ON hasMenu.MenuID = contains.MenuID
+    WHERE Items.isDeleted = 0""")
+
+
+# best matches first among the restaurants in :open (a JSON array of ids),
+# which is applied before the LIMIT so closed restaurants cannot crowd the
+# open ones out. The inner query ranks on rowids and rid alone; only the
+# rows that make the LIMIT have their other columns read and are joined to
+# Items.
+SEARCH_SQL = """SELECT hit.rowid as hit_id, SearchIndex.name,
+    SearchIndex.description, SearchIndex.rid, hit.rank,
+    Items.Price, Items.PictureThumb, Items.Picture
+  FROM (SELECT rowid, rank FROM SearchIndex
+        WHERE SearchIndex MATCH :query
+          AND rid IN (SELECT value FROM json_each(:open))
+        ORDER BY rank LIMIT :limit) as hit
+  JOIN SearchIndex ON SearchIndex.rowid = hit.rowid
+  LEFT JOIN Items ON Items.ItemID = hit.rowid / 2 AND hit.rowid % 2 = 0
+  ORDER BY hit.rank"""
+
+
+# builds an FTS5 query from free text: every word must match name or
+# description, the last one (from two letters on) as a prefix so results
+# appear while typing, and the row must deliver to the postcode
+def match_query(text, postcode):
+  terms = re.findall(r'\w+', text.lower())[:MAX_TERMS]
+  if not terms:
+    return None
+  words = [f'"{term}"' for term in terms]
+  if len(terms[-1]) > 1:
+    words[-1] += '*'
+  return (f'{{name description}} : ({" ".join(words)}) '
+          f'AND area : p{int(postcode)}')
+
+
+# dishes and restaurants matching `text` among the restaurants that deliver
+# to `postcode` and are open at the moment
+def search(conn, text, postcode, limit=MAX_RESULTS, now=None):
+  query = match_query(text, postcode)
+  if query is None:
+    return []
+  open_restaurants = {
+      row['RestaurantID']: row
+      for row in restaurant_index.open_now(postcode, now)
+  }
+  if not open_restaurants:
+    return []
+  results = []
+  for row in conn.execute(SEARCH_SQL, {
+      'query': query,
+      'open': json.dumps(list(open_restaurants)),
+      'limit': limit
+  }):
+    restaurant = open_restaurants[row['rid']]
+    is_item = row['hit_id'] % 2 == 0
+    results.append({
+        'type': 'item' if is_item else 'restaurant',
+        'id': row['hit_id'] // 2,
+        'name': row['name'],
+        'description': row['description'],
+        'restaurant_id': row['rid'],
+        'restaurant_name': restaurant.get('RestaurantName'),
+        'price': row['Price'] if is_item else None,
+        'picture': (row['PictureThumb'] or row['Picture']) if is_item else
+        (restaurant.get('PictureThumb') or restaurant.get('Picture')),
+        'score': round(-row['rank'], 4),
+    })
+  return results
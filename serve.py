@@ -0,0 +1,243 @@
+# Production entry point: loads and warms the app once, then forks worker
+# processes that each serve requests on a pool of threads.
+#
+#   WEB_WORKERS=8 WEB_THREADS=16 python3 serve.py
+#
+# Uses gunicorn (gthread workers, preload_app) when it is installed, and a
+# small built-in pre-fork server otherwise. Every setting comes from the
+# environment; see the names below.
+#
+# Behind a reverse proxy, set ADMISSION_PROXY_HOPS to the number of proxies
+# that append to X-Forwarded-For (see admission.py); otherwise every client
+# is rate limited as the proxy's address.
+import contextlib
+import gc
+import logging
+import os
+import random
+import signal
+import socket
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.serving import BaseWSGIServer
+
+HOST = os.environ.get('HOST', '0.0.0.0')
+PORT = int(os.environ.get('PORT', 8080))
+WORKERS = int(os.environ.get('WEB_WORKERS', os.cpu_count() or 1))
+THREADS = int(os.environ.get('WEB_THREADS', 8))
+# a worker is replaced after this many requests (0 = never), plus up to
+# MAX_REQUESTS_JITTER more so workers do not all restart at once
+MAX_REQUESTS = int(os.environ.get('MAX_REQUESTS', 10000))
+MAX_REQUESTS_JITTER = int(os.environ.get('MAX_REQUESTS_JITTER', 1000))
+# how long a stopping worker waits for in-flight requests (and open event
+# streams) before it exits anyway
+GRACEFUL_TIMEOUT = float(os.environ.get('GRACEFUL_TIMEOUT', 30))
+BACKLOG = int(os.environ.get('WEB_BACKLOG', 2048))
+# menus of the busiest restaurants built before forking
+WARM_MENUS = int(os.environ.get('WARM_MENUS', 100))
+SERVER = os.environ.get('WEB_SERVER', 'auto')  # auto, gunicorn or builtin
+
+log = logging.getLogger('serve')
+
+
+# everything that is the same in every worker is done once here, so the
+# forked workers share it copy-on-write instead of each paying for it
+def preload():
+  from datetime import date, timedelta
+
+  import db
+  from analytics import order_day
+  from discovery import restaurant_index
+  from main import app  # runs the schema migrations (AUTO_MIGRATE)
+  from menu import menu_cache
+  from writer import get_writer
+
+  for name in app.jinja_env.list_templates():
+    app.jinja_env.get_template(name)
+  restaurant_index.load()
+  with app.test_request_context():
+    conn = db.connect_db()
+    busiest = conn.execute(
+        'SELECT RestaurantId FROM DailySales WHERE Day >= ? /* scan-ok */ '
+        'GROUP BY RestaurantId ORDER BY SUM(Orders) DESC LIMIT ?',
+        (order_day(date.today() - timedelta(days=7)), WARM_MENUS)).fetchall()
+    for row in busiest:
+      menu_cache.get(row['RestaurantId'])
+  # no SQLite handle or writer thread may cross the fork
+  db.reset_pool()
+  get_writer().stop()
+  gc.collect()
+  gc.freeze()
+  log.info('preloaded: %d templates, %d menus',
+           len(app.jinja_env.list_templates()), len(busiest))
+  return app
+
+
+def post_fork():
+  import db
+  db.reset_pool()
+  random.seed()
+
+
+def serve_gunicorn(app):
+  from gunicorn.app.base import BaseApplication
+
+  class Application(BaseApplication):
+
+    def load_config(self):
+      settings = {
+          'bind': f'{HOST}:{PORT}',
+          'workers': WORKERS,
+          'threads': THREADS,
+          'worker_class': 'gthread',
+          'max_requests': MAX_REQUESTS,
+          'max_requests_jitter': MAX_REQUESTS_JITTER,
+          'graceful_timeout': GRACEFUL_TIMEOUT,
+          'backlog': BACKLOG,
+          'preload_app': True,
+          'post_fork': lambda *_: post_fork(),
+      }
+      for key, value in settings.items():
+        self.cfg.set(key, value)
+
+    def load(self):
+      return app
+
+  Application().run()
+
+
+class PooledWSGIServer(BaseWSGIServer):
+  # like werkzeug's threaded server, but with a fixed number of threads
+
+  def __init__(self, app, fd, threads):
+    super().__init__(HOST, PORT, app, fd=fd)
+    self.pool = ThreadPoolExecutor(max_workers=threads,
+                                   thread_name_prefix='request')
+
+  def process_request(self, request, client_address):
+    self.pool.submit(self._handle, request, client_address)
+
+  def _handle(self, request, client_address):
+    try:
+      self.finish_request(request, client_address)
+    except Exception:
+      self.handle_error(request, client_address)
+    finally:
+      self.shutdown_request(request)
+
+
+def run_worker(app, listener):
+  post_fork()
+  limit = MAX_REQUESTS + random.randint(0, MAX_REQUESTS_JITTER)
+  served = 0
+  lock = threading.Lock()
+  server = None
+
+  def stop(*_):
+    threading.Thread(target=server.shutdown, daemon=True).start()
+
+  def counting_app(environ, start_response):
+    nonlocal served
+    with lock:
+      served += 1
+      if MAX_REQUESTS and served == limit:
+        stop()
+    return app(environ, start_response)
+
+  server = PooledWSGIServer(counting_app, listener.fileno(), THREADS)
+  signal.signal(signal.SIGTERM, stop)
+  signal.signal(signal.SIGINT, signal.SIG_IGN)
+  import credentials
+  try:
+    server.serve_forever()
+    # finish what was accepted, but do not hang on open event streams
+    finisher = threading.Thread(target=server.pool.shutdown, daemon=True)
+    finisher.start()
+    finisher.join(GRACEFUL_TIMEOUT)
+    from writer import get_writer
+    get_writer().stop(GRACEFUL_TIMEOUT)
+  finally:
+    # the worker leaves through os._exit, which would orphan the password
+    # hashing processes
+    credentials.shutdown()
+
+
+def serve_builtin(app):
+  listener = socket.create_server((HOST, PORT), backlog=BACKLOG)
+  listener.set_inheritable(True)
+  children = set()
+  stopping = False
+
+  def spawn():
+    pid = os.fork()
+    if pid == 0:
+      code = 0
+      try:
+        run_worker(app, listener)
+      except BaseException:
+        log.exception('worker crashed')
+        code = 1
+      finally:
+        os._exit(code)
+    children.add(pid)
+    log.info('worker %d started', pid)
+
+  def shutdown(*_):
+    nonlocal stopping
+    stopping = True
+    for pid in list(children):
+      with contextlib.suppress(ProcessLookupError):
+        os.kill(pid, signal.SIGTERM)
+
+  signal.signal(signal.SIGTERM, shutdown)
+  signal.signal(signal.SIGINT, shutdown)
+  log.info('listening on %s:%d with %d workers x %d threads', HOST, PORT,
+           WORKERS, THREADS)
+  for _ in range(WORKERS):
+    spawn()
+  while children:
+    try:
+      pid, status = os.wait()
+    except ChildProcessError:
+      break
+    except InterruptedError:
+      continue
+    children.discard(pid)
+    if not stopping:
+      if os.waitstatus_to_exitcode(status) != 0:
+        log.warning('worker %d exited with %s, restarting', pid,
+                    os.waitstatus_to_exitcode(status))
+        time.sleep(1)  # do not spin on a worker that dies at startup
+      spawn()
+
+
+def main():
+  logging.basicConfig(level=logging.INFO,
+                      format='%(asctime)s %(process)d %(message)s')
+  os.environ.setdefault('FLASK_DEBUG', '0')
+  # an open dashboard holds a thread for as long as its event stream is
+  # live; keep half of them for everything else
+  os.environ.setdefault('EVENT_MAX_STREAMS', str(max(THREADS // 2, 1)))
+  # every worker process hashes passwords in a pool of its own; together
+  # they should not want more processes than there are CPUs
+  os.environ.setdefault('PASSWORD_WORKERS',
+                        str(max((os.cpu_count() or 1) // WORKERS, 1)))
+  app = preload()
+  use_gunicorn = SERVER == 'gunicorn'
+  if SERVER == 'auto':
+    try:
+      import gunicorn  # noqa: F401
+      use_gunicorn = True
+    except ImportError:
+      pass
+  if use_gunicorn:
+    serve_gunicorn(app)
+  else:
+    serve_builtin(app)
+
+
+if __name__ == '__main__':
+  sys.exit(main())
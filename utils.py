@@ -1,7 +1,13 @@
-from flask_login import LoginManager, UserMixin, login_user, login_required, logout_user, current_user
-import sqlite3
+import os
 
-ALLOWED_EXTENSIONS = set(['png', 'jpg', 'jpeg', 'gif'])
+from flask_login import UserMixin, current_user
+
+import db
+from cache import TTLCache
+from credentials import hash_password, verify_password
+from writer import write
+
+ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
 
 
 def allowed_file(filename):
@@ -10,68 +16,101 @@ def allowed_file(filename):
 
 
 def connect_db():
-  conn = sqlite3.connect('./lieferspatz.db')
-  conn.row_factory = sqlite3.Row
-  return conn
+  return db.connect_db()
 
 
-# write function where user already exists
+# authenticated principal, hydrated once by load_principal() so role and
+# postcode checks never have to go back to the database
 class User(UserMixin):
-  pass
+  role = None
+  postcode = None
+  name = None
 
+  @property
+  def is_customer(self):
+    return self.role == 'customer'
+
+  @property
+  def is_restaurant(self):
+    return self.role == 'restaurant'
+
+
+principal_cache = TTLCache(maxsize=int(os.environ.get('PRINCIPAL_CACHE_SIZE',
+                                                      4096)),
+                           ttl=int(os.environ.get('PRINCIPAL_CACHE_TTL', 300)))
+
+
+def load_principal(user_id):
+  user_id = int(user_id)
+  user = principal_cache.get(user_id)
+  if user is not None:
+    return user
 
-def authenticate_user(email, password):
   conn = connect_db()
-  user = conn.execute(
-      'SELECT * FROM AccountHolder WHERE Email = ? AND Password = ?',
-      (email, password)).fetchone()
+  row = conn.execute(
+      """SELECT AccountHolder.ID, AccountHolder.postcode,
+         Customer.CustomerID, Customer.FirstName, Customer.LastName,
+         Restaurant.RestaurantID, Restaurant.RestaurantName
+      FROM AccountHolder
+        LEFT JOIN Customer ON Customer.CustomerID = AccountHolder.ID
+        LEFT JOIN Restaurant ON Restaurant.RestaurantID = AccountHolder.ID
+      WHERE AccountHolder.ID = ?""", (user_id, )).fetchone()
   conn.close()
-  if user:
-    app_user = User()
-    app_user.id = user['ID']
-    return app_user
-  conn.close()
-  return None
+  if row is None:
+    return None
 
+  user = User()
+  user.id = row['ID']
+  user.postcode = row['postcode']
+  if row['RestaurantID'] is not None:
+    user.role = 'restaurant'
+    user.name = row['RestaurantName']
+  elif row['CustomerID'] is not None:
+    user.role = 'customer'
+    user.name = f"{row['FirstName']} {row['LastName']}"
+  principal_cache.set(user_id, user)
+  return user
 
-def isCustomer():
+
+# call whenever AccountHolder/Customer/Restaurant rows of a user change
+def invalidate_principal(user_id):
+  principal_cache.invalidate(int(user_id))
+
+
+def authenticate_user(email, password):
   conn = connect_db()
-  customer = conn.execute('SELECT *  FROM Customer where CustomerId = ?',
-                          (int(current_user.id), )).fetchone()
-  conn.close()
-  if customer:
-    return True
+  user = conn.execute('SELECT ID, Password FROM AccountHolder WHERE Email = ?',
+                      (email, )).fetchone()
   conn.close()
-  return False
+  # an unknown email is checked against a dummy hash, so the response time
+  # does not tell which accounts exist
+  matches, needs_rehash = verify_password(
+      user['Password'] if user is not None else None, password)
+  if not matches:
+    return None
+  if needs_rehash:
+    stored = hash_password(password)
+    # only replaces the value that was just verified
+    write(lambda conn: conn.execute(
+        'UPDATE AccountHolder SET Password = ? WHERE ID = ? AND Password = ?',
+        (stored, user['ID'], user['Password'])))
+  return load_principal(user['ID'])
+
+
+def isCustomer():
+  return getattr(current_user, 'is_customer', False)
 
 
 def isRestaurant():
-  conn = connect_db()
-  restaurant = conn.execute('SELECT *  FROM Restaurant where RestaurantId = ?',
-                            (current_user.id, )).fetchone()
-  conn.close()
-  if restaurant:
-    return True
-  conn.close()
-  return False
+  return getattr(current_user, 'is_restaurant', False)
 
 
 def getUserPostcode():
-  conn = connect_db()
-  row = conn.execute('SELECT postcode FROM AccountHolder where ID = ?',
-                     (int(current_user.id), )).fetchone()
-
-  conn.close()
-  return row['postcode']
+  return current_user.postcode
 
 
 def restaurantName():
-  conn = connect_db()
-  name = conn.execute('SELECT Name FROM Restaurant where RestaurantId = ?',
-                      (current_user.id, )).fetchone()
-
-  conn.close()
-  return name
+  return current_user.name
 
 
 def insertAccountHolder(email, password, postcode, address, conn):
@@ -81,14 +120,3 @@ def insertAccountHolder(email, password, postcode, address, conn):
       (email, password, postcode, address))
   last_row_id = account_holder.lastrowid
   return last_row_id
-
-
-def user_already_exists(conn, email):
-
-  user_exists = conn.execute('SELECT * FROM AccountHolder WHERE Email = ?',
-                             (email, )).fetchone()
-  print(user_exists)
-  if user_exists:
-    return True
-  else:
-    return False
@@ -0,0 +1,162 @@
+import os
+import queue
+import threading
+from concurrent.futures import Future
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+import db
+import metrics
+
+ENABLED = os.environ.get('DB_WRITER', '1') == '1'
+BATCH_SIZE = int(os.environ.get('DB_WRITER_BATCH', 64))
+# how long the writer lingers for more jobs before committing a batch
+BATCH_WAIT = float(os.environ.get('DB_WRITER_WAIT_MS', 0)) / 1000
+WRITE_TIMEOUT = float(os.environ.get('DB_WRITE_TIMEOUT', 30))
+
+_STOP = object()
+
+
+# all writes go through one thread holding one connection. It drains the
+# queue in small batches and commits each batch as one transaction (group
+# commit); every job runs under its own savepoint so a failing job is rolled
+# back alone and only its future carries the exception.
+class WriteQueue:
+
+  def __init__(self, path=None, batch_size=BATCH_SIZE, batch_wait=BATCH_WAIT):
+    self.path = path
+    self.batch_size = batch_size
+    self.batch_wait = batch_wait
+    self.batches = 0
+    self.jobs = 0
+    self._queue = queue.Queue()
+    self._thread = None
+    self._pid = None
+    self._lock = threading.Lock()
+
+  # the future's `stats` (metrics.JobStats) hold the job's statements once
+  # it is done, attributed to the submitting route or thread
+  def submit(self, fn, *args, **kwargs):
+    self._ensure_started()
+    future = Future()
+    future.stats = metrics.JobStats(metrics.current_endpoint())
+    self._queue.put((future, fn, args, kwargs))
+    return future
+
+  def _running(self):
+    return (self._thread is not None and self._pid == os.getpid()
+            and self._thread.is_alive())
+
+  # starts the thread, or restarts it after it died (e.g. its connection
+  # could not be opened); queued jobs are kept for the new one
+  def _ensure_started(self):
+    if self._running():
+      return
+    with self._lock:
+      if not self._running():
+        # a forked worker inherits the object but not the thread or the
+        # parent's jobs
+        if self._pid != os.getpid():
+          self._queue = queue.Queue()
+        self._pid = os.getpid()
+        self._thread = threading.Thread(target=self._run,
+                                        name='db-writer',
+                                        daemon=True)
+        self._thread.start()
+
+  # jobs waiting for the writer thread
+  def backlog(self):
+    return self._queue.qsize()
+
+  def stop(self, timeout=None):
+    if self._thread is not None:
+      self._queue.put(_STOP)
+      self._thread.join(timeout)
+      self._thread = None
+
+  def _next_batch(self):
+    batch = [self._queue.get()]
+    while len(batch) < self.batch_size and batch[-1] is not _STOP:
+      try:
+        batch.append(self._queue.get(timeout=self.batch_wait)
+                     if self.batch_wait else self._queue.get_nowait())
+      except queue.Empty:
+        break
+    return batch
+
+  def _run(self):
+    conn = db.open_connection(self.path)
+    try:
+      while True:
+        batch = self._next_batch()
+        stop = batch[-1] is _STOP
+        jobs = [job for job in batch if job is not _STOP]
+        if jobs:
+          self._commit(conn, jobs)
+        if stop:
+          return
+    finally:
+      conn.close()
+
+  def _commit(self, conn, jobs):
+    outcomes = []
+    try:
+      conn.execute('BEGIN IMMEDIATE')
+      for future, fn, args, kwargs in jobs:
+        if not future.set_running_or_notify_cancel():
+          outcomes.append(None)
+          continue
+        conn.execute('SAVEPOINT job')
+        try:
+          with metrics.job(future.stats):
+            outcomes.append((True, fn(conn, *args, **kwargs)))
+        except BaseException as e:
+          conn.execute('ROLLBACK TO job')
+          outcomes.append((False, e))
+        conn.execute('RELEASE job')
+      conn.commit()
+    except BaseException as e:
+      if conn.in_transaction:
+        conn.rollback()
+      for future, _, _, _ in jobs:
+        if not future.done():
+          future.set_exception(e)
+      return
+    self.batches += 1
+    self.jobs += len(jobs)
+    # results are only published once the batch is durable
+    for (future, _, _, _), outcome in zip(jobs, outcomes, strict=True):
+      if outcome is None:
+        continue
+      ok, value = outcome
+      if ok:
+        future.set_result(value)
+      else:
+        future.set_exception(value)
+
+
+_writer = WriteQueue()
+
+
+def get_writer():
+  return _writer
+
+
+# runs fn(conn, *args, **kwargs) in a write transaction and returns its
+# result. With the writer enabled the job is queued for the writer thread;
+# otherwise it runs on the request's own connection.
+def write(fn, *args, **kwargs):
+  if ENABLED:
+    future = _writer.submit(fn, *args, **kwargs)
+    try:
+      return future.result(timeout=WRITE_TIMEOUT)
+    except FutureTimeoutError:
+      # nobody waits for the result any more; don't run it if it has not
+      # started yet
+      future.cancel()
+      raise
+    finally:
+      if future.done():
+        metrics.add_job(future.stats)
+  conn = db.connect_db()
+  with db.transaction(conn):
+    return fn(conn, *args, **kwargs)